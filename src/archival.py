@@ -2,18 +2,20 @@ import os
 import math
 import argparse
 import random
-import pickle
 import logging
-from uuid import uuid4
-from pydub import AudioSegment
-from pydub.playback import play
+import functools
+from concurrent.futures import Future, ProcessPoolExecutor
 
+import numpy as np
+
+import metrics
 from constants import FLASK_NAME
-from twitter import get_trends_by_location_name
-from internet_archive import get_mp3_data_for_search_results
-from audio import convert_to_pcm, convert_to_pcm_ffmpeg
-from vad import extract_voiced_sections, write_wave
-from util import quantize_without_going_over
+from internet_archive import download_mp3, get_fetcher, select_mp3_candidates
+from audio import SAMPLE_RATE, ChunkedSource, Section, decode_stream, decode_to_samples, encode_mp3, seconds_to_samples, MP3Stream
+from vad import extract_voiced_sections, extract_voiced_sections_from_stream
+from mixdown import render_blocks
+from library import get_segment_library
+from util import quantize_without_going_over, wait_for_next
 
 
 logger = logging.getLogger(FLASK_NAME)
@@ -23,56 +25,221 @@ logger = logging.getLogger(FLASK_NAME)
 SEGMENT_BUCKETS_MS = [500, 1000, 1500, 3000, 5000]
 
 
-def generate_audio_for_search_results(name, results, max_section_length=10.0, max_sections_per_source=15):
+# Number of processes to decode and run VAD on sources in parallel, 0 to ingest sequentially
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 0))
+
+
+# Decode and run VAD on sources as they download, closing the connection once enough sections are found.
+#   Sources cut off early aren't added to the segment library, but still finish downloading into the cache
+PROGRESSIVE_INGEST = os.environ.get("PROGRESSIVE_INGEST", "True") == "True"
+
+
+def ingest_source(data):
+    """Decodes a source and runs VAD on it. Safe to run in a worker process.
+    Args:
+        data (bytes): Encoded MP3 data.
+    Returns:
+        (numpy.ndarray, list): The decoded samples and voiced (start, end) sections in seconds.
+    """
+    with metrics.stage("decode", nbytes=len(data)):
+        source = decode_to_samples(data)
+    with metrics.stage("vad", nbytes=source.nbytes):
+        sections = extract_voiced_sections(memoryview(source).cast("B"))
+    return source, sections
+
+
+def _ingest_source_in_worker(data):
+    # Hand stage metrics back to the parent along with the result
+    return metrics.collect_stages(ingest_source, data)
+
+
+def ingest_stream(chunks, enough=None):
+    """Decodes a source and runs VAD on it as its data arrives. Safe to run in a worker process.
+    Args:
+        chunks (iterable): Chunks of encoded MP3 data, closed if ingestion stops early.
+        enough (function): Given the voiced sections so far, returns True to stop reading.
+    Returns:
+        (numpy.ndarray, list, bool): The samples decoded so far, their voiced (start, end) sections
+            in seconds, and whether that is the whole source.
+    """
+    blocks = []
+    complete = False
+
+    def collect_blocks(source):
+        nonlocal complete
+        for block in decode_stream(source):
+            blocks.append(block)
+            yield memoryview(block).cast("B")
+        complete = True
+
+    with ChunkedSource(chunks) as source, metrics.stage("stream") as s:
+        sections = extract_voiced_sections_from_stream(collect_blocks(source), until=enough)
+        s.bytes = source.bytes_read
+    source_samples = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.int16)
+    return source_samples, sections, complete
+
+
+def _ingest_stream_in_worker(stream, identifier, filename, enough):
+    # Download in the worker too, so only the decoded source is sent back
+    return metrics.collect_stages(ingest_stream, stream(identifier, filename), enough)
+
+
+def _enough_sections(max_section_length, max_sections_per_source, sections):
+    # generate_audio_for_search_results stops after max_sections_per_source + 1 short enough sections
+    return sum(1 for start, end in sections if end - start <= max_section_length) > max_sections_per_source
+
+
+def _to_section(source, section):
+    start = seconds_to_samples(section[0])
+    return Section(source, start, seconds_to_samples(section[1]) - start)
+
+
+def _section_buckets(source, sections):
+    return [quantize_without_going_over(len(_to_section(source, section)), SEGMENT_BUCKETS_MS) for section in sections]
+
+
+def _completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _ingest_sources(mp3_files, workers=0, ordered=False, download=download_mp3, library=None, stream=None, enough=None):
+    """Yields (title, source, sections, buckets) for each source that can be ingested,
+        using the segment library instead of downloading when possible.
+    Args:
+        mp3_files (generator): Yields (identifier, filename, title) for candidate MP3s, with
+            the data appended if it has already been downloaded.
+        workers (int): Number of worker processes, 0 to ingest in this process.
+        ordered (bool): Yield in download order rather than completion order.
+        download (function): Returns the data for an (identifier, filename), or None.
+        library (SegmentLibrary): Library to read sources from and store them in.
+        stream (function): Yields the data for an (identifier, filename) in chunks. When
+            given, sources are ingested as they download instead of using download.
+        enough (function): Given a streaming source's sections so far, returns True to stop
+            downloading it.
+    """
+    executor = ProcessPoolExecutor(max_workers=workers) if workers else None
+    pending = {}
+    try:
+        mp3_files = iter(mp3_files)
+        files_remaining = True
+        while files_remaining or pending:
+            # Keep a bounded number of sources in flight while downloading the next ones
+            while files_remaining and len(pending) < max(1, 2 * workers):
+                next_file = next(mp3_files, None)
+                if next_file is None:
+                    files_remaining = False
+                    break
+                identifier, filename, title = next_file[:3]
+
+                # Skip ingestion entirely for sources in the library
+                entry = library.get(identifier, filename) if library else None
+                if entry:
+                    logger.debug(f"Found \"{title}\" in segment library")
+                    pending[_completed_future(((entry.source, entry.sections), []))] = (identifier, filename, title, entry)
+                    continue
+
+                if stream:
+                    if executor:
+                        logger.debug(f"Submitting \"{title}\" for streaming ingestion...")
+                        future = executor.submit(_ingest_stream_in_worker, stream, identifier, filename, enough)
+                    else:
+                        logger.debug(f"Streaming \"{title}\"...")
+                        try:
+                            future = _completed_future((ingest_stream(stream(identifier, filename), enough), []))
+                        except Exception as e:
+                            logger.debug(f"Unable to ingest \"{title}\": {e}")
+                            continue
+                    pending[future] = (identifier, filename, title, None)
+                    continue
+
+                data = next_file[3] if len(next_file) > 3 else download(identifier, filename)
+                if data is None:
+                    continue
+
+                if executor:
+                    logger.debug(f"Submitting \"{title}\" for ingestion...")
+                    # Memory-mapped cached downloads are copied to send them to the worker
+                    future = executor.submit(_ingest_source_in_worker, bytes(data))
+                else:
+                    logger.debug(f"Ingesting \"{title}\"...")
+                    try:
+                        future = _completed_future((ingest_source(data), []))
+                    except Exception as e:
+                        logger.debug(f"Unable to ingest \"{title}\": {e}")
+                        continue
+                pending[future] = (identifier, filename, title, None)
+            if not pending:
+                break
+
+            for future in wait_for_next(pending, ordered):
+                identifier, filename, title, entry = pending.pop(future)
+                try:
+                    result, observations = future.result()
+                    metrics.record_stages(observations)
+                except Exception as e:
+                    logger.debug(f"Unable to ingest \"{title}\": {e}")
+                    continue
+                source, sections = result[:2]
+                # Streamed sources stopped once they had enough sections are only partly ingested
+                complete = result[2] if len(result) > 2 else True
+
+                if entry and entry.buckets_ms == SEGMENT_BUCKETS_MS:
+                    buckets = entry.buckets
+                else:
+                    buckets = _section_buckets(source, sections)
+
+                # Newly ingested sources are added to the library, if they were ingested whole
+                if library and not entry and complete:
+                    library.put(identifier, filename, source, sections, buckets, SEGMENT_BUCKETS_MS)
+
+                yield title, source, sections, buckets
+    finally:
+        # Cancel outstanding work once the caller has collected enough
+        for future in pending:
+            future.cancel()
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def generate_audio_for_search_results(name, results, max_section_length=10.0, max_sections_per_source=15, workers=INGEST_WORKERS, seed=None,
+                                      fetcher=None, library=None, progressive=PROGRESSIVE_INGEST, upload=None):
     # Create map for audio 
     audio_segments = {bucket_max: [] for bucket_max in SEGMENT_BUCKETS_MS}
 
-    # Search internet archive for a related MP3s
-    mp3_data = get_mp3_data_for_search_results(results)
-
-    for title, data in mp3_data:
-        # Write to file to create AudioSegment
-        filename = f"{str(uuid4())}.mp3"
-        try:
-            with open(filename, "wb") as f:
-                f.write(data)
-        except Exception as e:
-            logger.debug(f"Unable to open file: {e}")
-
-        # Convert MP3 data to PCM
-        logger.debug(f"Converting \"{title}\"...")
-        try:
-            pcm_data = convert_to_pcm_ffmpeg(filename)
-        except Exception as e:
-            logger.debug(f"Unable to convert MP3 to PCM: {e}")
-            continue
-
-        # Create audio segment from MP3
-        logger.debug(f"Creating audio segment from \"{filename}\"...")
-        try:
-            source_segment = AudioSegment.from_mp3(filename)
-        except Exception as e:
-            logger.debug(f"Unable to create audio segment from MP3 file: {e}")
-            continue
-
-        # Delete downloaded MP3 file
-        logger.debug(f"Removing downloaded \"{filename}\"...")
-        if os.path.exists(filename):
-            os.remove(filename)
-
-        # Save off some voiced segments
-        logger.debug(f"Running VAD on \"{title}\"...")
-        sections = extract_voiced_sections(pcm_data)
+    # Use the shared fetcher and segment library unless given, or library=False
+    fetcher = fetcher if fetcher else get_fetcher()
+    library = get_segment_library() if library is None else library
+
+    # Fetch related MP3s from the internet archive several at a time, downloading
+    #   them along the way unless they are in the library or will be streamed
+    if progressive:
+        prefetch = None
+    else:
+        prefetch = lambda identifier, filename: not (library and library.contains(identifier, filename))
+    # Sources are used in search result order when seeded so the composition is reproducible
+    candidates = select_mp3_candidates(results)
+    mp3_files = fetcher.get_mp3_files(candidates, prefetch=prefetch, ordered=seed is not None)
+
+    # Stop streaming each source once it has as many sections as will be used
+    enough = functools.partial(_enough_sections, max_section_length, max_sections_per_source)
+
+    # Keep that order through ingestion too when seeded
+    sources = _ingest_sources(mp3_files, workers=workers, ordered=seed is not None, download=fetcher.download, library=library,
+                              stream=fetcher.stream if progressive else None, enough=enough)
+
+    for title, source, sections, buckets in sources:
+        logger.debug(f"Slicing voiced sections of \"{title}\"...")
         added_sections = 0
 
         source_audio_segments = {bucket_max: [] for bucket_max in SEGMENT_BUCKETS_MS}
 
-        for section in sections:
+        for section, bucket in zip(sections, buckets):
             if section[1] - section[0] > max_section_length:
                 # Skip sections longer than max_section_length
                 continue
-            audio_segment = source_segment[math.floor(section[0] * 1000):math.floor(section[1] * 1000)]
-            source_audio_segments[quantize_without_going_over(len(audio_segment), SEGMENT_BUCKETS_MS)].append(audio_segment)
+            source_audio_segments[bucket].append(_to_section(source, section))
             added_sections += 1
             # only save off a handful of sections per file for diversity
             if added_sections > max_sections_per_source:
@@ -96,22 +263,53 @@ def generate_audio_for_search_results(name, results, max_section_length=10.0, ma
 
         if num_files > 50:
             logger.debug("Collected 50 files, composing...")
+            sources.close()
             break
 
-    # Save off audio segments
-    if os.environ.get("SAVE_SEGMENTS"):
-        with open(f"{name}_audio_segments.pickle", "wb") as f:
-            pickle.dump(audio_segments, f)
-
     # Compose and save file
-    composition_filename, composition_duration = compose(name, audio_segments)
+    composition_filename, composition_duration = compose(name, audio_segments, rng=random.Random(seed), upload=upload)
 
     # Return metadata
     return composition_filename, composition_duration
 
 
-def compose(name, audio_segments, density=0.5):
+def compose(name, audio_segments, density=0.5, rng=random, upload=None):
+    """Schedules, renders and encodes a composition to {name}.mp3, or if upload is
+        given, passes it an MP3Stream of the composition to read as it is encoded.
+    Returns:
+        (str, float): The composition's filename, or None if uploaded, and duration in seconds.
+    """
     # Plan out the composition
+    with metrics.stage("compose"):
+        scheduled_segments, composition_length = schedule(audio_segments, density=density, rng=rng)
+
+    # Stream the composition block by block into the encoder
+    logger.debug("Putting together composition...")
+    filename = f"{name}.mp3"
+    with metrics.stage("export") as s:
+        blocks = render_blocks(scheduled_segments, composition_length)
+        if upload:
+            stream = MP3Stream(blocks)
+            upload(stream)
+            filename, frames, s.bytes = None, stream.frames, stream.bytes
+        else:
+            frames = encode_mp3(blocks, filename)
+            s.bytes = os.path.getsize(filename)
+    duration = frames / SAMPLE_RATE
+    logger.debug(f"{'Uploaded' if upload else 'Saved'} composition [{duration}s]...")
+
+    return filename, duration
+
+
+def schedule(audio_segments, density=0.5, rng=random):
+    """Randomly schedules bucketed segments into a composition.
+    Args:
+        audio_segments (dict): Lists of per-source segment lists, keyed by bucket.
+        density (float): How densely to pack segments, from 0 to 1.
+        rng (random.Random): Source of randomness.
+    Returns:
+        (list[dict], float): Scheduled segments and the composition length in ms.
+    """
     composition_buckets = {bucket: [] for bucket in audio_segments.keys()}
     composition_length = 0
 
@@ -137,29 +335,29 @@ def compose(name, audio_segments, density=0.5):
         added_silence_probability = 0.55 - (0.5 * ((bucket_index + 1) / num_buckets))
 
         # Set initial offset
-        offset = max(0, offset_min + (random.random() * offset_diff))
+        offset = max(0, offset_min + (rng.random() * offset_diff))
 
         # Randomly schedule available segments
         while source_segments_list:
             # Update offset
-            offset += (offset_min + (random.random() * offset_diff))
+            offset += (offset_min + (rng.random() * offset_diff))
 
             # Determine pan
-            pan = pan_min + (random.random() * pan_diff)
+            pan = pan_min + (rng.random() * pan_diff)
 
-            source_index = random.randint(0, len(source_segments_list)-1)
+            source_index = rng.randint(0, len(source_segments_list)-1)
             segment = source_segments_list[source_index].pop(0)
             if len(source_segments_list[source_index]) < 1:
                 source_segments_list.pop(source_index)
             scheduled_segment = {
-                "segment": segment.normalize().fade_in(10).fade_out(10),
+                "segment": segment,
                 "offset": max(0, offset),
                 "pan": pan
             }
             composition_buckets[bucket].append(scheduled_segment)
 
             # Determine if silence is added to affect density
-            if random.random() < added_silence_probability:
+            if rng.random() < added_silence_probability:
                 offset += ((1 - density) * 1000)
 
         # Update composition length
@@ -170,22 +368,8 @@ def compose(name, audio_segments, density=0.5):
 
         bucket_index += 1
 
-    # Put together the composition
-    logger.debug("Putting together composition...")
-    master = AudioSegment.silent(duration=composition_length)
-    for scheduled_segments in composition_buckets.values():
-        for scheduled_segment in scheduled_segments:
-            s = scheduled_segment["segment"].pan(scheduled_segment["pan"])
-            master = master.overlay(s, position=scheduled_segment["offset"])
-
-    # Save off master to file
-    duration = len(master) / 1000
-    logger.debug(f"Saving composition [{duration}s]...")
-    filename = f"{name}.mp3"
-    with open(filename, "wb") as f:
-        master.export(f, format="mp3")
-
-    return filename, duration
+    scheduled_segments = [s for scheduled_segments in composition_buckets.values() for s in scheduled_segments]
+    return scheduled_segments, composition_length
 
 
 if __name__ == "__main__":
@@ -1,21 +1,55 @@
 import os
 import subprocess
 import logging
+import threading
 import miniaudio
+import numpy as np
+from pydub import AudioSegment
 
 from constants import FLASK_NAME
 
 
 logger = logging.getLogger(FLASK_NAME)
 
+# All decoded audio is 16-bit mono 48kHz PCM
+SAMPLE_RATE = 48000
+SAMPLE_WIDTH = 2
+
+
+class Section(object):
+    """A section of a decoded source, stored as a view into the source's samples
+        rather than a copy.
+    Args:
+        source (numpy.ndarray): The source's int16 samples.
+        start (int): Index of the first sample of the section.
+        length (int): Number of samples in the section.
+    """
+    __slots__ = ("source", "start", "length")
+
+    def __init__(self, source, start, length):
+        self.source = source
+        self.start = start
+        self.length = length
+
+    @property
+    def samples(self):
+        return self.source[self.start:self.start + self.length]
+
+    def __len__(self):
+        # Length in milliseconds, matching AudioSegment
+        return round(self.length * 1000 / SAMPLE_RATE)
+
+    def to_audio_segment(self):
+        return AudioSegment(data=self.samples.tobytes(), sample_width=SAMPLE_WIDTH, frame_rate=SAMPLE_RATE, channels=1)
+
 
 def convert_to_pcm(data):
     # Convert to 16-bit mono 48kHz PCM
-    return miniaudio.decode(data, output_format=miniaudio.SampleFormat.SIGNED16, nchannels=1, sample_rate=48000).samples.tobytes()
+    return miniaudio.decode(data, output_format=miniaudio.SampleFormat.SIGNED16, nchannels=1, sample_rate=SAMPLE_RATE).samples.tobytes()
 
 
 def convert_to_pcm_ffmpeg(filename):
-    command = f"ffmpeg -y -i {filename} -acodec pcm_s16le -f s16le -ac 1 -ar 48000 {filename}.pcm"
+    command = f"ffmpeg -y -i {filename} -acodec pcm_s16le -f s16le -ac 1 -ar {SAMPLE_RATE} {filename}.pcm"
     logger.debug(f"running command: {command}")
     with open(os.devnull, 'wb') as devnull:
         subprocess.check_call(command.split(" "), stdout=devnull, stderr=subprocess.STDOUT)
@@ -29,3 +63,189 @@ def convert_to_pcm_ffmpeg(filename):
     os.remove(f"{filename}.pcm")
 
     return pcm_data
+
+
+def convert_to_pcm_ffmpeg_pipe(data):
+    # Same as convert_to_pcm_ffmpeg, but piped through ffmpeg without touching disk
+    command = f"ffmpeg -i pipe:0 -acodec pcm_s16le -f s16le -ac 1 -ar {SAMPLE_RATE} pipe:1"
+    logger.debug(f"running command: {command}")
+    return subprocess.run(command.split(" "), input=data, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+
+
+class ChunkedSource(miniaudio.StreamableSource):
+    """Feeds a streaming decoder from an iterable of encoded chunks, such as a
+        download read as it arrives. Closing the source closes the iterable.
+    Data that has arrived is kept so the decoder can seek back to read headers,
+        which is how it skips the MP3 encoder delay like decode_to_samples does.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.data = bytearray()
+        self.position = 0
+
+    @property
+    def bytes_read(self):
+        return len(self.data)
+
+    def _fill(self, num_bytes):
+        # Read chunks until num_bytes have arrived or there are none left
+        while len(self.data) < num_bytes:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.data += chunk
+
+    def read(self, num_bytes):
+        self._fill(self.position + num_bytes)
+        data = bytes(self.data[self.position:self.position + num_bytes])
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, origin):
+        if origin == miniaudio.SeekOrigin.START:
+            position = offset
+        elif origin == miniaudio.SeekOrigin.CURRENT:
+            position = self.position + offset
+        else:
+            return False
+        self._fill(position)
+        if not 0 <= position <= len(self.data):
+            return False
+        self.position = position
+        return True
+
+    def close(self):
+        close = getattr(self.chunks, "close", None)
+        if close:
+            close()
+
+
+def decode_stream(source, block_frames=SAMPLE_RATE):
+    """Decodes MP3 data as it is read from a source.
+    Args:
+        source (miniaudio.StreamableSource): Source of encoded MP3 data.
+        block_frames (int): Number of samples to decode at a time.
+    Returns:
+        generator: Yields blocks of int16 samples of 16-bit mono 48kHz audio.
+    """
+    stream = miniaudio.stream_any(source, source_format=miniaudio.FileFormat.MP3, output_format=miniaudio.SampleFormat.SIGNED16,
+                                  nchannels=1, sample_rate=SAMPLE_RATE, frames_to_read=block_frames)
+    for block in stream:
+        yield np.frombuffer(block, dtype=np.int16)
+
+
+def decode_to_samples(data):
+    """Decodes MP3 data once into a buffer of 16-bit mono 48kHz samples.
+    Args:
+        data (bytes-like): Encoded MP3 data, e.g. a memory-mapped cached download.
+    Returns:
+        numpy.ndarray: int16 samples, backed by the decoder's output buffer.
+    """
+    # miniaudio only decodes from bytes
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    try:
+        decoded = miniaudio.decode(data, output_format=miniaudio.SampleFormat.SIGNED16, nchannels=1, sample_rate=SAMPLE_RATE)
+        return np.frombuffer(decoded.samples, dtype=np.int16)
+    except miniaudio.DecodeError as e:
+        logger.debug(f"miniaudio unable to decode, falling back to ffmpeg: {e}")
+        return np.frombuffer(convert_to_pcm_ffmpeg_pipe(data), dtype=np.int16)
+
+
+def seconds_to_samples(seconds):
+    return int(round(seconds * SAMPLE_RATE))
+
+
+def encode_mp3(blocks, filename, channels=2):
+    """Pipes blocks of PCM into a single long-lived ffmpeg process encoding to MP3.
+    Args:
+        blocks (generator): Yields int16 numpy.ndarray blocks of interleaved samples.
+        filename (str): File to write the MP3 to.
+        channels (int): Number of interleaved channels in each block.
+    Returns:
+        int: Number of frames encoded.
+    """
+    command = f"ffmpeg -y -f s16le -ar {SAMPLE_RATE} -ac {channels} -i pipe:0 -f mp3".split(" ") + [filename]
+    logger.debug(f"running command: {command}")
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    frames = 0
+    try:
+        for block in blocks:
+            process.stdin.write(memoryview(block).cast("B"))
+            frames += len(block)
+    except BrokenPipeError:
+        # The encoder exited early, its exit code says why
+        pass
+    except BaseException:
+        # Stop the encoder rather than wait for it to finish a partial file
+        process.kill()
+        raise
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    return frames
+
+
+class MP3Stream(object):
+    """Encodes blocks of PCM to MP3 with a single long-lived ffmpeg process like
+        encode_mp3, but yields the MP3 as it is encoded rather than writing a file.
+    As ffmpeg can't seek back to fill in the LAME header, players don't know to skip
+        the encoder delay, leaving about 23ms of extra silence at the start.
+    Args:
+        blocks (generator): Yields int16 numpy.ndarray blocks of interleaved samples.
+        channels (int): Number of interleaved channels in each block.
+        chunk_size (int): Number of bytes of MP3 to yield at a time.
+    Once iterated, frames and bytes hold the number of frames encoded and MP3 bytes yielded.
+    """
+    def __init__(self, blocks, channels=2, chunk_size=64 * 1024):
+        self.blocks = blocks
+        self.channels = channels
+        self.chunk_size = chunk_size
+        self.frames = 0
+        self.bytes = 0
+        self.error = None
+
+    def _write(self, process):
+        try:
+            for block in self.blocks:
+                process.stdin.write(memoryview(block).cast("B"))
+                self.frames += len(block)
+        except BrokenPipeError:
+            # The encoder exited, e.g. as its output was closed early
+            pass
+        except BaseException as e:
+            self.error = e
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def __iter__(self):
+        command = f"ffmpeg -f s16le -ar {SAMPLE_RATE} -ac {self.channels} -i pipe:0 -f mp3 pipe:1".split(" ")
+        logger.debug(f"running command: {command}")
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+        # Feed the encoder from another thread, so it can't block on a full output pipe while being written to
+        writer = threading.Thread(target=self._write, args=(process,), daemon=True)
+        writer.start()
+        try:
+            while True:
+                chunk = process.stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                self.bytes += len(chunk)
+                yield chunk
+        finally:
+            process.stdout.close()
+            writer.join()
+            returncode = process.wait()
+        if self.error:
+            raise self.error
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
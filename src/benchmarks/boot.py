@@ -0,0 +1,85 @@
+"""Benchmarks how long a web-only worker takes to import main and be ready to
+    serve, with local storage standing in for S3 and a simulated delay on each
+    storage request. Compares starting without a local state snapshot, which
+    waits on storage, with starting from one.
+
+Run from src/:
+    python -m benchmarks.boot --latency 0.2
+
+Pass --src with a checkout of an older commit to measure it the same way.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh interpreter, so nothing is already imported
+BOOT_SCRIPT = """
+import sys
+import json
+import time
+
+start = time.perf_counter()
+import storage
+
+def delayed(fn):
+    def wrapper(*args, **kwargs):
+        time.sleep({latency})
+        return fn(*args, **kwargs)
+    return wrapper
+
+for name in ("get_bytes", "get_bytes_if_exists", "get_bytes_if_changed", "list_keys"):
+    if hasattr(storage.LocalStorage, name):
+        setattr(storage.LocalStorage, name, delayed(getattr(storage.LocalStorage, name)))
+
+import main
+ready = time.perf_counter() - start
+heavy = [m for m in ("boto3", "tweepy", "internetarchive", "pydub", "numpy", "archival") if m in sys.modules]
+print(json.dumps({{"ready": ready, "entries": len(main.state.entries), "heavy": heavy}}))
+"""
+
+
+def boot(src, env, latency):
+    output = subprocess.run([sys.executable, "-c", BOOT_SCRIPT.format(latency=latency)], cwd=src, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--src', default=SRC, help='Source directory to boot.')
+    parser.add_argument('--entries', default=1000, type=int, help='Number of entries in the state.')
+    parser.add_argument('--latency', default=0.2, type=float, help='Seconds each storage request takes.')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="archival-benchmark-boot-")
+    try:
+        storage_dir = os.path.join(directory, "storage")
+        os.makedirs(storage_dir)
+        entries = [{"trendName": f"Trend {i}", "trendLocation": "Boston", "numTweets": 1000 + i,
+                    "filename": f"audio/{i}.mp3", "duration": 600.0, "timestamp": 1.6e9 + i} for i in range(args.entries)]
+        with open(os.path.join(storage_dir, "state.json"), "w") as f:
+            json.dump({"entries": entries}, f)
+
+        # A single worker, kept away from any shared store or lock in the working directory
+        env = dict(os.environ, SKIP_GENERATION="True", STORAGE_DIR=storage_dir,
+                   STATE_LOCAL_SNAPSHOT=os.path.join(directory, "state_snapshot.json"),
+                   SHARED_STATE_DB="", GENERATION_LOCK="")
+
+        print(f"{'boot':<24} {'ready (s)':>10} {'entries':>8}  heavy modules")
+        for name in ("no local snapshot", "local snapshot"):
+            result = boot(args.src, env, args.latency)
+            assert result["entries"] == args.entries, result
+            print(f"{name:<24} {result['ready']:>10.3f} {result['entries']:>8}  {', '.join(result['heavy']) or '-'}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
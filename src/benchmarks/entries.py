@@ -0,0 +1,105 @@
+"""Benchmarks the archival page, which links only the most recent entries, and
+    the paginated entries API as the archive grows: server time and bytes per
+    request should stay flat. Then checks that walking every page, newest first
+    or by trend prefix, returns each entry exactly once, and that the trends used
+    recently are those of the entries after the cutoff.
+
+Run from src/:
+    python -m benchmarks.entries --entries 1000 10000 100000
+"""
+import os
+import json
+import time
+import shutil
+import random
+import argparse
+import tempfile
+
+
+def trend_name(i):
+    # Trends reused now and then, and names sharing prefixes
+    return f"{random.choice(['Trend', 'Topic', 'Tag'])} {i % 997 if i % 5 == 0 else i}"
+
+
+def entries_json(num_entries):
+    # Mostly in time order, with some ties and out of order arrivals
+    return [{"trendName": trend_name(i), "trendLocation": "Boston", "numTweets": i, "filename": f"{i}.mp3",
+             "duration": 60.0, "timestamp": 1.6e9 + i // 2 - (3 if i % 50 == 0 else 0)} for i in range(num_entries)]
+
+
+def walk(client, query):
+    entries, cursor, requests = [], None, 0
+    while True:
+        response = client.get(f"/api/entries?limit=100&{query}" + (f"&cursor={cursor}" if cursor else ""))
+        page = response.get_json()
+        entries += page["entries"]
+        requests += 1
+        cursor = page["cursor"]
+        if not cursor:
+            return entries, requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', default=[1000, 10000, 100000], type=int, nargs="+", help='Archive sizes to measure.')
+    parser.add_argument('--requests', default=100, type=int, help='Requests to time per measurement.')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="archival-benchmark-entries-")
+    try:
+        with open(os.path.join(directory, "state.json"), "w") as f:
+            json.dump({"entries": []}, f)
+        os.environ.update({"STORAGE_DIR": directory, "STATE_LOCAL_SNAPSHOT": "", "SHARED_STATE_DB": "",
+                           "GENERATION_LOCK": "", "SKIP_GENERATION": "True", "LOG_LEVEL": "WARNING"})
+        import main as app_main
+        from state import state, ArchivalState
+        from page_cache import PageCache
+        client = app_main.app.test_client()
+
+        print(f"{'entries':>8} {'request':<24} {'ms/request':>11} {'bytes':>8}")
+        for num_entries in args.entries:
+            random.seed(num_entries)
+            state._replace(ArchivalState.from_json({"entries": entries_json(num_entries)}))
+            middle = client.get(f"/api/entries?limit={num_entries // 2}").get_json()["cursor"]
+
+            def report(name, path, before=None):
+                start = time.perf_counter()
+                for _ in range(args.requests):
+                    if before:
+                        before()
+                    response = client.get(path)
+                elapsed = (time.perf_counter() - start) / args.requests
+                assert response.status_code == 200
+                print(f"{num_entries:>8} {name:<24} {elapsed * 1000:>11.3f} {len(response.data):>8}")
+
+            def empty_cache():
+                app_main.page_cache = PageCache()
+
+            report("page, rendered", "/", before=empty_cache)
+            report("api, newest", "/api/entries")
+            report("api, from the middle", f"/api/entries?cursor={middle}")
+            report("api, trend prefix", "/api/entries?trend=topic+1")
+
+            # Every entry once, newest first
+            by_time = sorted(state.entries, key=lambda e: e.timestamp)
+            walked, requests = walk(client, "")
+            assert len(walked) == num_entries, (len(walked), num_entries)
+            assert [e["timestamp"] for e in walked] == [e.timestamp for e in reversed(by_time)]
+            assert len(set(e["filename"] for e in walked)) == num_entries
+
+            # Every entry of trends with a prefix once
+            expected = sorted(e.filename for e in state.entries if e.trend_name.lower().startswith("topic 1"))
+            walked, _ = walk(client, "trend=Topic+1")
+            assert sorted(e["filename"] for e in walked) == expected
+            print(f"{num_entries:>8} walked {requests} pages, {len(expected)} entries matched \"topic 1\"")
+
+            # Trends used after a cutoff, including one tied with entries before and after it
+            for cutoff in (1.6e9 - 10, 1.6e9 + num_entries // 4, 1.6e9 + num_entries // 2 - 1):
+                expected = {e.trend_name.lower() for e in state.entries if e.timestamp > cutoff}
+                assert state.trends_used_since(cutoff) == expected, cutoff
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Local stand-ins for the Internet Archive and source audio, for running the
+    generation pipeline offline.
+"""
+import io
+import os
+import time
+import wave
+import random
+import tempfile
+import numpy as np
+
+from audio import SAMPLE_RATE, encode_mp3
+
+
+def synthetic_speech(seconds, seed=0):
+    """Generates speech-like audio: harmonic bursts at voice pitches separated by silence.
+    Args:
+        seconds (float): Length of the audio.
+        seed (int): Seed for burst placement and pitch.
+    Returns:
+        numpy.ndarray: int16 mono samples at SAMPLE_RATE.
+    """
+    rng = random.Random(seed)
+    samples = np.zeros(int(seconds * SAMPLE_RATE), dtype=np.float32)
+    position = rng.uniform(0.2, 1.0)
+    while position < seconds - 0.5:
+        length = min(rng.uniform(0.3, 6.0), seconds - position)
+        start = int(position * SAMPLE_RATE)
+        t = np.arange(int(length * SAMPLE_RATE), dtype=np.float32) / SAMPLE_RATE
+        f0 = rng.uniform(90, 240)
+        burst = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 12))
+        # Syllable-rate amplitude modulation
+        burst *= 0.6 + 0.4 * np.sin(2 * np.pi * rng.uniform(3, 6) * t)
+        samples[start:start + len(burst)] = burst * rng.uniform(2000, 6000)
+        position += length + rng.uniform(0.3, 2.0)
+    return samples.astype(np.int16)
+
+
+def _to_wav(samples):
+    b = io.BytesIO()
+    with wave.open(b, 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(SAMPLE_RATE)
+        wf.writeframes(samples.tobytes())
+    return b.getvalue()
+
+
+def encode_source(samples):
+    """Encodes samples as MP3 like an Internet Archive source, or as WAV when
+        ffmpeg isn't available (both decode through miniaudio).
+    """
+    fd, filename = tempfile.mkstemp(suffix=".mp3")
+    os.close(fd)
+    try:
+        encode_mp3([samples], filename, channels=1)
+        with open(filename, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return _to_wav(samples)
+    finally:
+        os.remove(filename)
+
+
+class FakeItem:
+    def __init__(self, identifier, title, files):
+        self.identifier = identifier
+        self.metadata = {"title": title}
+        self.files = files
+
+
+class FakeSearch:
+    """Mimics the parts of internetarchive.Search the pipeline uses."""
+
+    def __init__(self, items):
+        self.items = items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        # Search results as returned by search_internet_archive_audio
+        return iter({
+            "identifier": item.identifier,
+            "title": item.metadata["title"],
+            "format": ["VBR MP3"],
+            "item_size": sum(int(file["size"]) for file in item.files),
+        } for item in self.items)
+
+    def iter_as_items(self):
+        return iter(self.items)
+
+
+class FakeArchive:
+    """An in-memory Internet Archive with optional simulated download latency.
+    Args:
+        sources (dict): MP3 data keyed by identifier.
+        latency (float): Seconds to wait per download.
+    """
+
+    def __init__(self, sources, latency=0.0):
+        self.sources = sources
+        self.latency = latency
+        self.downloads = 0
+
+    @staticmethod
+    def synthetic(num_sources, seconds=60, seed=0, latency=0.0):
+        sources = {f"synthetic-{seed}-{i}": encode_source(synthetic_speech(seconds, seed=seed + i)) for i in range(num_sources)}
+        return FakeArchive(sources, latency=latency)
+
+    @staticmethod
+    def from_directory(directory, latency=0.0):
+        sources = {}
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(".mp3"):
+                with open(os.path.join(directory, filename), "rb") as f:
+                    sources[os.path.splitext(filename)[0]] = f.read()
+        return FakeArchive(sources, latency=latency)
+
+    def search(self, query=None):
+        return FakeSearch([
+            FakeItem(identifier, identifier, [{"name": f"{identifier}.mp3", "size": str(len(data))}])
+            for identifier, data in self.sources.items()
+        ])
+
+    def download(self, identifier, filename):
+        if self.latency:
+            time.sleep(self.latency)
+        self.downloads += 1
+        return self.sources.get(identifier)
+
+    def stream(self, identifier, filename, chunk_size=64 * 1024):
+        """Like download, but yields the data in chunks."""
+        data = self.download(identifier, filename)
+        if data is None:
+            return
+        for offset in range(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
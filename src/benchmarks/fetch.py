@@ -0,0 +1,128 @@
+"""Benchmarks fetching sources from a local Internet Archive stand-in with slow
+    and failing mirrors, at several concurrency limits, checking that every
+    healthy item arrives and failing or timed out items are skipped.
+Search results without an MP3 are mixed in, and should be filtered out by
+    select_mp3_candidates without any requests.
+Then fetches everything through an empty HTTP cache, again while it is fresh,
+    and again once it is stale and has to be revalidated. Finally checks a stream
+    closed early still finishes downloading into the cache.
+
+Run from src/:
+    python -m benchmarks.fetch --items 16 --concurrency 1 4 8
+"""
+import time
+import shutil
+import threading
+import argparse
+import tempfile
+
+import metrics
+from http_cache import HTTPCache
+from internet_archive import ArchiveFetcher, select_mp3_candidates
+from benchmarks.fakes import FakeArchive
+from benchmarks.mirror import Mirror
+
+
+def fetch_all(fetcher, results):
+    """Fetches and downloads every candidate, returning ([identifiers in completion order], seconds to first)."""
+    start = time.perf_counter()
+    first = None
+    identifiers = []
+    candidates = select_mp3_candidates(results)
+    for identifier, filename, title, data in fetcher.get_mp3_files(candidates, prefetch=lambda identifier, filename: True):
+        if first is None:
+            first = time.perf_counter() - start
+        identifiers.append(identifier)
+    return identifiers, first
+
+
+def _download_lookups(result):
+    return metrics.CACHE_LOOKUPS.values.get((("cache", "download"), ("result", result)), 0)
+
+
+def cache_runs(archive, results, latency):
+    """Fetches every candidate through an HTTP cache: cold, warm, then stale."""
+    directory = tempfile.mkdtemp(prefix="archival-benchmark-cache-")
+    print(f"{'cache':>11} {'time (s)':>9} {'requests':>9} {'MB sent':>8} {'hits':>5} {'misses':>7} {'revalidated':>12}")
+    try:
+        with Mirror(archive, latency=latency) as mirror:
+            cache = HTTPCache(directory, max_bytes=int(1e9))
+            for name, fresh_seconds in [("cold", 3600), ("warm", 3600), ("stale", 0)]:
+                cache.download_fresh = fresh_seconds
+                fetcher = ArchiveFetcher(base_url=mirror.url, cache=cache)
+                before = [mirror.requests, mirror.bytes_sent] + [_download_lookups(r) for r in ("hit", "miss", "revalidated")]
+                start = time.perf_counter()
+                fetch_all(fetcher, results)
+                elapsed = time.perf_counter() - start
+                after = [mirror.requests, mirror.bytes_sent] + [_download_lookups(r) for r in ("hit", "miss", "revalidated")]
+                requests, sent, hits, misses, revalidated = [a - b for a, b in zip(after, before)]
+                print(f"{name:>11} {elapsed:>9.3f} {requests:>9} {sent / 1e6:>8.1f} {hits:>5} {misses:>7} {revalidated:>12}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def check_closed_stream_cached(archive, latency):
+    """Closes a stream after its first chunk, checking the rest is still cached."""
+    directory = tempfile.mkdtemp(prefix="archival-benchmark-cache-")
+    try:
+        with Mirror(archive, latency=latency) as mirror:
+            cache = HTTPCache(directory, max_bytes=int(1e9))
+            fetcher = ArchiveFetcher(base_url=mirror.url, cache=cache)
+            identifier = next(iter(archive.sources))
+            stream = fetcher.stream(identifier, f"{identifier}.mp3", chunk_size=1024)
+            next(stream)
+            stream.close()
+            for thread in threading.enumerate():
+                if thread.name == "finish-caching":
+                    thread.join()
+            cached = cache.get_download(identifier, f"{identifier}.mp3")
+            assert cached is not None and bytes(cached.read()) == archive.sources[identifier]
+            print(f"stream closed after 1 chunk cached all {cached.size} bytes")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', default=16, type=int, help='Number of items in the search results.')
+    parser.add_argument('--seconds', default=10, type=float, help='Length of each synthetic source.')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 8], help='Concurrency limits to benchmark.')
+    parser.add_argument('--latency', default=0.1, type=float, help='Seconds every mirror request takes.')
+    parser.add_argument('--slow', default=2.0, type=float, help='Seconds the slow mirror stalls, under the read timeout.')
+    parser.add_argument('--timeout', default=3.0, type=float, help='Read timeout for each request.')
+    args = parser.parse_args()
+
+    archive = FakeArchive.synthetic(args.items, seconds=args.seconds)
+    identifiers = list(archive.sources.keys())
+
+    # The first item is slow, the second stalls past the timeout and the third fails
+    slow = {identifiers[0]: args.slow, identifiers[1]: args.timeout * 2}
+    failing = {identifiers[2]}
+    expected = set(identifiers) - {identifiers[1], identifiers[2]}
+
+    # Interleave results for items with no MP3s
+    results = []
+    for i, result in enumerate(archive.search()):
+        results.append(result)
+        results.append({"identifier": f"no-mp3-{i}", "title": f"no-mp3-{i}", "format": ["Flac", "Metadata"], "item_size": 1000})
+
+    print(f"{'concurrency':>11} {'time (s)':>9} {'first (s)':>10} {'fetched':>8} {'requests':>9} {'slow item at':>13} {'correct':>8}")
+    with Mirror(archive, slow=slow, failing=failing, latency=args.latency) as mirror:
+        for concurrency in args.concurrency:
+            fetcher = ArchiveFetcher(base_url=mirror.url, concurrency=concurrency, timeout=(1.0, args.timeout))
+            requests_before = mirror.requests
+            start = time.perf_counter()
+            fetched, first = fetch_all(fetcher, results)
+            elapsed = time.perf_counter() - start
+            slow_position = fetched.index(identifiers[0]) if identifiers[0] in fetched else -1
+            correct = set(fetched) == expected and len(fetched) == len(expected)
+            print(f"{concurrency:>11} {elapsed:>9.3f} {first:>10.3f} {len(fetched):>8} {mirror.requests - requests_before:>9} "
+                  f"{slow_position:>13} {str(correct):>8}")
+    print()
+
+    cache_runs(archive, results, args.latency)
+    check_closed_stream_cached(archive, args.latency)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Load tests the archival page while CPU-bound generation work runs in the same
+    gunicorn-style gevent worker: inline, as generation used to, where it holds
+    the worker's loop for as long as it runs, against in a child process through
+    the job runner. The work is repeated VAD over synthetic audio, standing in
+    for a generation's decoding, detection and mixing, so no network is needed.
+    Page latency during a job in a child process must stay under a bound. Then
+    checks a job timing out kills the processes its child started too.
+
+Run from src/:
+    python -m benchmarks.load --seconds 5 --entries 1000
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+
+
+def burn(args, send):
+    """A CPU-bound job running VAD for args["seconds"]."""
+    import numpy as np
+    from vad import extract_voiced_sections
+
+    # Ten seconds of noise at 48kHz
+    pcm_data = (np.sin(np.arange(48000 * 10) / 7.0) * 8000).astype(np.int16).tobytes()
+    deadline = time.time() + args["seconds"]
+    passes = 0
+    while time.time() < deadline:
+        extract_voiced_sections(pcm_data, parallel_min_seconds=0)
+        passes += 1
+        send(progress=f"{passes} passes")
+    send(result={"passes": passes})
+
+
+def linger(args, send):
+    """A job that starts a process of its own, then outlives any timeout."""
+    child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(600)"])
+    send(result={"pid": child.pid})
+    time.sleep(600)
+
+
+def _alive(pid):
+    # Killed processes can linger as zombies until reaped
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def check_timeout_kills_children(env):
+    os.environ.update(env)
+    import jobs
+
+    jobs.JOB_TIMEOUT_SECONDS = 2
+    job = jobs.JobRunner().submit("benchmarks.load:linger")
+    job.wait()
+    assert job.status == "failed" and job.results, job.to_json()
+    pid = job.results[0]["pid"]
+    deadline = time.time() + 5
+    while _alive(pid) and time.time() < deadline:
+        time.sleep(0.1)
+    assert not _alive(pid), f"process {pid} started by a timed out job is still running"
+    print(f"job timed out with \"{job.error}\", and the process it started was killed")
+
+
+def serve(runner, seconds, delay):
+    # Patch before anything imports sockets, as gunicorn's gevent worker does
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent
+    from gevent.pywsgi import WSGIServer
+
+    import main
+
+    server = WSGIServer(("127.0.0.1", 0), main.app, log=None)
+    server.start()
+    print(json.dumps({"port": server.server_port}), flush=True)
+
+    def run_job():
+        if runner == "inline":
+            burn({"seconds": seconds}, lambda **message: None)
+        else:
+            main.job_runner.submit("benchmarks.load:burn", {"seconds": seconds}).wait()
+    gevent.spawn_later(delay, run_job)
+    server.serve_forever()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else float("nan")
+
+
+def run(runner, seconds, delay, rate, env):
+    server = subprocess.Popen([sys.executable, "-m", "benchmarks.load", "--serve", runner, "--seconds", str(seconds),
+                               "--delay", str(delay)], stdout=subprocess.PIPE, env=env)
+    try:
+        port = json.loads(server.stdout.readline())["port"]
+        url = f"http://127.0.0.1:{port}/"
+        start = time.perf_counter()
+
+        # Request the page at a steady rate through the job and a little after
+        latencies = []
+        while time.perf_counter() - start < delay + seconds + 1:
+            sent = time.perf_counter()
+            with urllib.request.urlopen(url) as response:
+                response.read()
+            latencies.append((sent - start, time.perf_counter() - sent))
+            time.sleep(max(0, 1 / rate - (time.perf_counter() - sent)))
+    finally:
+        server.kill()
+        server.wait()
+
+    idle = [latency for sent, latency in latencies if sent < delay]
+    busy = [latency for sent, latency in latencies if delay <= sent < delay + seconds]
+    for name, values in (("idle", idle), ("during job", busy)):
+        print(f"{runner:<8} {name:<11} {len(values):>9} {percentile(values, 50) * 1000:>9.1f} "
+              f"{percentile(values, 99) * 1000:>9.1f} {max(values) * 1000:>9.1f}")
+    return busy
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', default=5, type=float, help='Seconds the CPU-bound job runs for.')
+    parser.add_argument('--delay', default=2, type=float, help='Seconds to serve before starting the job.')
+    parser.add_argument('--rate', default=50, type=float, help='Requests per second.')
+    parser.add_argument('--entries', default=1000, type=int, help='Number of entries in the state.')
+    parser.add_argument('--max_latency_ms', default=250, type=float,
+                        help='Bound on p99 page latency during a job run in a child process.')
+    parser.add_argument('--serve', choices=("inline", "process"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.seconds, args.delay)
+        return
+
+    directory = tempfile.mkdtemp(prefix="archival-benchmark-load-")
+    try:
+        storage_dir = os.path.join(directory, "storage")
+        os.makedirs(storage_dir)
+        entries = [{"trendName": f"Trend {i}", "trendLocation": "Boston", "numTweets": i, "filename": f"{i}.mp3",
+                    "duration": 60.0, "timestamp": 1.6e9 + i} for i in range(args.entries)]
+        with open(os.path.join(storage_dir, "state.json"), "w") as f:
+            json.dump({"entries": entries}, f)
+
+        print(f"{'runner':<8} {'requests':<11} {'count':>9} {'p50 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}")
+        for runner in ("inline", "process"):
+            env = dict(os.environ, STORAGE_DIR=storage_dir, STATE_LOCAL_SNAPSHOT="", SHARED_STATE_DB="",
+                       GENERATION_LOCK="", SKIP_GENERATION="True", GENERATION_RUNNER=runner, LOG_LEVEL="WARNING")
+            busy = run(runner, args.seconds, args.delay, args.rate, env)
+            if runner == "process":
+                assert busy, "no requests were made during the job"
+                p99 = percentile(busy, 99) * 1000
+                assert p99 <= args.max_latency_ms, f"p99 page latency during the job was {p99:.1f}ms"
+        check_timeout_kills_children(env)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
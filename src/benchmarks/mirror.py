@@ -0,0 +1,108 @@
+"""A local HTTP stand-in for the Internet Archive's metadata and download
+    endpoints, serving a FakeArchive with simulated slow and failing mirrors.
+
+    mirror = Mirror(FakeArchive.synthetic(8), slow={"synthetic-0-1": 2.0}, failing={"synthetic-0-2"})
+    with mirror:
+        fetcher = ArchiveFetcher(base_url=mirror.url)
+"""
+import sys
+import json
+import time
+import hashlib
+import threading
+from urllib.parse import unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping connections, e.g. streams closed early, are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class Mirror:
+    """Serves /metadata/<identifier>, /metadata/<identifier>/files and
+        /download/<identifier>/<filename> on localhost.
+    Args:
+        archive (FakeArchive): Items to serve.
+        slow (dict): Seconds to stall before responding, keyed by identifier.
+        failing (set): Identifiers to respond to with a 503.
+        latency (float): Seconds to wait before every response.
+    """
+
+    def __init__(self, archive, slow=None, failing=None, latency=0.0):
+        self.archive = archive
+        self.slow = slow or {}
+        self.failing = failing or set()
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self.server = _Server(("127.0.0.1", 0), self._handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _handler(self):
+        mirror = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, status, body, content_type, headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                mirror.bytes_sent += len(body)
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up, e.g. after a timeout or once it had enough
+                    pass
+
+            def do_GET(self):
+                mirror.requests += 1
+                parts = [unquote(part) for part in self.path.strip("/").split("/")]
+                identifier = parts[1] if len(parts) > 1 else None
+                time.sleep(mirror.latency + mirror.slow.get(identifier, 0.0))
+
+                if identifier in mirror.failing:
+                    return self._respond(503, b"Service Unavailable", "text/plain")
+                data = mirror.archive.sources.get(identifier)
+                if data is None:
+                    return self._respond(404, b"Not Found", "text/plain")
+
+                files = [{"name": f"{identifier}.mp3", "size": str(len(data))}]
+                if parts[0] == "metadata" and parts[2:] == ["files"]:
+                    return self._respond(200, json.dumps({"result": files}).encode("utf-8"), "application/json")
+                if parts[0] == "metadata":
+                    metadata = {"metadata": {"identifier": identifier, "title": identifier}, "files": files}
+                    return self._respond(200, json.dumps(metadata).encode("utf-8"), "application/json")
+                if parts[0] == "download":
+                    # Files never change, so a matching ETag always revalidates
+                    etag = f"\"{hashlib.sha1(data).hexdigest()}\""
+                    if self.headers.get("If-None-Match") == etag:
+                        return self._respond(304, b"", "audio/mpeg", {"ETag": etag})
+                    return self._respond(200, data, "audio/mpeg", {"ETag": etag})
+                return self._respond(404, b"Not Found", "text/plain")
+
+        return Handler
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
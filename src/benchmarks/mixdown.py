@@ -0,0 +1,103 @@
+"""Benchmarks rendering a composition with pydub's normalize/fade/pan/overlay loop
+    against mixdown.render, and the peak memory of mixdown.render against the
+    streaming mixdown.render_blocks.
+
+Run from src/:
+    python -m benchmarks.mixdown --counts 10 25 50 100 200
+"""
+import time
+import tracemalloc
+import random
+import argparse
+import numpy as np
+from pydub import AudioSegment
+
+from audio import SAMPLE_RATE, Section
+from mixdown import RENDER_BLOCK_FRAMES, render, render_blocks, to_audio_segment
+
+
+def make_scheduled_segments(count, seed=0):
+    rng = random.Random(seed)
+    scheduled_segments = []
+    offset = 0
+    for _ in range(count):
+        length_ms = rng.choice([500, 1000, 1500, 3000, 5000])
+        t = np.arange(length_ms * SAMPLE_RATE // 1000) / SAMPLE_RATE
+        samples = (np.sin(2 * np.pi * rng.uniform(100, 1000) * t) * rng.uniform(1000, 8000)).astype(np.int16)
+        scheduled_segments.append({
+            "segment": Section(samples, 0, len(samples)),
+            "offset": offset,
+            "pan": rng.random()
+        })
+        # Keep segments apart so per-add clipping in the overlay loop doesn't skew the comparison
+        offset += length_ms + rng.random() * 500
+    composition_length = max(s["offset"] + len(s["segment"]) for s in scheduled_segments)
+    return scheduled_segments, composition_length
+
+
+def render_overlay(scheduled_segments, composition_length):
+    master = AudioSegment.silent(duration=composition_length, frame_rate=SAMPLE_RATE)
+    for scheduled_segment in scheduled_segments:
+        s = scheduled_segment["segment"].to_audio_segment().normalize().fade_in(10).fade_out(10)
+        s = s.pan(scheduled_segment["pan"])
+        master = master.overlay(s, position=scheduled_segment["offset"])
+    return master
+
+
+def peak_memory(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def consume(blocks):
+    for _ in blocks:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counts', nargs='+', type=int, default=[10, 25, 50, 100, 200], help='Numbers of scheduled segments to render.')
+    parser.add_argument('--skip_overlay', action='store_true', help='Only time mixdown.render.')
+    parser.add_argument('--block_frames', default=RENDER_BLOCK_FRAMES, type=int, help='Block size for mixdown.render_blocks.')
+    args = parser.parse_args()
+
+    print(f"{'segments':>8} {'overlay (s)':>12} {'render (s)':>12} {'speedup':>8} {'mean diff':>9}")
+    for count in args.counts:
+        scheduled_segments, composition_length = make_scheduled_segments(count)
+
+        start = time.perf_counter()
+        rendered = to_audio_segment(render(scheduled_segments, composition_length))
+        render_time = time.perf_counter() - start
+
+        if args.skip_overlay:
+            print(f"{count:>8} {'-':>12} {render_time:>12.3f} {'-':>8} {'-':>9}")
+            continue
+
+        start = time.perf_counter()
+        overlaid = render_overlay(scheduled_segments, composition_length)
+        overlay_time = time.perf_counter() - start
+
+        a = np.frombuffer(rendered.raw_data, dtype=np.int16).astype(np.int32)
+        b = np.frombuffer(overlaid.raw_data, dtype=np.int16).astype(np.int32)
+        n = min(len(a), len(b))
+        # Mean absolute difference in LSBs; render rounds once at the end rather
+        # than after every normalize, fade, pan and add
+        mean_diff = np.abs(a[:n] - b[:n]).mean()
+        print(f"{count:>8} {overlay_time:>12.3f} {render_time:>12.3f} {overlay_time / render_time:>7.1f}x {mean_diff:>9.2f}")
+
+    print()
+    print(f"{'segments':>8} {'render (s)':>12} {'peak (MB)':>10} {'blocks (s)':>12} {'peak (MB)':>10}")
+    for count in args.counts:
+        scheduled_segments, composition_length = make_scheduled_segments(count)
+        render_time, render_peak = peak_memory(lambda: render(scheduled_segments, composition_length))
+        blocks_time, blocks_peak = peak_memory(lambda: consume(render_blocks(scheduled_segments, composition_length, block_frames=args.block_frames)))
+        print(f"{count:>8} {render_time:>12.3f} {render_peak / 1e6:>10.1f} {blocks_time:>12.3f} {blocks_peak / 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Benchmarks serving the archival page from a state of many entries: rendering
+    it for every request, as before the page cache, against serving it from the
+    cache, and against a client revalidating its copy with If-None-Match. Then
+    checks an added entry changes the page.
+
+Run from src/:
+    python -m benchmarks.page --entries 10000 --requests 200
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', default=10000, type=int, help='Number of entries in the state.')
+    parser.add_argument('--requests', default=200, type=int, help='Requests to time per row.')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="archival-benchmark-page-")
+    try:
+        entries = [{"trendName": f"Trend {i}", "trendLocation": "Boston", "numTweets": i, "filename": f"{i}.mp3",
+                    "duration": 60.0, "timestamp": 1.6e9 + i} for i in range(args.entries)]
+        with open(os.path.join(directory, "state.json"), "w") as f:
+            json.dump({"entries": entries}, f)
+        os.environ.update({"STORAGE_DIR": directory, "STATE_LOCAL_SNAPSHOT": "", "SHARED_STATE_DB": "",
+                           "GENERATION_LOCK": "", "SKIP_GENERATION": "True", "LOG_LEVEL": "WARNING"})
+
+        import main as app_main
+        from state import state, ArchivalEntry
+        from page_cache import PageCache
+        client = app_main.app.test_client()
+
+        print(f"{'request':<26} {'ms/request':>11} {'status':>7} {'bytes':>10}")
+
+        def report(name, path, headers=None, before=None):
+            response = None
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                if before:
+                    before()
+                response = client.get(path, headers=headers)
+            elapsed = (time.perf_counter() - start) / args.requests
+            print(f"{name:<26} {elapsed * 1000:>11.3f} {response.status_code:>7} {len(response.data):>10}")
+            return response
+
+        def empty_cache():
+            app_main.page_cache = PageCache()
+
+        report("rendered", "/", before=empty_cache)
+        report("rendered, trend", "/?trend=Trend+42", before=empty_cache)
+        response = report("cached", "/")
+        report("cached, trend", "/?trend=Trend+42")
+        report("revalidated (304)", "/", headers={"If-None-Match": response.headers["ETag"]})
+
+        # A new entry changes the page, and its ETag
+        state.add_entry(ArchivalEntry("New Trend", "Boston", 1, "new.mp3", 60.0, time.time()))
+        updated = client.get("/", headers={"If-None-Match": response.headers["ETag"]})
+        assert updated.status_code == 200 and b"New Trend" in updated.data
+        assert updated.headers["ETag"] != response.headers["ETag"]
+        print(f"Cache-Control: {response.headers['Cache-Control']}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""Benchmarks each stage of the generation pipeline offline, using synthetic or
+    fixture audio, a fake Internet Archive and local storage in place of S3.
+
+Run from src/:
+    python -m benchmarks.pipeline --sources 2 4 8
+    python -m benchmarks.pipeline --fixtures path/to/mp3s --memory --profile
+"""
+import os
+import io
+import time
+import shutil
+import random
+import pstats
+import cProfile
+import argparse
+import tempfile
+import tracemalloc
+
+from audio import SAMPLE_RATE, convert_to_pcm, convert_to_pcm_ffmpeg, decode_to_samples, encode_mp3
+from vad import extract_voiced_sections
+from mixdown import render_blocks
+from storage import LocalStorage
+from archival import (SEGMENT_BUCKETS_MS, _enough_sections, _section_buckets, _to_section, generate_audio_for_search_results,
+                      ingest_stream, schedule)
+from library import SegmentLibrary
+from internet_archive import ArchiveFetcher
+from benchmarks.fakes import FakeArchive
+from benchmarks.mirror import Mirror
+
+
+class Stage:
+    """Times one pipeline stage, optionally tracking peak memory and profiling it."""
+
+    def __init__(self, name, memory=False, profile=False):
+        self.name = name
+        self.memory = memory
+        self.profiler = cProfile.Profile() if profile else None
+        self.seconds = 0.0
+        self.peak_bytes = None
+
+    def __enter__(self):
+        if self.memory:
+            tracemalloc.start()
+        if self.profiler:
+            self.profiler.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        if self.profiler:
+            self.profiler.disable()
+        if self.memory:
+            _, self.peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        return False
+
+    def profile_summary(self, limit=10):
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+
+def _ffmpeg_available():
+    return shutil.which("ffmpeg") is not None
+
+
+def run(archive, workdir, workers=0, memory=False, profile=False):
+    """Runs every stage over the archive's sources, returning (Stage, units, unit name) tuples."""
+    stages = []
+
+    def stage(name):
+        return Stage(name, memory=memory, profile=profile)
+
+    sources = list(archive.sources.items())
+
+    s = stage("decode (convert_to_pcm)")
+    with s:
+        for _, data in sources:
+            convert_to_pcm(data)
+
+    if _ffmpeg_available():
+        filenames = []
+        for identifier, data in sources:
+            filename = os.path.join(workdir, f"{identifier}.mp3")
+            with open(filename, "wb") as f:
+                f.write(data)
+            filenames.append(filename)
+        s_ffmpeg = stage("decode (convert_to_pcm_ffmpeg)")
+        with s_ffmpeg:
+            for filename in filenames:
+                convert_to_pcm_ffmpeg(filename)
+    else:
+        s_ffmpeg = None
+
+    s_shared = stage("decode (decode_to_samples)")
+    with s_shared:
+        decoded = [decode_to_samples(data) for _, data in sources]
+    audio_seconds = sum(len(samples) for samples in decoded) / SAMPLE_RATE
+    stages.append((s, audio_seconds, "audio s"))
+    if s_ffmpeg:
+        stages.append((s_ffmpeg, audio_seconds, "audio s"))
+    stages.append((s_shared, audio_seconds, "audio s"))
+
+    s = stage("extract_voiced_sections")
+    with s:
+        sections = [extract_voiced_sections(memoryview(samples).cast("B")) for samples in decoded]
+    stages.append((s, audio_seconds, "audio s"))
+    num_sections = sum(len(source_sections) for source_sections in sections)
+
+    # Stop each source at as many sections as generate_audio_for_search_results would use
+    s = stage("progressive ingest")
+    with s:
+        streamed = [ingest_stream(archive.stream(identifier, f"{identifier}.mp3"), lambda sections: _enough_sections(10.0, 15, sections))
+                    for identifier, _ in sources]
+    stages.append((s, sum(len(samples) for samples, _, _ in streamed) / SAMPLE_RATE, "audio s"))
+
+    s = stage("bucket assignment")
+    with s:
+        buckets = [_section_buckets(samples, source_sections) for samples, source_sections in zip(decoded, sections)]
+    stages.append((s, num_sections, "sections"))
+
+    # Use every section, to see how later stages scale with the segment count
+    audio_segments = {bucket_max: [] for bucket_max in SEGMENT_BUCKETS_MS}
+    for samples, source_sections, source_buckets in zip(decoded, sections, buckets):
+        source_audio_segments = {bucket_max: [] for bucket_max in SEGMENT_BUCKETS_MS}
+        for section, bucket in zip(source_sections, source_buckets):
+            source_audio_segments[bucket].append(_to_section(samples, section))
+        for bucket_max, source_bucket in source_audio_segments.items():
+            if source_bucket:
+                audio_segments[bucket_max].append(source_bucket)
+
+    s = stage("compose scheduling")
+    with s:
+        scheduled_segments, composition_length = schedule(audio_segments, rng=random.Random(0))
+    stages.append((s, len(scheduled_segments), "segments"))
+
+    s = stage("mixdown (render_blocks)")
+    with s:
+        for _ in render_blocks(scheduled_segments, composition_length):
+            pass
+    stages.append((s, len(scheduled_segments), "segments"))
+
+    composition_filename = os.path.join(workdir, "composition.mp3")
+    if _ffmpeg_available():
+        blocks = list(render_blocks(scheduled_segments, composition_length))
+        s = stage("export (encode_mp3)")
+        with s:
+            encode_mp3(iter(blocks), composition_filename)
+        stages.append((s, composition_length / 1000, "audio s"))
+
+        s = stage("upload (local storage)")
+        storage = LocalStorage(os.path.join(workdir, "bucket"))
+        with s:
+            storage.upload_file(composition_filename, "composition.mp3")
+        stages.append((s, os.path.getsize(composition_filename) / 1e6, "MB"))
+
+        # Fetch over HTTP from a local stand-in for the Internet Archive
+        with Mirror(archive, latency=archive.latency) as mirror:
+            fetcher = ArchiveFetcher(base_url=mirror.url)
+
+            s = stage("end to end")
+            with s:
+                generate_audio_for_search_results(os.path.join(workdir, "end_to_end"), archive.search(),
+                                                  fetcher=fetcher, library=False, workers=workers, seed=0, progressive=False)
+            stages.append((s, len(sources), "sources"))
+
+            s = stage("end to end (progressive)")
+            with s:
+                generate_audio_for_search_results(os.path.join(workdir, "end_to_end_progressive"), archive.search(),
+                                                  fetcher=fetcher, library=False, workers=workers, seed=0, progressive=True)
+            stages.append((s, len(sources), "sources"))
+
+            # Sources cut off once they had enough sections aren't kept in the library as if whole
+            library = SegmentLibrary(os.path.join(workdir, "library"), max_bytes=int(1e10))
+            generate_audio_for_search_results(os.path.join(workdir, "end_to_end_library"), archive.search(),
+                                              fetcher=fetcher, library=library, workers=workers, seed=0, progressive=True)
+            for (identifier, _), samples in zip(sources, decoded):
+                entry = library.get(identifier, f"{identifier}.mp3")
+                assert entry is None or len(entry.source) == len(samples), identifier
+
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', nargs='+', type=int, default=[2, 4, 8], help='Numbers of synthetic sources to benchmark with.')
+    parser.add_argument('--seconds', default=120, type=float, help='Length of each synthetic source.')
+    parser.add_argument('--fixtures', default=None, help='Directory of MP3s to use instead of synthetic sources.')
+    parser.add_argument('--workers', default=0, type=int, help='Ingestion workers for the end to end run.')
+    parser.add_argument('--memory', action='store_true', help='Track peak memory of each stage (slower).')
+    parser.add_argument('--profile', action='store_true', help='Print a cProfile summary of each stage.')
+    args = parser.parse_args()
+
+    if args.fixtures:
+        archives = [FakeArchive.from_directory(args.fixtures)]
+    else:
+        archives = [FakeArchive.synthetic(n, seconds=args.seconds) for n in args.sources]
+
+    if not _ffmpeg_available():
+        print("ffmpeg not found, skipping convert_to_pcm_ffmpeg, export, upload and end to end stages")
+
+    print(f"{'sources':>7} {'stage':<32} {'time (s)':>9} {'throughput':>22} {'peak (MB)':>10}")
+    for archive in archives:
+        workdir = tempfile.mkdtemp(prefix="archival-benchmark-")
+        try:
+            stages = run(archive, workdir, workers=args.workers, memory=args.memory, profile=args.profile)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        for s, units, unit_name in stages:
+            throughput = f"{units / s.seconds:,.1f} {unit_name}/s" if s.seconds else "-"
+            peak = f"{s.peak_bytes / 1e6:.1f}" if s.peak_bytes is not None else "-"
+            print(f"{len(archive.sources):>7} {s.name:<32} {s.seconds:>9.3f} {throughput:>22} {peak:>10}")
+            if args.profile:
+                print(s.profile_summary())
+        print()
+
+
+if __name__ == "__main__":
+    main()
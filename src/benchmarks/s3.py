@@ -0,0 +1,184 @@
+"""A local HTTP stand-in for the parts of the S3 API that S3Storage uses, with
+    simulated latency, per-connection bandwidth and failing upload parts.
+
+    s3 = S3StandIn(bandwidth=4e6, failing_parts={2})
+    with s3:
+        storage = S3Storage(endpoint_url=s3.url)
+"""
+import time
+import uuid
+import hashlib
+import threading
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler
+
+from benchmarks.mirror import _Server
+
+
+class S3StandIn:
+    """Serves objects, listings, conditional GETs and multipart uploads for any
+        bucket on localhost, keeping everything in memory.
+    Args:
+        latency (float): Seconds to wait before every response.
+        bandwidth (float): Bytes per second each connection can upload, or None for no limit.
+        failing_parts (set): Part numbers to respond to with a 500 the first time each is uploaded.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, failing_parts=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failing_parts = set(failing_parts or ())
+        self.objects = {}
+        self.uploads = {}
+        self.requests = 0
+        self.failed_parts = 0
+        self.lock = threading.Lock()
+        self.server = _Server(("127.0.0.1", 0), type("Handler", (_Handler,), {"stand_in": self}))
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _etag(data):
+    return f"\"{hashlib.md5(data).hexdigest()}\""
+
+
+def _xml(root, **fields):
+    body = "".join(f"<{name}>{escape(str(value))}</{name}>" for name, value in fields.items())
+    return f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><{root}>{body}</{root}>".encode("utf-8")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    stand_in = None
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body=b"", content_type="application/xml", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        self._respond(status, _xml("Error", Code=code, Message=code))
+
+    def _parse(self):
+        self.stand_in.requests += 1
+        time.sleep(self.stand_in.latency)
+        url = urlsplit(self.path)
+        bucket, _, key = url.path.lstrip("/").partition("/")
+        return unquote(key), {name: values[0] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b"\r\n", b""):
+                        pass
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+            body = bytes(body)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.stand_in.bandwidth:
+            time.sleep(len(body) / self.stand_in.bandwidth)
+        if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+            body = _decode_aws_chunked(body)
+        return body
+
+    def do_GET(self):
+        key, query = self._parse()
+        if not key and query.get("list-type") == "2":
+            prefix = query.get("prefix", "")
+            keys = sorted(k for k in self.stand_in.objects if k.startswith(prefix))
+            contents = "".join(f"<Contents><Key>{escape(k)}</Key><Size>{len(self.stand_in.objects[k])}</Size></Contents>" for k in keys)
+            body = ("<?xml version=\"1.0\" encoding=\"UTF-8\"?><ListBucketResult>"
+                    f"<Prefix>{escape(prefix)}</Prefix><KeyCount>{len(keys)}</KeyCount><IsTruncated>false</IsTruncated>"
+                    f"{contents}</ListBucketResult>").encode("utf-8")
+            return self._respond(200, body)
+
+        data = self.stand_in.objects.get(key)
+        if data is None:
+            return self._error(404, "NoSuchKey")
+        etag = _etag(data)
+        if self.headers.get("If-None-Match") == etag:
+            return self._respond(304, headers={"ETag": etag})
+        self._respond(200, data, "application/octet-stream", {"ETag": etag})
+
+    def do_PUT(self):
+        key, query = self._parse()
+        body = self._read_body()
+        if "uploadId" in query:
+            number = int(query["partNumber"])
+            with self.stand_in.lock:
+                if number in self.stand_in.failing_parts:
+                    self.stand_in.failing_parts.discard(number)
+                    self.stand_in.failed_parts += 1
+                    return self._error(500, "InternalError")
+                parts = self.stand_in.uploads.get(query["uploadId"])
+                if parts is None:
+                    return self._error(404, "NoSuchUpload")
+                parts[number] = body
+            return self._respond(200, headers={"ETag": _etag(body)})
+
+        self.stand_in.objects[key] = body
+        self._respond(200, headers={"ETag": _etag(body)})
+
+    def do_POST(self):
+        key, query = self._parse()
+        body = self._read_body()
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.stand_in.uploads[upload_id] = {}
+            return self._respond(200, _xml("InitiateMultipartUploadResult", Key=key, UploadId=upload_id))
+
+        parts = self.stand_in.uploads.pop(query.get("uploadId"), None)
+        if parts is None:
+            return self._error(404, "NoSuchUpload")
+        numbers = [int(e.text) for e in ElementTree.fromstring(body).iter() if e.tag.endswith("PartNumber")]
+        data = b"".join(parts[number] for number in numbers)
+        self.stand_in.objects[key] = data
+        self._respond(200, _xml("CompleteMultipartUploadResult", Key=key, ETag=_etag(data)))
+
+    def do_DELETE(self):
+        key, query = self._parse()
+        if "uploadId" in query:
+            self.stand_in.uploads.pop(query["uploadId"], None)
+        else:
+            self.stand_in.objects.pop(key, None)
+        self._respond(204)
+
+
+def _decode_aws_chunked(body):
+    # <hex size>[;chunk-signature=...]\r\n<data>\r\n ... 0\r\n<trailers>\r\n\r\n
+    data = bytearray()
+    position = 0
+    while True:
+        line_end = body.index(b"\r\n", position)
+        size = int(body[position:line_end].split(b";")[0], 16)
+        if size == 0:
+            return bytes(data)
+        data += body[line_end + 2:line_end + 2 + size]
+        position = line_end + 2 + size + 2
@@ -0,0 +1,157 @@
+"""Benchmarks adding entries to the archival state in local storage, comparing
+    rewriting the whole snapshot on every entry with appending each entry to a
+    log that is compacted periodically, and checks that reloading the state
+    gives back the same entries in both cases, and when a compaction overlaps
+    the reload. Then compares the request path's original linear trend and most
+    recent lookups with the state's indexes.
+
+Run from src/:
+    python -m benchmarks.state --entries 2000
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from operator import attrgetter
+
+# state loads from storage on import, so point it somewhere empty first
+os.environ.setdefault("STORAGE_DIR", tempfile.mkdtemp(prefix="archival-benchmark-state-"))
+with open(os.path.join(os.environ["STORAGE_DIR"], os.environ.get("STATE_FILENAME", "state.json")), "w") as f:
+    json.dump({"entries": []}, f)
+
+import state as state_module
+from state import ArchivalEntry, ArchivalState, _get_state
+from storage import LocalStorage
+
+
+def make_entry(i):
+    return ArchivalEntry(f"Trend {i}", "Boston", 1000 + i, f"audio/{i}.mp3", 600.0, 1.6e9 + i)
+
+
+def add_entries(mode, storage, num_entries):
+    """Adds entries one at a time, returning the per-entry write times and the bytes written."""
+    state_module.STATE_PERSISTENCE = mode
+    archival_state = ArchivalState(storage=storage)
+    storage.put_bytes(json.dumps(archival_state.to_json()).encode("utf-8"), state_module.STATE_FILENAME)
+
+    times = []
+    bytes_written = 0
+    put_bytes = storage.put_bytes
+
+    def counting_put_bytes(b, key, **kwargs):
+        nonlocal bytes_written
+        bytes_written += len(b)
+        put_bytes(b, key, **kwargs)
+
+    storage.put_bytes = counting_put_bytes
+    try:
+        for i in range(num_entries):
+            start = time.perf_counter()
+            archival_state.add_entry(make_entry(i))
+            times.append(time.perf_counter() - start)
+    finally:
+        storage.put_bytes = put_bytes
+    return archival_state, times, bytes_written
+
+
+def check_overlapping_compaction(archival_state, storage, num_entries):
+    """Checks a reload overlapping a compaction by another process still gives back
+        every entry, with the compaction run just after each of the reload's storage reads.
+    """
+    for method in ("list_keys", "get_bytes_if_changed"):
+        for i in range(num_entries):
+            archival_state.add_entry(make_entry(100000 + i))
+        assert storage.list_keys(state_module.STATE_LOG_PREFIX)
+        read = getattr(storage, method)
+
+        def read_then_compact(*args, **kwargs):
+            setattr(storage, method, read)
+            result = read(*args, **kwargs)
+            state_module._update_state(archival_state)
+            return result
+
+        setattr(storage, method, read_then_compact)
+        try:
+            reloaded = _get_state(storage)
+        finally:
+            setattr(storage, method, read)
+        assert [e.to_json() for e in reloaded.entries] == [e.to_json() for e in archival_state.entries], method
+
+
+def benchmark_lookups(num_entries, num_lookups=200):
+    tracemalloc.start()
+    entries = [make_entry(i) for i in range(num_entries)]
+    entries_memory, _ = tracemalloc.get_traced_memory()
+    archival_state = ArchivalState(entries)
+    indexes_memory = tracemalloc.get_traced_memory()[0] - entries_memory
+    tracemalloc.stop()
+
+    trend_names = [f"TREND {i * num_entries // num_lookups}" for i in range(num_lookups)]
+
+    def original():
+        # As the / route did, filtering and taking the max over every entry
+        for trend_name in trend_names:
+            matches = list(filter(lambda e: e.trend_name.lower() == trend_name.lower(), archival_state.entries))
+            max(archival_state.entries, default=None, key=attrgetter("timestamp"))
+            yield matches[0] if matches else None
+
+    def indexed():
+        for trend_name in trend_names:
+            archival_state.most_recent()
+            yield archival_state.get_by_trend(trend_name)
+
+    print(f"{num_entries} entries, {entries_memory / num_entries:.0f} bytes/entry in memory "
+          f"and {indexes_memory / num_entries:.0f} bytes/entry of indexes")
+    print(f"{'lookup':<10} {'ms/request':>11}")
+    results = {}
+    for name, fn in (("original", original), ("indexed", indexed)):
+        start = time.perf_counter()
+        results[name] = list(fn())
+        print(f"{name:<10} {1000 * (time.perf_counter() - start) / num_lookups:>11.4f}")
+    assert results["original"] == results["indexed"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', default=2000, type=int, help='Number of entries to add.')
+    parser.add_argument('--compact_every', default=state_module.STATE_COMPACT_EVERY, type=int,
+                        help='Log entries between compactions.')
+    parser.add_argument('--lookup_entries', default=100000, type=int, help='Number of entries to look up from.')
+    args = parser.parse_args()
+    state_module.STATE_COMPACT_EVERY = args.compact_every
+
+    print(f"{'mode':<10} {'total (s)':>10} {'last 100 (ms/entry)':>20} {'bytes/entry':>12} {'reload':>8}")
+    for mode in ("snapshot", "log"):
+        directory = tempfile.mkdtemp(prefix="archival-benchmark-state-")
+        try:
+            storage = LocalStorage(directory)
+            archival_state, times, bytes_written = add_entries(mode, storage, args.entries)
+
+            # Reload from storage, as a restarted process would
+            reloaded = _get_state(storage)
+            matches = [e.to_json() for e in reloaded.entries] == [e.to_json() for e in archival_state.entries]
+            tail = times[-100:]
+            print(f"{mode:<10} {sum(times):>10.3f} {1000 * sum(tail) / len(tail):>20.3f} "
+                  f"{bytes_written / args.entries:>12.0f} {'ok' if matches else 'MISMATCH':>8}")
+
+            if mode == "log":
+                # A log tail with no compaction since, then a compaction, still reload identically
+                for i in range(args.entries, args.entries + args.compact_every // 2):
+                    archival_state.add_entry(make_entry(i))
+                assert [e.to_json() for e in _get_state(storage).entries] == [e.to_json() for e in archival_state.entries]
+                state_module._update_state(archival_state)
+                assert not storage.list_keys(state_module.STATE_LOG_PREFIX)
+                assert [e.to_json() for e in _get_state(storage).entries] == [e.to_json() for e in archival_state.entries]
+                check_overlapping_compaction(archival_state, storage, args.compact_every // 2)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    print()
+    benchmark_lookups(args.lookup_entries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Benchmarks trend lookups offline with fixture trends and simulated request
+    latency, comparing the original per-run lookup, which lists every location
+    to resolve each name, with TrendService cold and warm.
+
+Run from src/:
+    python -m benchmarks.trends --latency 0.2
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from trends import FixtureTrendProvider, RateLimiter, TrendService
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "trends.json")
+
+
+class SlowProvider:
+    """Wraps a provider, sleeping before each request and counting them."""
+
+    def __init__(self, provider, latency):
+        self.provider = provider
+        self.latency = latency
+        self.requests = 0
+
+    def available_locations(self):
+        self.requests += 1
+        time.sleep(self.latency)
+        return self.provider.available_locations()
+
+    def trends(self, woeid):
+        self.requests += 1
+        time.sleep(self.latency)
+        return self.provider.trends(woeid)
+
+
+def original_lookup(provider, location_names):
+    # As get_trends_by_location_name did, listing every location for each name
+    trends_by_location = {}
+    for location_name in location_names:
+        locations = [l for l in provider.available_locations() if l["name"].lower() == location_name.lower()]
+        trends_by_location[location_name] = provider.trends(locations[0]["woeid"]) if len(locations) == 1 else None
+    return trends_by_location
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixtures', default=FIXTURES, help='JSON file of fixture locations and trends.')
+    parser.add_argument('--latency', default=0.2, type=float, help='Seconds each provider request takes.')
+    args = parser.parse_args()
+
+    provider = SlowProvider(FixtureTrendProvider(args.fixtures), args.latency)
+    location_names = [location["name"] for location in provider.available_locations()]
+    provider.requests = 0
+
+    print(f"{'lookup':<24} {'time (s)':>9} {'requests':>9} {'locations':>10}")
+
+    def report(name, fn):
+        requests = provider.requests
+        start = time.perf_counter()
+        trends_by_location = fn()
+        elapsed = time.perf_counter() - start
+        found = sum(1 for trends in trends_by_location.values() if trends)
+        print(f"{name:<24} {elapsed:>9.3f} {provider.requests - requests:>9} {found:>10}")
+
+    report("original", lambda: original_lookup(provider, location_names))
+
+    cache_dir = tempfile.mkdtemp(prefix="archival-benchmark-trends-")
+    try:
+        service = TrendService(provider, cache_dir=cache_dir, rate_limiter=RateLimiter(75, 15 * 60))
+        report("service (cold)", lambda: service.get_trends_for_locations(location_names))
+        report("service (warm)", lambda: service.get_trends_for_locations(location_names))
+
+        # A restart keeps the WOEID index and trend lists on disk
+        restarted = TrendService(provider, cache_dir=cache_dir)
+        report("service (restarted)", lambda: restarted.get_trends_for_locations(location_names))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
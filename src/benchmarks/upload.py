@@ -0,0 +1,102 @@
+"""Benchmarks time-to-published for a composition against a local S3 stand-in
+    with limited per-connection bandwidth: encoding to a file then uploading it
+    in a single put, as generation used to, against streaming the encoder's
+    output as concurrent multipart parts, then again with a part failing once to
+    exercise retries. Then checks the encoder's failures, and its input's, are
+    raised rather than hidden.
+
+Run from src/:
+    python -m benchmarks.upload --seconds 600 --bandwidth 2e6
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+from audio import SAMPLE_RATE, MP3Stream, decode_to_samples, encode_mp3
+from storage import S3Storage
+from benchmarks.s3 import S3StandIn
+
+
+def blocks(seconds, block_frames=SAMPLE_RATE):
+    # A slowly sweeping stereo tone
+    for start in range(0, int(seconds * SAMPLE_RATE), block_frames):
+        t = np.arange(start, start + block_frames) / SAMPLE_RATE
+        left = np.sin(2 * np.pi * (220 + 20 * np.sin(t / 7)) * t)
+        right = np.sin(2 * np.pi * (330 + 30 * np.sin(t / 11)) * t)
+        yield (np.stack([left, right], axis=1) * 8000).astype(np.int16)
+
+
+def check_encode_failures(workdir):
+    # ffmpeg unable to open its output exits early, while blocks are still being written to it
+    try:
+        encode_mp3(blocks(60), os.path.join(workdir, "missing", "composition.mp3"))
+        raise AssertionError("encode_mp3 didn't raise")
+    except subprocess.CalledProcessError as e:
+        assert e.returncode != 0
+        print(f"encoder exiting early raises CalledProcessError, exit code {e.returncode}")
+
+    def failing_blocks():
+        yield from blocks(5)
+        raise ValueError("mixdown failed")
+
+    start = time.perf_counter()
+    try:
+        encode_mp3(failing_blocks(), os.path.join(workdir, "failed.mp3"))
+        raise AssertionError("encode_mp3 didn't raise")
+    except ValueError as e:
+        print(f"failing blocks raise their own error \"{e}\" after {time.perf_counter() - start:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', default=600, type=float, help='Length of the composition.')
+    parser.add_argument('--bandwidth', default=2e6, type=float, help='Bytes per second each connection can upload.')
+    parser.add_argument('--latency', default=0.05, type=float, help='Seconds each S3 request takes to respond.')
+    parser.add_argument('--part_size', default=5 * 1024 * 1024, type=int, help='Bytes per part.')
+    parser.add_argument('--concurrency', default=4, type=int, help='Parts to upload at once.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="archival-benchmark-upload-")
+    try:
+        with S3StandIn(latency=args.latency, bandwidth=args.bandwidth) as s3:
+            storage = S3Storage(endpoint_url=s3.url, part_size=args.part_size, concurrency=args.concurrency)
+            print(f"{'upload':<24} {'published (s)':>14} {'MB':>6} {'requests':>9} {'retried parts':>14}")
+
+            def report(name, key, fn):
+                requests, failed_parts = s3.requests, s3.failed_parts
+                start = time.perf_counter()
+                fn()
+                elapsed = time.perf_counter() - start
+                size = len(s3.objects[key]) / 1e6
+                print(f"{name:<24} {elapsed:>14.2f} {size:>6.1f} {s3.requests - requests:>9} {s3.failed_parts - failed_parts:>14}")
+
+            def file_then_put():
+                filename = os.path.join(workdir, "composition.mp3")
+                encode_mp3(blocks(args.seconds), filename)
+                with open(filename, "rb") as f:
+                    storage.put_bytes(f.read(), "file.mp3", ACL="public-read")
+                os.remove(filename)
+
+            report("file then put", "file.mp3", file_then_put)
+            report("streamed multipart", "streamed.mp3",
+                   lambda: storage.upload_stream(MP3Stream(blocks(args.seconds)), "streamed.mp3", ACL="public-read"))
+            s3.failing_parts = {1}
+            report("streamed, part 1 failing", "retried.mp3",
+                   lambda: storage.upload_stream(MP3Stream(blocks(args.seconds)), "retried.mp3", ACL="public-read"))
+            assert s3.objects["retried.mp3"] == s3.objects["streamed.mp3"]
+
+            # A streamed MP3 lacks the header giving the encoder delay, so decodes one frame longer
+            lengths = [len(decode_to_samples(s3.objects[key])) for key in ("file.mp3", "streamed.mp3")]
+            assert abs(lengths[0] - lengths[1]) <= 1152, lengths
+        check_encode_failures(workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Benchmarks VAD over long synthetic recordings, comparing each mode's speed
+    and agreement on section boundaries with the original 48kHz frame list path.
+The parallel mode splits recordings into chunks of --chunk_seconds. Its
+    per-frame decisions and sections are also checked to be the same as a
+    sequential pass's, in every mode.
+
+Run from src/:
+    python -m benchmarks.vad --minutes 10 60
+"""
+import time
+import bisect
+import argparse
+import tracemalloc
+import webrtcvad
+
+from vad import (VAD_MODE, extract_voiced_sections, extract_voiced_sections_parallel, frame_generator, parallel_speech_flags,
+                 speech_flags, vad_collector)
+from benchmarks.fakes import synthetic_speech
+
+
+def frame_list_sections(pcm_data):
+    # The original path, materializing every Frame up front
+    frames = list(frame_generator(30, pcm_data, 48000))
+    return vad_collector(48000, 30, 300, frames, detector=webrtcvad.Vad(VAD_MODE))
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def modes(energy_threshold, chunk_seconds, workers):
+    return [
+        ("frame list", frame_list_sections),
+        ("streaming", lambda pcm_data: extract_voiced_sections(pcm_data, 48000, 0, parallel_min_seconds=0)),
+        ("16kHz", lambda pcm_data: extract_voiced_sections(pcm_data, 16000, 0, parallel_min_seconds=0)),
+        ("energy gate", lambda pcm_data: extract_voiced_sections(pcm_data, 48000, energy_threshold, parallel_min_seconds=0)),
+        ("16kHz + energy gate", lambda pcm_data: extract_voiced_sections(pcm_data, 16000, energy_threshold, parallel_min_seconds=0)),
+        ("parallel", lambda pcm_data: extract_voiced_sections_parallel(pcm_data, 48000, 0, chunk_seconds=chunk_seconds, workers=workers)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--minutes', nargs='+', type=float, default=[10, 60], help='Lengths of synthetic recordings to run VAD on.')
+    parser.add_argument('--tolerance', default=0.15, type=float, help='Seconds section boundaries may differ by and still agree.')
+    parser.add_argument('--energy_threshold', default=100, type=float, help='RMS threshold for the energy gate modes.')
+    parser.add_argument('--chunk_seconds', default=600, type=float, help='Length of the chunks for the parallel mode.')
+    parser.add_argument('--workers', default=None, type=int, help='Number of processes for the parallel mode, defaults to one per CPU.')
+    args = parser.parse_args()
+
+    print(f"{'minutes':>7} {'mode':<24} {'time (s)':>9} {'peak (MB)':>10} {'sections':>9} {'agreement':>10}")
+    for minutes in args.minutes:
+        samples = synthetic_speech(minutes * 60)
+        pcm_data = memoryview(samples).cast("B")
+        reference = None
+        for name, fn in modes(args.energy_threshold, args.chunk_seconds, args.workers):
+            sections, elapsed, peak = measure(fn, pcm_data)
+            if reference is None:
+                reference = sections
+            print(f"{minutes:>7g} {name:<24} {elapsed:>9.3f} {peak / 1e6:>10.1f} {len(sections):>9} {agreement(reference, sections, args.tolerance):>10.1%}")
+        check_parallel(pcm_data, args)
+
+
+def check_parallel(pcm_data, args):
+    for analysis_rate, energy_threshold in ((48000, 0), (16000, 0), (8000, 0), (48000, args.energy_threshold),
+                                            (16000, args.energy_threshold)):
+        sequential_flags = speech_flags(pcm_data, analysis_rate, energy_threshold)
+        parallel_flags = b"".join(parallel_speech_flags(pcm_data, analysis_rate, energy_threshold,
+                                                        chunk_seconds=args.chunk_seconds, workers=args.workers))
+        assert parallel_flags == sequential_flags, (analysis_rate, energy_threshold)
+
+        sequential = extract_voiced_sections(pcm_data, analysis_rate, energy_threshold, parallel_min_seconds=0)
+        parallel = extract_voiced_sections_parallel(pcm_data, analysis_rate, energy_threshold,
+                                                    chunk_seconds=args.chunk_seconds, workers=args.workers)
+        assert parallel == sequential, (analysis_rate, energy_threshold)
+    print(f"parallel vs sequential: same decisions for all {len(sequential_flags)} frames, "
+          f"same {len(sequential)} sections, in every mode")
+
+
+def agreement(reference, sections, tolerance):
+    """Fraction of reference sections with a matching section within tolerance seconds at both ends."""
+    if not reference:
+        return 1.0 if not sections else 0.0
+    starts = [s for s, _ in sections]
+    matched = 0
+    for start, end in reference:
+        lo = bisect.bisect_left(starts, start - tolerance)
+        hi = bisect.bisect_right(starts, start + tolerance)
+        if any(abs(end - e) <= tolerance for _, e in sections[lo:hi]):
+            matched += 1
+    return matched / len(reference)
+
+
+if __name__ == "__main__":
+    main()
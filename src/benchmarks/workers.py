@@ -0,0 +1,173 @@
+"""Simulates several gunicorn workers on one machine, each loading the state and
+    trying to generate, with local storage standing in for S3. Without
+    coordination, every worker loads the state from storage and generates, and
+    each only sees its own new entries. With coordination, one worker holds the
+    generation lock, the rest load from the shared store once the local snapshot
+    shows it holds the current state, and every worker sees each new entry
+    within the sync interval. Then checks workers whose shared store nobody
+    adds to still pick up entries added elsewhere, by reloading from storage.
+
+Run from src/:
+    python -m benchmarks.workers --workers 4 --entries 5
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from uuid import uuid4
+
+
+STORAGE_METHODS = ("get_bytes", "get_bytes_if_exists", "get_bytes_if_changed", "list_keys", "put_bytes", "delete")
+
+
+def worker(num_entries, interval, results):
+    import storage
+
+    # Count storage requests
+    counts = {"reads": 0, "writes": 0}
+
+    def counted(fn, kind):
+        def wrapper(*args, **kwargs):
+            counts[kind] += 1
+            return fn(*args, **kwargs)
+        return wrapper
+
+    for name in STORAGE_METHODS:
+        kind = "writes" if name in ("put_bytes", "delete") else "reads"
+        setattr(storage.LocalStorage, name, counted(getattr(storage.LocalStorage, name), kind))
+
+    from state import state, refresh_state, ArchivalEntry
+    from coordination import LeaderLock
+
+    # Held until the worker exits
+    lock_filename = os.environ.get("GENERATION_LOCK")
+    lock = LeaderLock(lock_filename) if lock_filename else None
+    leader = lock.try_acquire() if lock else True
+    if leader and state.shared:
+        refresh_state(state)
+
+    # The leader adds entries, which every worker waits to see
+    initial = len(state.entries)
+    seen_at = []
+    deadline = time.time() + num_entries * interval + 10
+    while len(seen_at) < num_entries and time.time() < deadline:
+        if leader and len(seen_at) < num_entries and (not seen_at or time.time() - seen_at[-1][1] >= interval):
+            state.add_entry(ArchivalEntry(f"Trend {os.getpid()}-{len(seen_at)}", "Boston", 1, f"{os.getpid()}-{len(seen_at)}.mp3",
+                                          60.0, time.time()))
+        while len(state.entries) - initial > len(seen_at):
+            entry = state.entries[initial + len(seen_at)]
+            seen_at.append((entry.timestamp, time.time()))
+        if not leader and not state.shared:
+            # Nothing will ever arrive
+            break
+        time.sleep(0.01)
+
+    delays = [seen - added for added, seen in seen_at]
+    results.put({"leader": leader, "entries": len(state.entries), "seen": len(seen_at),
+                 "delay": max(delays) if delays else None, **counts})
+
+
+def follower(results):
+    from state import state
+
+    # Wait for an entry this machine never adds to the shared store
+    initial = len(state.entries)
+    deadline = time.time() + 30
+    while len(state.entries) == initial and time.time() < deadline:
+        time.sleep(0.01)
+    results.put({"seen": len(state.entries) > initial, "at": time.time()})
+
+
+def check_unseeded_followers(workers):
+    directory = tempfile.mkdtemp(prefix="archival-benchmark-workers-")
+    try:
+        storage_dir = os.path.join(directory, "storage")
+        os.makedirs(os.path.join(storage_dir, "state-log"))
+        with open(os.path.join(storage_dir, "state.json"), "w") as f:
+            json.dump({"entries": []}, f)
+        os.environ.update({"STORAGE_DIR": storage_dir, "STATE_LOCAL_SNAPSHOT": "", "STATE_SYNC_SECONDS": "0.1",
+                           "STATE_REFRESH_SECONDS": "1.0", "SHARED_STATE_DB": os.path.join(directory, "state.sqlite3"),
+                           "GENERATION_LOCK": ""})
+
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        processes = [context.Process(target=follower, args=(results,)) for _ in range(workers)]
+        for process in processes:
+            process.start()
+        time.sleep(3.0)
+
+        # As the leader on another machine appends to the log
+        added = time.time()
+        entry = {"trendName": "Elsewhere", "trendLocation": "Boston", "numTweets": 1, "filename": "elsewhere.mp3",
+                 "duration": 60.0, "timestamp": added}
+        with open(os.path.join(storage_dir, "state-log", f"{time.time_ns():020d}-{uuid4().hex}.json"), "w") as f:
+            json.dump(entry, f)
+        reports = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        assert all(r["seen"] for r in reports), reports
+        print(f"unseeded store: {workers} workers saw an entry added elsewhere within "
+              f"{max(r['at'] for r in reports) - added:.2f}s")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run(name, workers, num_entries, interval, env):
+    directory = tempfile.mkdtemp(prefix="archival-benchmark-workers-")
+    try:
+        storage_dir = os.path.join(directory, "storage")
+        os.makedirs(storage_dir)
+        entries = [{"trendName": f"Trend {i}", "trendLocation": "Boston", "numTweets": i, "filename": f"{i}.mp3",
+                    "duration": 60.0, "timestamp": 1.6e9 + i} for i in range(1000)]
+        with open(os.path.join(storage_dir, "state.json"), "w") as f:
+            json.dump({"entries": entries}, f)
+
+        os.environ.update({"STORAGE_DIR": storage_dir, "STATE_LOCAL_SNAPSHOT": "", "STATE_SYNC_SECONDS": "0.1"})
+        os.environ.update({key: value.format(directory=directory) for key, value in env.items()})
+
+        # A fresh interpreter per worker, like gunicorn's
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        processes = []
+        for i in range(workers):
+            process = context.Process(target=worker, args=(num_entries, interval, results))
+            process.start()
+            processes.append(process)
+            if i == 0:
+                # Let the first worker load the state, as gunicorn's workers start staggered
+                time.sleep(1.0)
+        reports = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        leaders = sum(1 for r in reports if r["leader"])
+        delays = [r["delay"] for r in reports if r["delay"] is not None and not r["leader"]]
+        entry_counts = sorted(set(r["entries"] for r in reports))
+        print(f"{name:<14} {leaders:>8} {'/'.join(str(c) for c in entry_counts):>14} "
+              f"{sum(r['reads'] for r in reports):>13} {sum(r['writes'] for r in reports):>14} "
+              f"{(max(delays) if delays else float('nan')):>15.3f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default=4, type=int, help='Number of workers.')
+    parser.add_argument('--entries', default=5, type=int, help='Number of entries each generating worker adds.')
+    parser.add_argument('--interval', default=0.5, type=float, help='Seconds between added entries.')
+    args = parser.parse_args()
+
+    print(f"{'mode':<14} {'leaders':>8} {'entries seen':>14} {'storage reads':>13} {'storage writes':>14} {'max delay (s)':>15}")
+    run("uncoordinated", args.workers, args.entries, args.interval, {"SHARED_STATE_DB": "", "GENERATION_LOCK": ""})
+    run("coordinated", args.workers, args.entries, args.interval,
+        {"SHARED_STATE_DB": "{directory}/state.sqlite3", "GENERATION_LOCK": "{directory}/generation.lock",
+         "STATE_LOCAL_SNAPSHOT": "{directory}/state_snapshot.json"})
+    check_unseeded_followers(args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import os
+import json
+import fcntl
+import logging
+import sqlite3
+import threading
+
+from constants import FLASK_NAME
+
+
+logger = logging.getLogger(FLASK_NAME)
+
+
+class LeaderLock(object):
+    """An exclusive lock on a file, held by at most one process on the machine.
+        The operating system releases it when the holder exits, however it exits,
+        so another process can take over by trying again.
+    Args:
+        filename (str): File to lock, created if it doesn't exist.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+
+    @property
+    def held(self):
+        return self.file is not None
+
+    def try_acquire(self):
+        """Takes the lock without waiting, returning whether this process holds it."""
+        if self.file:
+            return True
+        f = open(self.filename, "a+")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+
+        # Note the holder for anyone looking
+        f.seek(0)
+        f.truncate()
+        f.write(f"{os.getpid()}\n")
+        f.flush()
+        self.file = f
+        return True
+
+    def release(self):
+        if self.file:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+
+class SharedEntryStore(object):
+    """Entries shared by the processes on a machine through a SQLite file, so that
+        an entry added by one is seen by the others without any of them
+        downloading the state again. Entries are kept as JSON in the order they
+        were added, and an entry added twice is only kept once.
+    The store notes the ETag of the last state loaded into it from storage, so a
+        file left from an earlier run is only trusted if it matches the state a
+        process would otherwise start from.
+    Args:
+        filename (str): SQLite database file, created if it doesn't exist.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+        # One connection, so its data_version notices commits from other processes
+        self.connection = sqlite3.connect(filename, timeout=30, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            # Readers don't block the writer, or each other
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                    "entry TEXT NOT NULL UNIQUE)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            self.data_version = None
+
+    def seeded_etag(self):
+        """Returns the ETag of the last state loaded into the store, or None if none has been."""
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE name = 'etag'").fetchone()
+        return row[0] if row else None
+
+    def mark_seeded(self, etag):
+        """Notes that the state with an ETag has been loaded into the store."""
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('etag', ?)", (etag,))
+
+    def add_entries(self, entries):
+        """Adds entry JSON dicts in order in one transaction, skipping those already present."""
+        if not entries:
+            return
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany("INSERT OR IGNORE INTO entries (entry) VALUES (?)",
+                                            [(json.dumps(entry, sort_keys=True),) for entry in entries])
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def entries_after(self, row_id):
+        """Returns a list of (id, entry JSON dict) for entries added after row_id, in order."""
+        with self.lock:
+            rows = self.connection.execute("SELECT id, entry FROM entries WHERE id > ? ORDER BY id", (row_id,)).fetchall()
+        return [(row_id, json.loads(entry)) for row_id, entry in rows]
+
+    def changed(self):
+        """Whether anything has been committed since last asked, a cheap check to poll."""
+        with self.lock:
+            data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        changed = data_version != self.data_version
+        self.data_version = data_version
+        return changed
@@ -0,0 +1,99 @@
+import numpy as np
+
+from audio import SAMPLE_RATE
+
+
+# Matches pydub's AudioSegment.normalize() default headroom
+NORMALIZE_HEADROOM_DB = 0.1
+NORMALIZE_TARGET_PEAK = 32768 * (10 ** (-NORMALIZE_HEADROOM_DB / 20))
+
+# Matches fade_in(10)/fade_out(10), which fade from/to -120dB
+FADE_MS = 10
+FADE_FRAMES = FADE_MS * SAMPLE_RATE // 1000
+FADE_FLOOR = 10 ** (-120 / 20)
+
+
+def _ramp(from_gain, to_gain, frames):
+    # Per-sample linear ramp, as pydub uses for fades of 100ms or less
+    return (from_gain + ((to_gain - from_gain) / frames) * np.arange(frames)).astype(np.float32)
+
+
+FADE_IN_RAMP = _ramp(FADE_FLOOR, 1.0, FADE_FRAMES)
+FADE_OUT_RAMP = _ramp(1.0, FADE_FLOOR, FADE_FRAMES)
+
+
+def fade_envelope(length):
+    """Returns the fade in/out envelope for a segment of a given length.
+    Args:
+        length (int): Segment length in samples.
+    Returns:
+        numpy.ndarray: float32 gains of the given length.
+    """
+    envelope = np.ones(length, dtype=np.float32)
+    fade_frames = min(FADE_FRAMES, length)
+    envelope[:fade_frames] *= FADE_IN_RAMP[:fade_frames]
+    envelope[length - fade_frames:] *= FADE_OUT_RAMP[FADE_FRAMES - fade_frames:]
+    return envelope
+
+
+def apply_fades(samples, offset, length):
+    """Applies a segment's fade in/out, in place, to a slice of it, touching only
+        the samples within FADE_FRAMES of either end.
+    Args:
+        samples (numpy.ndarray): float32 samples of the segment starting at offset.
+        offset (int): Position of the first sample within the segment.
+        length (int): Segment length in samples.
+    """
+    end = offset + len(samples)
+    if length < 2 * FADE_FRAMES:
+        # The fades overlap, and the envelope is short
+        samples *= fade_envelope(length)[offset:end]
+        return
+
+    if offset < FADE_FRAMES:
+        samples[:min(end, FADE_FRAMES) - offset] *= FADE_IN_RAMP[offset:min(end, FADE_FRAMES)]
+    fade_out_start = length - FADE_FRAMES
+    if end > fade_out_start:
+        lo = max(offset, fade_out_start)
+        samples[lo - offset:] *= FADE_OUT_RAMP[lo - fade_out_start:end - fade_out_start]
+
+
+def normalization_gains(sections):
+    """Computes the peak normalization gain of each section.
+    Args:
+        sections (list[audio.Section]): Sections to normalize.
+    Returns:
+        numpy.ndarray: float32 linear gains, one per section.
+    """
+    peaks = np.fromiter((max(int(s.samples.max()), -int(s.samples.min())) if s.length else 0 for s in sections),
+                        dtype=np.float64, count=len(sections))
+    gains = np.ones(len(sections), dtype=np.float64)
+    np.divide(NORMALIZE_TARGET_PEAK, peaks, out=gains, where=peaks > 0)
+    return gains.astype(np.float32)
+
+
+def pan_gains(pans):
+    """Computes the left and right gains pydub's AudioSegment.pan applies.
+    Args:
+        pans (numpy.ndarray): Pan amounts from -1.0 (100% left) to 1.0 (100% right).
+    Returns:
+        numpy.ndarray: float32 gains of shape (len(pans), 2).
+    """
+    pans = np.asarray(pans, dtype=np.float64)
+    boost = 2 ** (np.abs(pans) / 2)
+    reduce = 2 - (2 ** np.abs(pans))
+    left = np.where(pans < 0, boost, reduce)
+    right = np.where(pans < 0, reduce, boost)
+    return np.stack([left, right], axis=1).astype(np.float32)
+
+
+def segment_gains(scheduled_segments):
+    """Computes the combined normalization and pan gains for all scheduled segments at once.
+    Args:
+        scheduled_segments (list[dict]): Scheduled segments with a "segment" section and "pan".
+    Returns:
+        numpy.ndarray: float32 left/right gains of shape (len(scheduled_segments), 2).
+    """
+    gains = normalization_gains([s["segment"] for s in scheduled_segments])
+    pans = pan_gains([s["pan"] for s in scheduled_segments])
+    return pans * gains[:, np.newaxis]
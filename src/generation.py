@@ -0,0 +1,128 @@
+import os
+import re
+import time
+import uuid
+import logging
+
+import metrics
+from constants import FLASK_NAME
+from storage import get_storage
+
+
+logger = logging.getLogger(FLASK_NAME)
+
+# Number of trends to count Internet Archive results for at once when picking one
+PRESCREEN_TRENDS = int(os.environ.get("PRESCREEN_TRENDS", 10))
+
+# Trends need this many Internet Archive results to be used
+MIN_RESULTS = 10
+
+# Upload compositions as they are encoded rather than saving them to disk first
+STREAM_UPLOAD = os.environ.get("STREAM_UPLOAD", "True") == "True"
+
+
+def get_trends_by_location():
+    """Returns a dict of trend lists, or None where unavailable, for every TREND_LOCATIONS location."""
+    from trends import TREND_LOCATIONS, get_trend_service
+
+    # Get trends for every location at once
+    with metrics.stage("trend_fetch"):
+        return get_trend_service().get_trends_for_locations(TREND_LOCATIONS)
+
+
+def generate_for_location(trend_location, trends, recently_used, storage=None, progress=None):
+    """Composes and uploads audio for the most tweeted usable trend of a location.
+    Args:
+        trend_location (str): Name of the location.
+        trends (list[dict]): The location's trends.
+        recently_used (set[str]): Case-folded names of trends used in the past 24 hours.
+        storage: Storage to upload the composition to.
+        progress (callable): Called with a description of each step as it starts.
+    Returns:
+        dict: JSON of the new ArchivalEntry, or None if no trend was usable.
+    """
+    from internet_archive import search_internet_archive_audio
+    from archival import generate_audio_for_search_results
+
+    storage = storage if storage else get_storage()
+    progress = progress if progress else (lambda step: None)
+
+    # Sort trends by most tweets
+    trends.sort(reverse=True, key=lambda t: (t['tweet_volume'] is not None, t['tweet_volume']))
+
+    # Find an appropriate trend
+    progress(f"selecting a trend for {trend_location}")
+    trend = select_trend(trends, recently_used)
+    if not trend:
+        return None
+
+    trend_name = trend["name"]
+    trend_num_tweets = trend["tweet_volume"]
+    logger.debug(f"Using trend \"{trend_name}\" ({trend_num_tweets} tweets)")
+
+    # Search internet archive
+    progress(f"searching for \"{trend_name}\"")
+    with metrics.stage("ia_search"):
+        results = search_internet_archive_audio(trend_name)
+
+    quoted_filename = re.sub(r'[^0-9a-zA-Z\-.]+', '_', f"{trend_name}.mp3")
+    s3_filename = f"{str(uuid.uuid4())}-{quoted_filename}"
+
+    progress(f"composing \"{trend_name}\"")
+    if STREAM_UPLOAD:
+        # Generate audio, uploading it as it is encoded
+        def upload(chunks):
+            with metrics.stage("upload") as s:
+                storage.upload_stream(chunks, s3_filename, ACL="public-read")
+                s.bytes = chunks.bytes
+        _, composition_duration = generate_audio_for_search_results(trend_name, results, upload=upload)
+    else:
+        # Generate audio
+        composition_filename, composition_duration = generate_audio_for_search_results(trend_name, results)
+
+        # Upload audio
+        progress(f"uploading \"{trend_name}\"")
+        with metrics.stage("upload", nbytes=os.path.getsize(composition_filename)):
+            storage.upload_file(composition_filename, s3_filename, ACL="public-read")
+
+        # Delete original composition file
+        if os.path.exists(composition_filename):
+            os.remove(composition_filename)
+
+    return {
+        "trendName": trend_name,
+        "trendLocation": trend_location,
+        "numTweets": trend_num_tweets,
+        "filename": s3_filename,
+        "duration": composition_duration,
+        "timestamp": time.time()
+    }
+
+
+def select_trend(trends, recently_used):
+    """Returns the first trend, in order, that isn't in recently_used and has at
+        least MIN_RESULTS Internet Archive results, or None.
+    Results are counted for PRESCREEN_TRENDS trends at a time, concurrently.
+    """
+    from internet_archive import count_internet_archive_audio_concurrently
+
+    # Skip trends used in the past 24 hours
+    unused_trends = []
+    for trend in trends:
+        if trend["name"].lower() in recently_used:
+            logger.debug(f"{trend['name']} used in the past 24 hours, skipping...")
+            continue
+        unused_trends.append(trend)
+
+    for i in range(0, len(unused_trends), max(1, PRESCREEN_TRENDS)):
+        batch = unused_trends[i:i + max(1, PRESCREEN_TRENDS)]
+        with metrics.stage("ia_prescreen"):
+            counts = count_internet_archive_audio_concurrently([trend["name"] for trend in batch])
+
+        for trend, num_results in zip(batch, counts):
+            if num_results is None or num_results < MIN_RESULTS:
+                logger.debug(f"{trend['name']} did not return enough results from the internet archive")
+                continue
+            logger.debug(f"{trend['name']} returned {num_results} results from the internet archive")
+            return trend
+    return None
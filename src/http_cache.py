@@ -0,0 +1,196 @@
+import os
+import json
+import mmap
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import metrics
+from constants import FLASK_NAME
+from util import evict_least_recently_used, mark_recently_used, write_json_atomically
+
+
+logger = logging.getLogger(FLASK_NAME)
+
+# Directory of the Internet Archive HTTP cache, empty to disable it
+IA_CACHE_DIR = os.environ.get("IA_CACHE_DIR", "ia_cache")
+IA_CACHE_MAX_BYTES = int(float(os.environ.get("IA_CACHE_MAX_BYTES", 2e9)))
+
+# Seconds to reuse search results for
+IA_SEARCH_TTL_SECONDS = float(os.environ.get("IA_SEARCH_TTL_SECONDS", 60 * 60))
+
+# Seconds to reuse downloads for before revalidating them with the server
+IA_DOWNLOAD_FRESH_SECONDS = float(os.environ.get("IA_DOWNLOAD_FRESH_SECONDS", 24 * 60 * 60))
+
+DATA_FILENAME = "data"
+INDEX_FILENAME = "index.json"
+
+
+class CachedDownload(object):
+    """A file in the cache.
+    Args:
+        path (str): Directory of the cache entry.
+        etag (str): ETag the server sent with the file, if any.
+        last_modified (str): Last-Modified the server sent with the file, if any.
+        fetched_at (float): When the file was last fetched or revalidated.
+    """
+    def __init__(self, path, etag, last_modified, fetched_at):
+        self.path = path
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+
+    def is_fresh(self, fresh_seconds):
+        return time.time() - self.fetched_at < fresh_seconds
+
+    def conditional_headers(self):
+        """Headers to revalidate the file with, so the server can reply 304 Not Modified."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    @property
+    def size(self):
+        return os.path.getsize(os.path.join(self.path, DATA_FILENAME))
+
+    def read(self):
+        """Returns the file memory-mapped read-only, or empty bytes for an empty file."""
+        with open(os.path.join(self.path, DATA_FILENAME), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class DownloadWriter(object):
+    """Writes a download into the cache as it arrives. Nothing is visible in the
+        cache unless commit is called, so partial downloads are never served.
+    """
+    def __init__(self, cache, identifier, filename, etag, last_modified):
+        self.cache = cache
+        self.identifier = identifier
+        self.filename = filename
+        self.etag = etag
+        self.last_modified = last_modified
+        self.tmp_path = tempfile.mkdtemp(dir=cache.directory, prefix=".tmp-")
+        self.file = open(os.path.join(self.tmp_path, DATA_FILENAME), "wb")
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.close()
+        path = self.cache._download_path(self.identifier, self.filename)
+        try:
+            with open(os.path.join(self.tmp_path, INDEX_FILENAME), "w") as f:
+                json.dump({
+                    "identifier": self.identifier,
+                    "filename": self.filename,
+                    "etag": self.etag,
+                    "lastModified": self.last_modified,
+                    "fetchedAt": time.time()
+                }, f)
+            # Replace any stale copy, then move the new one into place
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(self.tmp_path, path)
+        except OSError as e:
+            logger.debug(f"Unable to cache {self.identifier}/{self.filename}: {e}")
+            self.abort()
+            return
+        evict_least_recently_used(self.cache.directory, self.cache.max_bytes)
+
+    def abort(self):
+        self.file.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+class HTTPCache:
+    """An on-disk cache of Internet Archive search results, keyed by query and
+        expiring after a TTL, and of downloaded files, keyed by identifier and
+        filename and revalidated with the server once stale. Evicts least
+        recently used entries once over a size budget.
+    """
+
+    def __init__(self, directory, max_bytes, search_ttl=IA_SEARCH_TTL_SECONDS, download_fresh=IA_DOWNLOAD_FRESH_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.search_ttl = search_ttl
+        self.download_fresh = download_fresh
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, kind, key):
+        return os.path.join(self.directory, f"{kind}-{hashlib.sha1(key.encode('utf-8')).hexdigest()}")
+
+    def _search_path(self, query):
+        return self._path("search", query) + ".json"
+
+    def _download_path(self, identifier, filename):
+        return self._path("download", f"{identifier}/{filename}")
+
+    def get_search(self, query):
+        """Returns (results, num_found) for a query searched within the TTL, or None."""
+        path = self._search_path(query)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            metrics.record_cache_lookup("search", "miss")
+            return None
+        if time.time() - entry["fetchedAt"] >= self.search_ttl:
+            metrics.record_cache_lookup("search", "miss")
+            return None
+
+        mark_recently_used(path)
+        metrics.record_cache_lookup("search", "hit")
+        return entry["results"], entry["numFound"]
+
+    def put_search(self, query, results, num_found):
+        try:
+            write_json_atomically(self._search_path(query),
+                                  {"query": query, "results": results, "numFound": num_found, "fetchedAt": time.time()})
+        except (OSError, TypeError) as e:
+            logger.debug(f"Unable to cache search \"{query}\": {e}")
+            return
+        evict_least_recently_used(self.directory, self.max_bytes)
+
+    def get_download(self, identifier, filename):
+        """Returns the CachedDownload for a file, or None if it isn't cached."""
+        path = self._download_path(identifier, filename)
+        try:
+            with open(os.path.join(path, INDEX_FILENAME), "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        mark_recently_used(path)
+        return CachedDownload(path, index["etag"], index["lastModified"], index["fetchedAt"])
+
+    def revalidated(self, download):
+        """Marks a download as fresh again after the server replied 304 Not Modified."""
+        download.fetched_at = time.time()
+        index_path = os.path.join(download.path, INDEX_FILENAME)
+        try:
+            with open(index_path, "r") as f:
+                index = json.load(f)
+            index["fetchedAt"] = download.fetched_at
+            write_json_atomically(index_path, index)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Unable to update {download.path}: {e}")
+
+    def writer(self, identifier, filename, etag=None, last_modified=None):
+        """Returns a DownloadWriter to cache a file as it downloads, or None if it can't be written."""
+        try:
+            return DownloadWriter(self, identifier, filename, etag, last_modified)
+        except OSError as e:
+            logger.debug(f"Unable to cache {identifier}/{filename}: {e}")
+            return None
+
+
+def get_http_cache():
+    if not IA_CACHE_DIR:
+        return None
+    return HTTPCache(IA_CACHE_DIR, IA_CACHE_MAX_BYTES)
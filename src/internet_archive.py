@@ -1,55 +1,374 @@
+import os
 import re
 import logging
+import itertools
+import threading
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 import internetarchive as ia
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+import metrics
 from constants import FLASK_NAME
+from http_cache import get_http_cache
+from util import wait_for_next
 
 logger = logging.getLogger(FLASK_NAME)
 
 
-def search_internet_archive_audio(search_terms):
-    query = f"({search_terms}) AND mediatype:(audio) AND language:(eng)"
-    return ia.search_items(query, fields=["title"])
+# Bytes to read from the connection at a time when streaming downloads
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
 
+# Where to fetch item metadata and files from, e.g. a local stand-in from benchmarks/mirror.py
+IA_BASE_URL = os.environ.get("IA_BASE_URL", "https://archive.org")
 
-def get_mp3_data_for_search_results(results, max_size=30e6):
-    for result in results.iter_as_items():
-        identifier = result.identifier
-        title = result.metadata['title']
-        logger.debug(f"Evaluating \"{title}\"...")
+# Number of items to fetch metadata and files for at once
+IA_FETCH_CONCURRENCY = int(os.environ.get("IA_FETCH_CONCURRENCY", 4))
 
-        for file in result.files:
-            filename = file["name"]
+# Seconds to wait to connect, and between bytes once connected, for each request
+IA_CONNECT_TIMEOUT = float(os.environ.get("IA_CONNECT_TIMEOUT", 5))
+IA_READ_TIMEOUT = float(os.environ.get("IA_READ_TIMEOUT", 30))
 
-            if re.search(".mp3$", filename) is not None:
-                # Grab the file size in bytes
-                size = file.get("size")
-                if not size:
-                    continue
-                size = int(size)
+# Number of search results to rank MP3 candidates from
+IA_MAX_CANDIDATES = int(os.environ.get("IA_MAX_CANDIDATES", 200))
 
-                # Ensure size is under max size in bytes (default 5MB)
-                if size > max_size:
-                    continue
-                logger.debug(f"File is {size / 1e6} MB")
 
-                # Download the file
-                response = _get_download_response(identifier, filename)
-                if response is None:
-                    break
+def _finish_caching(filename, response, chunks, writer):
+    """Reads the rest of a streamed download into the cache."""
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+        writer.commit()
+        logger.debug(f"Finished caching {filename}")
+    except (requests.RequestException, OSError) as e:
+        logger.debug(f"Unable to finish caching {filename}: {e}")
+        writer.abort()
+    finally:
+        response.close()
+
+
+class SearchResults(object):
+    """The first results of a search, and the total number found."""
+    def __init__(self, results, num_found):
+        self.results = results
+        self.num_found = num_found
+
+    def __len__(self):
+        return self.num_found
+
+    def __iter__(self):
+        return iter(self.results)
+
+
+def _audio_query(search_terms):
+    return f"({search_terms}) AND mediatype:(audio) AND language:(eng)"
+
+
+def search_internet_archive_audio(search_terms, cache=None):
+    """Returns SearchResults with the first IA_MAX_CANDIDATES results, reusing recent
+        results for the same query from the HTTP cache.
+    """
+    query = _audio_query(search_terms)
+    cache = get_http_cache() if cache is None else cache
+    cached = cache.get_search(query) if cache else None
+    if cached:
+        return SearchResults(*cached)
+
+    # Formats and total size come back with each result, to select candidates without fetching metadata
+    search = ia.search_items(query, fields=["identifier", "title", "format", "item_size"],
+                             params={"count": max(100, IA_MAX_CANDIDATES)})
+    results = SearchResults(list(itertools.islice(search, IA_MAX_CANDIDATES)), len(search))
+    if cache:
+        cache.put_search(query, results.results, results.num_found)
+    return results
+
+
+def count_internet_archive_audio(search_terms, cache=None):
+    """Returns the number of results search_internet_archive_audio would find, with a
+        count-only query unless the search is in the HTTP cache.
+    """
+    query = _audio_query(search_terms)
+    cache = get_http_cache() if cache is None else cache
+    cached = cache.get_search(query) if cache else None
+    if cached:
+        return cached[1]
+    return len(ia.search_items(query, request_kwargs={"timeout": (IA_CONNECT_TIMEOUT, IA_READ_TIMEOUT)}))
+
+
+def count_internet_archive_audio_concurrently(search_terms_list, count=count_internet_archive_audio):
+    """Runs count-only queries for several search terms at once, so they take as long
+        as the slowest one rather than all of them.
+    Args:
+        search_terms_list (list[str]): Search terms to count results for.
+        count (function): Returns the number of results for search terms.
+    Returns:
+        list[int]: Number of results for each search terms, or None where the query failed.
+    """
+    def count_or_none(search_terms):
+        try:
+            return count(search_terms)
+        except Exception as e:
+            logger.debug(f"Unable to count results for \"{search_terms}\": {e}")
+            return None
+
+    if not search_terms_list:
+        return []
+    with ThreadPoolExecutor(max_workers=len(search_terms_list)) as executor:
+        return list(executor.map(count_or_none, search_terms_list))
+
+
+def _has_mp3(result):
+    formats = result.get("format", [])
+    if isinstance(formats, str):
+        formats = [formats]
+    return any("MP3" in f.upper() for f in formats)
+
+
+def select_mp3_candidates(results, max_size=30e6, limit=IA_MAX_CANDIDATES):
+    """Ranks the first limit search results by how likely they are to have an MP3
+        under max_size, using only the fields returned by the search.
+    Items without an MP3 format are dropped. Items no larger than max_size in total
+        are certain to qualify, so they come first, then the rest, each in search order.
+    Args:
+        results (iterable): Search results with format and item_size fields.
+        max_size (float): Largest file to consider in bytes.
+        limit (int): Number of search results to consider.
+    Returns:
+        list[dict]: The candidate search results.
+    """
+    candidates = [result for result in itertools.islice(results, limit) if _has_mp3(result)]
+    # sorted is stable, so relevance order is kept within each group
+    return sorted(candidates, key=lambda result: int(result.get("item_size") or max_size + 1) > max_size)
+
+
+def _select_mp3_file(files, max_size):
+    """Returns the name of the first MP3 under max_size bytes in an item's files, or None."""
+    for file in files:
+        filename = file["name"]
+
+        if re.search(".mp3$", filename) is not None:
+            # Grab the file size in bytes
+            size = file.get("size")
+            if not size:
+                continue
+            size = int(size)
+
+            # Ensure size is under max size in bytes (default 5MB)
+            if size > max_size:
+                continue
+            logger.debug(f"File is {size / 1e6} MB")
 
-                logger.debug(f"Loading \"{title}\" into memory...")
+            return filename
+    return None
+
+
+class ArchiveFetcher(object):
+    """Fetches item metadata and files from the Internet Archive over one pooled
+        session, working on several items at once.
+    Args:
+        base_url (str): Where to fetch metadata and files from.
+        concurrency (int): Number of items to fetch at once.
+        timeout (tuple): (connect, read) timeouts in seconds for each request.
+        cache (HTTPCache): Cache to keep downloads in.
+    """
+    def __init__(self, base_url=IA_BASE_URL, concurrency=IA_FETCH_CONCURRENCY, timeout=(IA_CONNECT_TIMEOUT, IA_READ_TIMEOUT),
+                 cache=None):
+        self.base_url = base_url.rstrip("/")
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.cache = cache
+
+        # Keep a connection per concurrent fetch open to each host, retrying
+        #   connection errors and overloaded mirrors
+        retry = Retry(total=2, read=0, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+        adapter = HTTPAdapter(pool_maxsize=self.concurrency, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _get(self, url, **kwargs):
+        response = self.session.get(url, timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def get_files(self, identifier):
+        """Returns just the list of an item's files, a much smaller response than its full metadata."""
+        return self._get(f"{self.base_url}/metadata/{quote(identifier)}/files").json().get("result", [])
+
+    def _get_download_response(self, identifier, filename, stream=False, headers=None):
+        try:
+            return self._get(f"{self.base_url}/download/{quote(identifier)}/{quote(filename)}", stream=stream, headers=headers)
+        except requests.RequestException as e:
+            logger.debug(f"Unable to download {filename}: {e})")
+            return None
+
+    def _open(self, identifier, filename, stream=False):
+        """Returns (data, response): the cached file if it can be used, otherwise the
+            response to read it from, which is None if it can't be downloaded.
+        """
+        cached = self.cache.get_download(identifier, filename) if self.cache else None
+        if cached and cached.is_fresh(self.cache.download_fresh):
+            metrics.record_cache_lookup("download", "hit", cached.size)
+            return cached.read(), None
+
+        # Ask the server whether a stale copy is still current
+        headers = cached.conditional_headers() if cached else None
+        response = self._get_download_response(identifier, filename, stream=stream, headers=headers)
+        if cached and response is None:
+            logger.debug(f"Using stale copy of {filename}")
+            metrics.record_cache_lookup("download", "stale", cached.size)
+            return cached.read(), None
+        if cached and response.status_code == 304:
+            response.close()
+            self.cache.revalidated(cached)
+            metrics.record_cache_lookup("download", "revalidated", cached.size)
+            return cached.read(), None
+
+        if self.cache:
+            metrics.record_cache_lookup("download", "miss")
+        return None, response
+
+    def _cache_writer(self, identifier, filename, response):
+        if not self.cache:
+            return None
+        return self.cache.writer(identifier, filename, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+    def download(self, identifier, filename):
+        """Returns the contents of a file from an item, or None if it can't be downloaded.
+            Cached files are returned memory-mapped.
+        """
+        with metrics.stage("download") as s:
+            data, response = self._open(identifier, filename)
+            if response is None:
+                return data
+
+            logger.debug(f"Loading \"{filename}\" into memory...")
+            try:
                 data = response.content
+            except requests.RequestException as e:
+                logger.debug(f"Unable to download {filename}: {e})")
+                return None
+            s.bytes = len(data)
 
-                # Yield the downloaded data
-                yield title, data
+        writer = self._cache_writer(identifier, filename, response)
+        if writer:
+            writer.write(data)
+            writer.commit()
+        return data
 
-                # Look for another result
-                break
+    def stream(self, identifier, filename, chunk_size=DOWNLOAD_CHUNK_BYTES):
+        """Yields the contents of a file from an item in chunks as they arrive, or nothing
+            if it can't be downloaded. Files are only cached once downloaded to the end,
+            so closing the generator early leaves the rest to download into the cache
+            in the background, or closes the connection if there is no cache.
+        """
+        with metrics.stage("download"):
+            data, response = self._open(identifier, filename, stream=True)
+        if response is None:
+            if data is not None:
+                view = memoryview(data)
+                for offset in range(0, len(view), chunk_size):
+                    yield view[offset:offset + chunk_size]
+            return
+
+        logger.debug(f"Streaming \"{filename}\"...")
+        writer = self._cache_writer(identifier, filename, response)
+        chunks = response.iter_content(chunk_size)
+        try:
+            for chunk in chunks:
+                if writer:
+                    writer.write(chunk)
+                yield chunk
+            if writer:
+                writer.commit()
+                writer = None
+        except GeneratorExit:
+            if writer:
+                # Not daemonic, so a process exiting waits for the download to be cached
+                threading.Thread(target=_finish_caching, args=(filename, response, chunks, writer),
+                                 name="finish-caching").start()
+                response = writer = None
+            raise
+        finally:
+            if response is not None:
+                response.close()
+            if writer:
+                writer.abort()
+
+    def _fetch_item(self, result, max_size, prefetch):
+        identifier = result["identifier"]
+        title = result.get("title") or identifier
+        logger.debug(f"Evaluating \"{title}\"...")
+        with metrics.stage("metadata"):
+            files = self.get_files(identifier)
+
+        filename = _select_mp3_file(files, max_size)
+        if filename is None:
+            return None
+        if prefetch and prefetch(identifier, filename):
+            data = self.download(identifier, filename)
+            if data is None:
+                return None
+            return identifier, filename, title, data
+        return identifier, filename, title
+
+    def get_mp3_files(self, results, max_size=30e6, prefetch=None, ordered=False):
+        """Yields the first MP3 under max_size of each search result, in the order
+            the fetches complete so a slow or failing mirror only holds up its own item.
+        Args:
+            results (iterable): Search results, dicts with an identifier and optionally a title,
+                e.g. from select_mp3_candidates.
+            max_size (float): Largest file to consider in bytes.
+            prefetch (function): Given an (identifier, filename), returns True to download
+                the file along with the metadata.
+            ordered (bool): Yield in search result order rather than completion order.
+        Yields:
+            tuple: (identifier, filename, title), with the data appended when prefetched.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        pending = {}
+        results = iter(results)
+        try:
+            while True:
+                # Keep a bounded number of items in flight
+                for result in results:
+                    pending[executor.submit(self._fetch_item, result, max_size, prefetch)] = result
+                    if len(pending) >= self.concurrency:
+                        break
+                if not pending:
+                    break
+
+                for future in wait_for_next(pending, ordered):
+                    pending.pop(future)
+                    try:
+                        fetched = future.result()
+                    except Exception as e:
+                        logger.debug(f"Unable to fetch item: {e}")
+                        continue
+                    if fetched:
+                        yield fetched
+        finally:
+            # Abandon outstanding fetches once the caller has enough
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+_fetcher = None
+
+
+def get_fetcher():
+    """Returns the shared ArchiveFetcher, creating it in each process on first use."""
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = ArchiveFetcher(cache=get_http_cache())
+    return _fetcher
+
+
+def download_mp3(identifier, filename):
+    """Returns the contents of a file from an item, or None if it can't be downloaded."""
+    return get_fetcher().download(identifier, filename)
 
-def _get_download_response(identifier, filename):
-    try:
-        return ia.download(identifier, files=[filename], return_responses=True)[0]
-    except Exception as e:
-        logger.debug(f"Unable to download {filename}: {e})")
-        return None
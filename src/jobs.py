@@ -0,0 +1,229 @@
+"""Runs generation in a child process, so its CPU-bound work never stalls the
+    web worker's gevent loop. The worker queues jobs with a JobRunner and picks
+    up results as the child reports them, one JSON message per line of its stdout.
+
+The child is this module, run as a script:
+    python jobs.py < job.json
+
+where the job names a function as "module:function", which is called with the
+    job's args and a function to send messages back with.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import logging
+import importlib
+
+import metrics
+from constants import FLASK_NAME
+
+
+logger = logging.getLogger(FLASK_NAME)
+
+# Number of finished jobs to keep the status of
+JOBS_KEPT = int(os.environ.get("JOBS_KEPT", 20))
+
+# Seconds a job may run before its child, and any processes it started, are killed
+JOB_TIMEOUT_SECONDS = float(os.environ.get("JOB_TIMEOUT_SECONDS", 2 * 60 * 60))
+
+
+class Job(object):
+    """A queued generation job.
+    Args:
+        kind (str): Function to run, as "module:function".
+        args (dict): JSON arguments for the job.
+    """
+    def __init__(self, kind, args):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.args = args
+        self.status = "queued"
+        self.progress = None
+        self.results = []
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        # Imported here so jobs.py can run as a script without gevent
+        from gevent.event import Event
+        self.finished = Event()
+
+    def wait(self, timeout=None):
+        """Waits for the job to finish, cooperatively, returning whether it has."""
+        return self.finished.wait(timeout)
+
+    def to_json(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "results": len(self.results),
+            "error": self.error,
+            "createdAt": self.created_at,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at
+        }
+
+
+class JobRunner(object):
+    """Runs queued jobs one at a time, each in a fresh child process.
+    Args:
+        on_result (callable): Called with the job and each result as the child reports it.
+    """
+    def __init__(self, on_result=None):
+        from gevent.queue import Queue
+
+        self.on_result = on_result
+        self.queue = Queue()
+        self.jobs = {}
+        self.greenlet = None
+
+    def submit(self, kind, args=None):
+        """Queues a job, returning its Job."""
+        import gevent
+
+        job = Job(kind, args if args else {})
+        self.jobs[job.id] = job
+        self.queue.put(job)
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self._run_forever)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def recent(self):
+        """Returns jobs, newest first."""
+        return sorted(self.jobs.values(), key=lambda job: job.created_at, reverse=True)
+
+    def _run_forever(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self._run(job)
+            except Exception as e:
+                logger.exception(f"Job {job.id} failed")
+                job.status, job.error = "failed", str(e)
+            finally:
+                job.finished_at = time.time()
+                job.finished.set()
+                self._forget_old_jobs()
+
+    def _run(self, job):
+        # gevent's subprocess waits on the child without blocking other greenlets
+        import gevent
+        from gevent import subprocess
+
+        job.status, job.started_at = "running", time.time()
+        logger.debug(f"Starting {job.kind} job {job.id}")
+        # Only the first job is profiled, as with generation in this process
+        env = dict(os.environ, PROFILE_GENERATION=metrics.PROFILE_GENERATION or "")
+        metrics.PROFILE_GENERATION = None
+
+        # In its own process group, so ffmpeg and ingestion workers it starts can be killed with it
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)), env=env, start_new_session=True)
+        finished = False
+        try:
+            process.stdin.write(json.dumps({"kind": job.kind, "args": job.args}).encode("utf-8"))
+            process.stdin.close()
+            with gevent.Timeout(JOB_TIMEOUT_SECONDS):
+                for line in process.stdout:
+                    self._handle(job, json.loads(line))
+            finished = True
+        except gevent.Timeout:
+            job.error = f"timed out after {JOB_TIMEOUT_SECONDS}s"
+        finally:
+            # Never leave the child or its own children running, or the child unwaited for
+            if not finished:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            process.stdout.close()
+            returncode = process.wait()
+
+        if job.error or returncode != 0:
+            job.status = "failed"
+            job.error = job.error if job.error else f"exited with {returncode}"
+        else:
+            job.status = "done"
+        logger.debug(f"{job.kind} job {job.id} {job.status} with {len(job.results)} results")
+
+    def _handle(self, job, message):
+        if "observations" in message:
+            metrics.record_stages([(getattr(metrics, name), args) for name, args in message["observations"]])
+        if "progress" in message:
+            job.progress = message["progress"]
+        if "result" in message:
+            job.results.append(message["result"])
+            if self.on_result:
+                try:
+                    self.on_result(job, message["result"])
+                except Exception as e:
+                    # Keep reading, so later results aren't lost
+                    logger.exception(f"Unable to handle a result of job {job.id}")
+                    job.error = f"unable to handle result: {e}"
+        if "error" in message:
+            job.error = message["error"]
+
+    def _forget_old_jobs(self):
+        finished = [job for job in self.recent() if job.finished.is_set()]
+        for job in finished[JOBS_KEPT:]:
+            del self.jobs[job.id]
+
+
+def generate(args, send):
+    """Generates an entry per trend location, sending each as a result."""
+    from generation import generate_for_location, get_trends_by_location
+
+    recently_used = set(args.get("recentlyUsed", []))
+    send(progress="fetching trends")
+    trends_by_location, observations = metrics.collect_stages(get_trends_by_location)
+    send(observations=observations)
+
+    for trend_location, trends in trends_by_location.items():
+        if not trends:
+            logger.warning(f"No trends available for {trend_location}, skipping...")
+            continue
+        progress = lambda step: send(progress=step)
+        entry, observations = metrics.collect_stages(generate_for_location, trend_location, trends, recently_used, None, progress)
+        send(observations=observations)
+        if entry:
+            # Later locations shouldn't reuse the trend
+            recently_used.add(entry["trendName"].lower())
+            send(result=entry)
+
+
+def _run_child():
+    # Keep stdout for messages, sending anything else written to it to stderr
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    logging.basicConfig(format='[%(asctime)s] (%(name)s) [%(filename)s::%(funcName)s::%(lineno)s] [%(levelname)s]: %(message)s')
+    logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+
+    def send(observations=None, **message):
+        if observations is not None:
+            message["observations"] = [[record.__name__, list(args)] for record, args in observations]
+        out.write(json.dumps(message) + "\n")
+        out.flush()
+
+    job = json.loads(sys.stdin.read())
+    module_name, function_name = job["kind"].split(":")
+    try:
+        with metrics.profile_once():
+            getattr(importlib.import_module(module_name), function_name)(job["args"], send)
+    except Exception as e:
+        logger.exception(f"{job['kind']} job failed")
+        send(error=str(e))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    _run_child()
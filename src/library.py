@@ -0,0 +1,101 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import numpy as np
+
+from constants import FLASK_NAME
+from util import evict_least_recently_used, mark_recently_used
+
+
+logger = logging.getLogger(FLASK_NAME)
+
+# Directory of the voiced segment library, empty to disable it
+SEGMENT_LIBRARY_DIR = os.environ.get("SEGMENT_LIBRARY_DIR", "segment_library")
+SEGMENT_LIBRARY_MAX_BYTES = int(float(os.environ.get("SEGMENT_LIBRARY_MAX_BYTES", 2e9)))
+
+SAMPLES_FILENAME = "samples.npy"
+INDEX_FILENAME = "index.json"
+
+
+class LibraryEntry(object):
+    """A source in the segment library.
+    Args:
+        source (numpy.ndarray): The source's int16 samples, memory-mapped from disk.
+        sections (list[list[float]]): Voiced (start, end) sections in seconds.
+        buckets (list[int]): Length bucket of each section.
+        buckets_ms (list[int]): The length buckets used when the entry was stored.
+    """
+    def __init__(self, source, sections, buckets, buckets_ms):
+        self.source = source
+        self.sections = sections
+        self.buckets = buckets
+        self.buckets_ms = buckets_ms
+
+
+class SegmentLibrary:
+    """An on-disk library of decoded sources and their voiced sections, keyed by
+        Internet Archive identifier and filename, evicting least recently used
+        sources once over a size budget.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_path(self, identifier, filename):
+        key = hashlib.sha1(f"{identifier}/{filename}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def contains(self, identifier, filename):
+        return os.path.isdir(self._entry_path(identifier, filename))
+
+    def get(self, identifier, filename):
+        """Returns the LibraryEntry for a file, or None if it isn't in the library."""
+        path = self._entry_path(identifier, filename)
+        try:
+            with open(os.path.join(path, INDEX_FILENAME), "r") as f:
+                index = json.load(f)
+            source = np.load(os.path.join(path, SAMPLES_FILENAME), mmap_mode="r")
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.debug(f"Unable to load {identifier}/{filename} from segment library: {e}")
+            return None
+
+        mark_recently_used(path)
+        return LibraryEntry(source, index["sections"], index["buckets"], index["bucketsMs"])
+
+    def put(self, identifier, filename, source, sections, buckets, buckets_ms):
+        """Stores a decoded source and its voiced sections, evicting old sources if needed."""
+        path = self._entry_path(identifier, filename)
+        if os.path.exists(path):
+            return
+
+        # Write to a temporary directory and move it into place so readers never see partial entries
+        tmp_path = tempfile.mkdtemp(dir=self.directory, prefix=".tmp-")
+        try:
+            np.save(os.path.join(tmp_path, SAMPLES_FILENAME), source)
+            with open(os.path.join(tmp_path, INDEX_FILENAME), "w") as f:
+                json.dump({
+                    "identifier": identifier,
+                    "filename": filename,
+                    "sections": sections,
+                    "buckets": buckets,
+                    "bucketsMs": buckets_ms
+                }, f)
+            os.rename(tmp_path, path)
+        except OSError as e:
+            logger.debug(f"Unable to store {identifier}/{filename} in segment library: {e}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+
+        evict_least_recently_used(self.directory, self.max_bytes)
+
+
+def get_segment_library():
+    if not SEGMENT_LIBRARY_DIR:
+        return None
+    return SegmentLibrary(SEGMENT_LIBRARY_DIR, SEGMENT_LIBRARY_MAX_BYTES)
@@ -1,14 +1,13 @@
 import os
-import re
+import json
 import time
+import base64
 import logging
-import uuid
 from urllib.parse import quote_plus, unquote_plus
-from operator import attrgetter
 from logging.config import dictConfig
 import gevent
 import jinja2
-from flask import Flask, render_template, request
+from flask import Flask, abort, g, jsonify, render_template, request
 
 # Configure logging before any local imports to ensure config is applied
 dictConfig({
@@ -27,11 +26,12 @@ dictConfig({
     }
 })
 
+import metrics
 from constants import FLASK_NAME
-from state import state, ArchivalEntry, upload_file
-from twitter import get_trends_by_location_name
-from internet_archive import search_internet_archive_audio
-from archival import generate_audio_for_search_results
+from state import state, ArchivalEntry, get_state_storage, refresh_state
+from coordination import LeaderLock
+from jobs import JobRunner
+from page_cache import PageCache, PAGE_CACHE_CONTROL
 
 # Use reverse proxy to ensure url_for populates with the correct scheme
 class ReverseProxied(object):
@@ -59,81 +59,133 @@ app.jinja_loader = jinja2.ChoiceLoader(
 # Create quote_plus jina filter
 app.jinja_env.filters['quote_plus'] = lambda u: quote_plus(u)
 
+# "process" generates in a child process, so CPU-bound work doesn't stall requests,
+#   "inline" generates in this one
+GENERATION_RUNNER = os.environ.get("GENERATION_RUNNER", "process")
+
+# Entries linked on the page, the most recent, before loading more from the API
+PAGE_ENTRIES = int(os.environ.get("PAGE_ENTRIES", 50))
+
+# Entries returned per API request by default, and at most
+API_ENTRIES_LIMIT = int(os.environ.get("API_ENTRIES_LIMIT", 50))
+API_ENTRIES_MAX_LIMIT = int(os.environ.get("API_ENTRIES_MAX_LIMIT", 200))
+
+# Only the worker holding a lock on this file generates, empty for every worker to generate
+GENERATION_LOCK = os.environ.get("GENERATION_LOCK", "generation.lock")
+
+# Seconds between attempts by other workers to take over generation
+LEADER_RETRY_SECONDS = float(os.environ.get("LEADER_RETRY_SECONDS", 30))
+
 
 # Generates an entry and updates state
 def generate_and_update(generation_interval=4*60*60):
     # Denote start time
     start = time.time()
 
-    # Get trends for location - Boston
-    trend_location = "Boston"
-    trends = get_trends_by_location_name(trend_location)
-
-    # Sort trends by most tweets
-    trends.sort(reverse=True, key=lambda t: (t['tweet_volume'] is not None, t['tweet_volume']))
-
-    # Find an appropriate trend
-    for trend in trends:
-        trend_name = trend["name"]
-        trend_num_tweets = trend["tweet_volume"]
-
-        # Check if trend has been used in the past 24 hours
-        last_24_hour_entries = filter(lambda e: e.timestamp > (time.time() - 24*60*60), state.entries)
-        if trend_name.lower() in [e.trend_name.lower() for e in last_24_hour_entries]:
-            logger.debug(f"{trend_name} used in the past 24 hours, skipping...")
+    # Trends used in the past 24 hours are skipped
+    recently_used = state.trends_used_since(time.time() - 24*60*60)
+
+    try:
+        if job_runner:
+            with metrics.stage("generation"):
+                job = job_runner.submit("jobs:generate", {"recentlyUsed": sorted(recently_used)})
+                job.wait()
+            if job.status == "failed":
+                logger.error(f"generation job failed: {job.error}")
+        else:
+            with metrics.profile_once(), metrics.stage("generation"):
+                _generate(recently_used)
+    finally:
+        # Compute when next generation should start
+        generation_duration = time.time() - start
+        next_generation_start_time = max(0, generation_interval - generation_duration)
+        logger.debug(f"generation took {generation_duration}s, starting next generation in {next_generation_start_time}s")
+
+        # Schedule next generation
+        gevent.spawn_later(next_generation_start_time, generate_and_update, generation_interval)
+
+
+def _generate(recently_used):
+    # Imported here so workers that skip generation don't load the generation stack
+    from generation import generate_for_location, get_trends_by_location
+
+    # Generate a composition per location
+    for trend_location, trends in get_trends_by_location().items():
+        if not trends:
+            logger.warning(f"No trends available for {trend_location}, skipping...")
             continue
+        entry_json = generate_for_location(trend_location, trends, recently_used, storage=get_state_storage())
+        if entry_json:
+            recently_used.add(entry_json["trendName"].lower())
+            _add_entry(None, entry_json)
 
-        # Search internet archive
-        results = search_internet_archive_audio(trend_name)
-        MIN_RESULTS = 10
-        if len(results) < MIN_RESULTS:
-            logger.debug(f"{trend_name} did not return enough results from the internet archive")
-            continue
-        logger.debug(f"{trend_name} returned {len(results)} results from the internet archive")
 
-        logger.debug(f"Using trend \"{trend_name}\" ({trend_num_tweets} tweets)")
+def _add_entry(job, entry_json):
+    # Add entry
+    state.add_entry(ArchivalEntry.from_json(entry_json))
 
-        # Generate audio
-        composition_filename, composition_duration = generate_audio_for_search_results(trend_name, results)
 
-        # Upload audio
-        quoted_filename = re.sub(r'[^0-9a-zA-Z\-.]+', '_', composition_filename)
-        s3_filename = f"{str(uuid.uuid4())}-{quoted_filename}"
-        upload_file(composition_filename, s3_filename, ACL="public-read")
+# Waits to hold the generation lock, then generates for as long as this worker lives
+def lead_generation(generation_interval=4*60*60):
+    while not leader_lock.try_acquire():
+        gevent.sleep(LEADER_RETRY_SECONDS)
+    logger.info("leading generation")
 
-        # Create new archival entry
-        entry = ArchivalEntry(trend_name, trend_location, trend_num_tweets, s3_filename, composition_duration, time.time())
+    # Other workers may have been serving entries from a shared store loaded long ago
+    if state.shared:
+        try:
+            with metrics.stage("state_refresh"):
+                refresh_state(state)
+        except Exception as e:
+            logger.warning(f"Unable to refresh state, generating from shared entries: {e}")
 
-        # Add entry
-        state.add_entry(entry)
+    generate_and_update(generation_interval)
 
-        # Delete original composition file
-        if os.path.exists(composition_filename):
-            os.remove(composition_filename)
 
-        # Only generate once
-        break
+leader_lock = LeaderLock(GENERATION_LOCK) if GENERATION_LOCK else None
+job_runner = JobRunner(on_result=_add_entry) if GENERATION_RUNNER == "process" else None
+page_cache = PageCache()
+
+# Kickoff generation
+if os.environ.get("SKIP_GENERATION") == "True":
+    logger.info("not generating entries")
+elif leader_lock:
+    gevent.spawn(lead_generation)
+else:
+    gevent.spawn(generate_and_update)
 
-    # Compute when next generation should start
-    generation_duration = time.time() - start
-    next_generation_start_time = max(0, generation_interval - generation_duration)
-    logger.debug(f"generation took {generation_duration}s, starting next generation in {next_generation_start_time}s")
 
-    # Schedule next generation
-    gevent.spawn_later(next_generation_start_time, generate_and_update, generation_interval)
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
 
 
-# Kickoff generation
-if not os.environ.get("SKIP_GENERATION") == "True":
-    gevent.spawn(generate_and_update)
-else:
-    logger.info("not generating entries")
+@app.after_request
+def record_request_latency(response):
+    if request.endpoint and hasattr(g, "request_start"):
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, endpoint=request.endpoint)
+    return response
 
 
 @app.route('/health')
 def health():
     return 'OK', 200
 
+@app.route('/metrics')
+def prometheus_metrics():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+@app.route('/jobs')
+def jobs():
+    return jsonify([job.to_json() for job in job_runner.recent()] if job_runner else [])
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_runner.get(job_id) if job_runner else None
+    if not job:
+        abort(404)
+    return jsonify(job.to_json())
+
 @app.route('/', methods=["GET"])
 def archival():
     # Allow specifying a trend
@@ -144,14 +196,62 @@ def archival():
 
     # Get entry by trend name
     if trend_name:
-        unquoted_trend_name = unquote_plus(trend_name)
-        entries_by_trend = list(filter(lambda e: e.trend_name.lower() == unquoted_trend_name.lower(), state.entries))
-        if len(entries_by_trend) > 0:
-            entry = entries_by_trend.pop(0)
+        entry = state.get_by_trend(unquote_plus(trend_name))
 
     # Default to most recent
     if not entry:
-        most_recent_entry = max(state.entries, default=None, key=attrgetter("timestamp"))
-        entry = most_recent_entry
-
-    return render_template('archival.html', entry=entry, all_entries=state.entries)
+        entry = state.most_recent()
+
+    # Render only when the entry or the archive has changed, and let clients revalidate with the ETag
+    def render():
+        recent_entries, next_cursor = state.entries_before(PAGE_ENTRIES)
+        return render_template('archival.html', entry=entry, recent_entries=recent_entries,
+                               next_cursor=_encode_cursor(next_cursor))
+    body, etag = page_cache.get(state.version, entry, render)
+    response = app.response_class(body, mimetype="text/html")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = PAGE_CACHE_CONTROL
+    return response.make_conditional(request)
+
+
+# Entries newest first, or with ?trend= those of trends starting with a prefix by name,
+#   a page at a time. The returned cursor, passed as ?cursor=, gets the next page
+@app.route('/api/entries', methods=["GET"])
+def api_entries():
+    limit = request.args.get("limit", API_ENTRIES_LIMIT, type=int)
+    if limit is None or limit < 1:
+        abort(400)
+    limit = min(limit, API_ENTRIES_MAX_LIMIT)
+    trend_prefix = request.args.get("trend")
+    cursor = _decode_cursor(request.args.get("cursor"), str if trend_prefix else float)
+
+    if trend_prefix:
+        entries, next_cursor = state.entries_with_trend_prefix(trend_prefix, limit, cursor)
+    else:
+        entries, next_cursor = state.entries_before(limit, cursor)
+
+    body = json.dumps({"entries": [e.to_json() for e in entries], "cursor": _encode_cursor(next_cursor)},
+                      separators=(",", ":"))
+    response = app.response_class(body, mimetype="application/json")
+    response.add_etag()
+    response.headers["Cache-Control"] = PAGE_CACHE_CONTROL
+    return response.make_conditional(request)
+
+
+def _encode_cursor(cursor):
+    # Opaque to clients, and safe in a URL
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(cursor, separators=(",", ":")).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor, key_type):
+    if not cursor:
+        return None
+    try:
+        key, position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        abort(400)
+    if not isinstance(position, int) or position < 0 or not isinstance(key, (int, float) if key_type is float else str):
+        abort(400)
+    return key, position
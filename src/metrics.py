@@ -0,0 +1,193 @@
+import os
+import time
+import resource
+import cProfile
+import contextlib
+
+
+# Default histogram buckets, in seconds
+STAGE_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+REQUEST_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# Filename to write a cProfile capture of the next generation run to, if set
+PROFILE_GENERATION = os.environ.get("PROFILE_GENERATION")
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for k, v in pairs]
+    return "{" + ",".join(f"{k}=\"{v}\"" for k, v in escaped) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        REGISTRY.append(self)
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, _format_labels(labels), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets):
+        super().__init__(name, documentation)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self.values:
+            self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        histogram = self.values[key]
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+    def samples(self):
+        for labels, histogram in self.values.items():
+            for upper_bound, count in zip(self.buckets, histogram["buckets"]):
+                yield f"{self.name}_bucket", _format_labels(labels, ("le", upper_bound)), count
+            yield f"{self.name}_bucket", _format_labels(labels, ("le", "+Inf")), histogram["count"]
+            yield f"{self.name}_sum", _format_labels(labels), histogram["sum"]
+            yield f"{self.name}_count", _format_labels(labels), histogram["count"]
+
+
+REGISTRY = []
+
+STAGE_SECONDS = Histogram("archival_stage_seconds", "Time spent in each generation stage.", STAGE_BUCKETS)
+STAGE_BYTES = Counter("archival_stage_bytes_total", "Bytes processed by each generation stage.")
+STAGE_ERRORS = Counter("archival_stage_errors_total", "Generation stages that raised an exception.")
+STAGE_MAX_RSS = Gauge("archival_stage_max_rss_bytes", "Peak resident memory of the process after each generation stage.")
+PROCESS_MAX_RSS = Gauge("archival_process_max_rss_bytes", "Peak resident memory of the process.")
+REQUEST_SECONDS = Histogram("archival_request_seconds", "Latency of HTTP requests by endpoint.", REQUEST_BUCKETS)
+CACHE_LOOKUPS = Counter("archival_cache_lookups_total", "Cache lookups by cache and result (hit, miss, revalidated or stale).")
+CACHE_HIT_BYTES = Counter("archival_cache_hit_bytes_total", "Bytes served from each cache without being fetched.")
+
+# When set, observations are collected here as (function, args) instead of
+#   recorded, so worker processes can hand them back to the parent
+_collected = None
+
+
+def _max_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def record_stage(name, seconds, nbytes=0, error=False, max_rss=None):
+    # Taken now, so observations replayed from a worker process keep the worker's own
+    max_rss = max_rss if max_rss is not None else _max_rss_bytes()
+    if _collected is not None:
+        _collected.append((record_stage, (name, seconds, nbytes, error, max_rss)))
+        return
+
+    STAGE_SECONDS.observe(seconds, stage=name)
+    if nbytes:
+        STAGE_BYTES.inc(nbytes, stage=name)
+    if error:
+        STAGE_ERRORS.inc(stage=name)
+    STAGE_MAX_RSS.set(max_rss, stage=name)
+
+
+class _Stage:
+    def __init__(self):
+        self.bytes = 0
+
+
+@contextlib.contextmanager
+def stage(name, nbytes=0):
+    """Times a generation stage. Bytes can be passed up front or added to the
+        yielded object's bytes attribute.
+    """
+    s = _Stage()
+    s.bytes = nbytes
+    start = time.perf_counter()
+    try:
+        yield s
+    except BaseException:
+        record_stage(name, time.perf_counter() - start, s.bytes, error=True)
+        raise
+    record_stage(name, time.perf_counter() - start, s.bytes)
+
+
+def record_cache_lookup(cache, result, nbytes=0):
+    if _collected is not None:
+        _collected.append((record_cache_lookup, (cache, result, nbytes)))
+        return
+
+    CACHE_LOOKUPS.inc(cache=cache, result=result)
+    if nbytes and result != "miss":
+        CACHE_HIT_BYTES.inc(nbytes, cache=cache)
+
+
+def collect_stages(fn, *args):
+    """Calls fn, returning its result and the observations it made rather than recording them."""
+    global _collected
+    _collected = []
+    try:
+        return fn(*args), _collected
+    finally:
+        _collected = None
+
+
+def record_stages(observations):
+    for record, args in observations:
+        record(*args)
+
+
+@contextlib.contextmanager
+def profile_once():
+    """Captures a cProfile of the wrapped code to PROFILE_GENERATION, only the first time."""
+    global PROFILE_GENERATION
+    filename = PROFILE_GENERATION
+    if not filename:
+        yield
+        return
+
+    PROFILE_GENERATION = None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
+
+
+def render():
+    PROCESS_MAX_RSS.set(_max_rss_bytes())
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
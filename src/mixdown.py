@@ -0,0 +1,91 @@
+import os
+import logging
+import numpy as np
+from pydub import AudioSegment
+
+from constants import FLASK_NAME
+from audio import SAMPLE_RATE, SAMPLE_WIDTH
+from dsp import apply_fades, segment_gains
+
+
+logger = logging.getLogger(FLASK_NAME)
+
+INT16_MIN = -32768
+INT16_MAX = 32767
+
+# Length of each block rendered when streaming
+RENDER_BLOCK_MS = int(os.environ.get("RENDER_BLOCK_MS", 5000))
+RENDER_BLOCK_FRAMES = RENDER_BLOCK_MS * SAMPLE_RATE // 1000
+
+
+def ms_to_frames(ms):
+    # Matches pydub's millisecond to frame conversion
+    return int(ms * SAMPLE_RATE / 1000)
+
+
+def render(scheduled_segments, composition_length):
+    """Mixes scheduled mono sections into a single stereo buffer, applying
+        normalization, fades and pan along the way.
+    Args:
+        scheduled_segments (list[dict]): Scheduled segments with a "segment" section, "offset" (ms) and "pan".
+        composition_length (float): Length of the composition in ms.
+    Returns:
+        numpy.ndarray: int16 interleaved stereo samples of shape (frames, 2).
+    """
+    block_frames = max(1, ms_to_frames(composition_length))
+    blocks = list(render_blocks(scheduled_segments, composition_length, block_frames=block_frames))
+    return blocks[0] if blocks else np.zeros((0, 2), dtype=np.int16)
+
+
+def render_blocks(scheduled_segments, composition_length, block_frames=RENDER_BLOCK_FRAMES):
+    """Mixes scheduled mono sections into fixed-size stereo blocks, so memory is
+        bounded by the block size rather than the composition length.
+    Args:
+        scheduled_segments (list[dict]): Scheduled segments with a "segment" section, "offset" (ms) and "pan".
+        composition_length (float): Length of the composition in ms.
+        block_frames (int): Number of frames per block.
+    Yields:
+        numpy.ndarray: int16 interleaved stereo samples of shape (frames, 2).
+    """
+    length = ms_to_frames(composition_length)
+    gains = segment_gains(scheduled_segments)
+    starts = [ms_to_frames(s["offset"]) for s in scheduled_segments]
+    order = sorted(range(len(scheduled_segments)), key=lambda i: starts[i])
+
+    # Reused accumulator for every block
+    block = np.zeros((block_frames, 2), dtype=np.float32)
+    active = []
+    next_index = 0
+    for block_start in range(0, length, block_frames):
+        block_end = min(block_start + block_frames, length)
+        accumulator = block[:block_end - block_start]
+        accumulator.fill(0)
+
+        # Activate segments starting in this block
+        while next_index < len(order) and starts[order[next_index]] < block_end:
+            active.append(order[next_index])
+            next_index += 1
+
+        # Mix only the segments overlapping this block
+        still_active = []
+        for i in active:
+            section = scheduled_segments[i]["segment"]
+            start = starts[i]
+            end = min(start + section.length, length)
+            lo = max(start, block_start)
+            hi = min(end, block_end)
+            if hi > lo:
+                weighted = section.samples[lo - start:hi - start].astype(np.float32)
+                apply_fades(weighted, lo - start, section.length)
+                accumulator[lo - block_start:hi - block_start] += weighted[:, np.newaxis] * gains[i]
+            if end > block_end:
+                still_active.append(i)
+        active = still_active
+
+        # Clip and convert once per block
+        np.clip(accumulator, INT16_MIN, INT16_MAX, out=accumulator)
+        yield accumulator.astype(np.int16)
+
+
+def to_audio_segment(frames):
+    return AudioSegment(data=frames.tobytes(), sample_width=SAMPLE_WIDTH, frame_rate=SAMPLE_RATE, channels=2)
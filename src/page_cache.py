@@ -0,0 +1,49 @@
+import os
+import hashlib
+import threading
+
+import metrics
+
+
+# Rendered pages to keep per version of the state
+PAGE_CACHE_MAX_PAGES = int(os.environ.get("PAGE_CACHE_MAX_PAGES", 256))
+
+# Cache-Control for pages, letting browsers and a CDN reuse them briefly, then revalidate
+PAGE_CACHE_CONTROL = os.environ.get("PAGE_CACHE_CONTROL", "public, max-age=60, stale-while-revalidate=300")
+
+
+class PageCache(object):
+    """Rendered pages by the entry they present, for one version of the state.
+        Entries are compared by identity, as the state keeps every entry for as
+        long as its version stands, and the cache is emptied when it changes.
+    Args:
+        max_pages (int): Pages to keep, evicting the oldest first.
+    """
+    def __init__(self, max_pages=PAGE_CACHE_MAX_PAGES):
+        self.max_pages = max_pages
+        self.version = None
+        self.pages = {}
+        self.lock = threading.Lock()
+
+    def get(self, version, entry, render):
+        """Returns (body, etag) of the page for an entry, calling render for its HTML if not cached.
+            The ETag is a hash of the body, so every worker gives a page the same one.
+        """
+        with self.lock:
+            if version != self.version:
+                self.pages, self.version = {}, version
+            page = self.pages.get(entry)
+        if page:
+            metrics.record_cache_lookup("page", "hit", len(page[0]))
+            return page
+
+        metrics.record_cache_lookup("page", "miss")
+        body = render().encode("utf-8")
+        page = (body, hashlib.sha1(body).hexdigest())
+        with self.lock:
+            # Don't keep a page rendered from a state that has since changed
+            if version == self.version:
+                if len(self.pages) >= self.max_pages:
+                    del self.pages[next(iter(self.pages))]
+                self.pages[entry] = page
+        return page
@@ -1,31 +1,205 @@
 import os
 import json
+import time
+import uuid
+import bisect
 import logging
-import boto3
+import sqlite3
+import threading
 
-from secrets import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
+import metrics
 from constants import FLASK_NAME
+from storage import get_storage
+from coordination import SharedEntryStore
+from util import write_json_atomically
 
 logger = logging.getLogger(FLASK_NAME)
 
-S3_BUCKET_NAME = "archival-project"
-AWS_SESSION = boto3.Session(aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
 STATE_FILENAME = os.environ.get("STATE_FILENAME", "state.json")
 
+# Local copy of the state to start from while it is refreshed from storage in the
+#   background, empty to always wait for storage
+STATE_LOCAL_SNAPSHOT = os.environ.get("STATE_LOCAL_SNAPSHOT", "state_snapshot.json")
+
+# "log" appends each new entry as its own object under STATE_LOG_PREFIX, compacting
+#   them into STATE_FILENAME every STATE_COMPACT_EVERY entries. "snapshot" rewrites
+#   STATE_FILENAME on every entry.
+STATE_PERSISTENCE = os.environ.get("STATE_PERSISTENCE", "log")
+STATE_LOG_PREFIX = os.environ.get("STATE_LOG_PREFIX", "state-log/")
+STATE_COMPACT_EVERY = int(os.environ.get("STATE_COMPACT_EVERY", 100))
+
+# SQLite file through which processes on this machine share entries, so only one
+#   needs to load state from S3, empty to have each process keep its own
+SHARED_STATE_DB = os.environ.get("SHARED_STATE_DB", "state.sqlite3")
+
+# Seconds between checks for entries added by other processes
+STATE_SYNC_SECONDS = float(os.environ.get("STATE_SYNC_SECONDS", 1.0))
+
+# Seconds without any change to the shared store before a process reloads the state from
+#   storage itself, in case no process on this machine is adding entries to the store
+STATE_REFRESH_SECONDS = float(os.environ.get("STATE_REFRESH_SECONDS", 5 * 60))
+
+_storage = None
+
+
+def get_state_storage():
+    """Returns the shared storage, created on first use as connecting to S3 is slow to set up."""
+    global _storage
+    if _storage is None:
+        _storage = get_storage()
+    return _storage
+
+
 class ArchivalState:
 
-    def __init__(self, entries=None):
+    def __init__(self, entries=None, storage=None, log_keys=None):
         self.entries = entries if entries else []
+        self._storage = storage
+
+        # Log objects not yet compacted into the snapshot
+        self.log_keys = log_keys if log_keys else []
+
+        # Number of entries added since loading, to detect adds during a refresh
+        self.added = 0
+
+        # Incremented whenever the entries change, for caches of anything derived from them
+        self.version = 0
+
+        # SharedEntryStore this state mirrors, and the last of its entries applied
+        self.shared = None
+        self.shared_row_id = 0
+        self.sync_lock = threading.Lock()
+
+        # Entries in the order they were added, by case-folded trend name
+        self.by_trend = {}
+
+        # Case-folded trend names, sorted to bisect for those with a prefix, and sorted
+        #   once after loading rather than kept sorted throughout
+        self.trend_names = None
+
+        # Entries sorted by timestamp, ties in the order they were added, and their timestamps to bisect
+        self.by_time = []
+        self.timestamps = []
+
+        for entry in self.entries:
+            self._index(entry)
+        self.trend_names = sorted(self.by_trend)
+
+    def _index(self, entry):
+        self.version += 1
+        key = entry.trend_name.lower()
+        if key not in self.by_trend and self.trend_names is not None:
+            bisect.insort(self.trend_names, key)
+        self.by_trend.setdefault(key, []).append(entry)
+
+        # Entries are almost always added in time order, making this an append
+        i = bisect.bisect_right(self.timestamps, entry.timestamp)
+        self.timestamps.insert(i, entry.timestamp)
+        self.by_time.insert(i, entry)
+
+    @property
+    def storage(self):
+        return self._storage if self._storage else get_state_storage()
+
+    def _replace(self, other):
+        """Takes the entries and indexes of another state, or when shared, adds any of
+            its entries the store doesn't have yet.
+        """
+        if self.shared:
+            self.shared.add_entries([e.to_json() for e in other.entries])
+            self.log_keys = other.log_keys
+            self.sync()
+            return
+        self.entries, self.log_keys = other.entries, other.log_keys
+        self.by_trend, self.trend_names = other.by_trend, other.trend_names
+        self.by_time, self.timestamps = other.by_time, other.timestamps
+        self.version += 1
+
+    def sync(self):
+        """Applies entries added to the shared store since last synced."""
+        with self.sync_lock:
+            for row_id, entry_json in self.shared.entries_after(self.shared_row_id):
+                entry = ArchivalEntry.from_json(entry_json)
+                self.entries.append(entry)
+                self._index(entry)
+                self.shared_row_id = row_id
 
     def add_entry(self, entry):
-        self.entries.append(entry)
-        _update_state()
+        self.added += 1
+        if self.shared:
+            # Other processes pick it up from the store
+            self.shared.add_entries([entry.to_json()])
+            self.sync()
+        else:
+            self.entries.append(entry)
+            self._index(entry)
+        if STATE_PERSISTENCE == "log":
+            _append_entry(self, entry)
+        else:
+            _update_state(self)
+
+    def trends_used_since(self, timestamp):
+        """Returns the case-folded names of trends with an entry added after timestamp."""
+        return {entry.trend_name.lower() for entry in self.by_time[bisect.bisect_right(self.timestamps, timestamp):]}
+
+    def get_by_trend(self, trend_name):
+        """Returns the first entry added for a case-insensitive trend name, or None."""
+        entries = self.by_trend.get(trend_name.lower())
+        return entries[0] if entries else None
+
+    def most_recent(self):
+        """Returns the entry with the latest timestamp, the first added if tied, or None."""
+        if not self.by_time:
+            return None
+        return self.by_time[bisect.bisect_left(self.timestamps, self.timestamps[-1])]
+
+    def entries_before(self, limit, cursor=None):
+        """Returns up to limit entries, newest first, that come after a cursor, and a cursor
+            for the rest, or None if there are none.
+        A cursor is an entry's (timestamp, number of entries added earlier with that timestamp),
+            which stays valid as entries are added.
+        """
+        end = len(self.by_time)
+        if cursor:
+            timestamp, ties = cursor
+            end = min(bisect.bisect_left(self.timestamps, timestamp) + ties, bisect.bisect_right(self.timestamps, timestamp))
+        start = max(0, end - limit)
+
+        next_cursor = None
+        if start > 0:
+            timestamp = self.timestamps[start]
+            next_cursor = (timestamp, start - bisect.bisect_left(self.timestamps, timestamp))
+        return self.by_time[start:end][::-1], next_cursor
+
+    def entries_with_trend_prefix(self, prefix, limit, cursor=None):
+        """Returns up to limit entries for trends whose case-folded name starts with prefix,
+            by name then in the order added, and a cursor for the rest, or None if there are none.
+        A cursor is the (case-folded trend name, number of its entries already returned) to continue from.
+        """
+        prefix = prefix.lower()
+        name, skip = cursor if cursor and cursor[0] >= prefix else (prefix, 0)
+
+        entries = []
+        i = bisect.bisect_left(self.trend_names, name)
+        while i < len(self.trend_names) and self.trend_names[i].startswith(prefix):
+            key = self.trend_names[i]
+            trend_entries = self.by_trend[key][skip if key == name else 0:]
+            taken = trend_entries[:limit - len(entries)]
+            entries += taken
+            if len(entries) == limit:
+                if len(taken) < len(trend_entries):
+                    return entries, (key, len(self.by_trend[key]) - len(trend_entries) + len(taken))
+                if i + 1 < len(self.trend_names) and self.trend_names[i + 1].startswith(prefix):
+                    return entries, (self.trend_names[i + 1], 0)
+                break
+            i += 1
+        return entries, None
 
     @staticmethod
-    def from_json(json_dict):
+    def from_json(json_dict, storage=None):
         entries = json_dict.get("entries", [])
         entries = [ArchivalEntry.from_json(e) for e in entries]
-        return ArchivalState(entries)
+        return ArchivalState(entries, storage=storage)
 
     def to_json(self) -> dict:
         return {
@@ -34,6 +208,7 @@ class ArchivalState:
 
 
 class ArchivalEntry:
+    __slots__ = ("trend_name", "trend_location", "num_tweets", "filename", "duration", "timestamp")
 
     def __init__(self, trend_name, trend_location, num_tweets, filename, duration, timestamp):
         self.trend_name = trend_name
@@ -64,36 +239,187 @@ class ArchivalEntry:
         }
 
 
-def upload_file(filename, key, **kwargs):
-    s3 = AWS_SESSION.resource('s3')
-    with open(filename, 'rb') as file_obj:
-        s3.Object(S3_BUCKET_NAME, key).put(Body=file_obj, **kwargs)
+def _read_state(storage, cached=None, attempts=3):
+    """Reads the snapshot and the log objects written after it.
+        Log keys are listed before the snapshot is read, so a compaction in between
+        only leaves the snapshot covering more of them. A log object compacted and
+        deleted after the snapshot was read means there is a newer one, so it is read again.
+    Args:
+        storage: Storage to read from.
+        cached (dict): A previous read, whose snapshot is reused if its ETag still
+            matches and whose log objects are not read again.
+        attempts (int): Reads to try before giving up on compactions overlapping them.
+    Returns:
+        dict: {"etag", "snapshot", "log": {key: entry JSON}}.
+    """
+    cached = cached if cached else {}
+    cached_log = dict(cached.get("log", {}))
+    for _ in range(attempts):
+        logger.debug("fetching state from S3")
+        # Log keys sort in the order they were written
+        log_keys = storage.list_keys(STATE_LOG_PREFIX)
+        snapshot_bytes, etag = storage.get_bytes_if_changed(STATE_FILENAME, cached.get("etag"))
+        snapshot = json.loads(snapshot_bytes) if snapshot_bytes is not None else cached["snapshot"]
+
+        last_log_key = snapshot.get("lastLogKey", "")
+        log = {}
+        for key in log_keys:
+            if key <= last_log_key:
+                continue
+            if key not in cached_log:
+                entry_bytes = storage.get_bytes_if_exists(key)
+                if entry_bytes is None:
+                    logger.debug(f"{key} compacted while reading state, reading it again")
+                    break
+                cached_log[key] = json.loads(entry_bytes)
+            log[key] = cached_log[key]
+        else:
+            return {"etag": etag, "snapshot": snapshot, "log": log}
+        cached = {"etag": etag, "snapshot": snapshot}
+    raise RuntimeError("Unable to read state while it was being compacted")
+
+
+def _state_from_read(read, storage=None) -> ArchivalState:
+    loaded_state = ArchivalState.from_json(read["snapshot"], storage=storage)
+    log_keys = sorted(read["log"])
+    for key in log_keys:
+        entry = ArchivalEntry.from_json(read["log"][key])
+        loaded_state.entries.append(entry)
+        loaded_state._index(entry)
+    loaded_state.log_keys = log_keys
+    if log_keys:
+        logger.debug(f"applied {len(log_keys)} state log entries")
+    return loaded_state
 
 
-def _upload_bytes(b, key):
-    s3 = AWS_SESSION.resource('s3')
-    s3.Object(S3_BUCKET_NAME, key).put(Body=b)
+def _get_state(storage=None) -> ArchivalState:
+    """Loads the snapshot, then applies any log objects written after it."""
+    storage = storage if storage else get_state_storage()
+    return _state_from_read(_read_state(storage), storage)
+
+
+def _read_local_snapshot():
+    if not STATE_LOCAL_SNAPSHOT:
+        return None
+    try:
+        with open(STATE_LOCAL_SNAPSHOT, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_local_snapshot(read):
+    if not STATE_LOCAL_SNAPSHOT:
+        return
+    try:
+        write_json_atomically(STATE_LOCAL_SNAPSHOT, read)
+    except OSError as e:
+        logger.debug(f"Unable to write {STATE_LOCAL_SNAPSHOT}: {e}")
+
 
+def refresh_state(archival_state, cached=None, attempts=3):
+    """Reloads a state from storage in place, then saves the local snapshot.
+        A reload that overlaps an entry being added in this process is retried,
+        so the entry isn't lost.
+    Returns:
+        bool: Whether the state was reloaded.
+    """
+    for _ in range(attempts):
+        added = archival_state.added
+        read = _read_state(archival_state.storage, cached)
+        if archival_state.added == added:
+            archival_state._replace(_state_from_read(read, archival_state._storage))
+            if archival_state.shared:
+                archival_state.shared.mark_seeded(read["etag"])
+            _write_local_snapshot(read)
+            return True
+        cached = read
+    logger.warning("Unable to refresh state while entries were being added")
+    return False
 
-def _get_state() -> ArchivalState:
-    logger.debug("fetching state from S3")
-    s3 = AWS_SESSION.resource('s3')
-    state_object = s3.Object(S3_BUCKET_NAME, STATE_FILENAME).get()
-    state_dict = json.load(state_object["Body"])
-    return ArchivalState.from_json(state_dict)
 
-def _update_state():
-    global state
-    
-    if not state:
+def _refresh_in_background(archival_state, cached):
+    try:
+        with metrics.stage("state_refresh"):
+            refresh_state(archival_state, cached)
+        logger.debug("refreshed state from S3")
+    except Exception as e:
+        logger.warning(f"Unable to refresh state, serving local snapshot: {e}")
+
+
+def _update_state(archival_state=None):
+    """Rewrites the whole snapshot, folding in any log objects."""
+    archival_state = archival_state if archival_state else state
+
+    if not archival_state:
         logger.warning("update_state: state not yet defined")
         return
-    
+
     logger.debug("updating state in S3")
-    state_json = state.to_json()
+    state_json = archival_state.to_json()
+    if archival_state.log_keys:
+        state_json["lastLogKey"] = archival_state.log_keys[-1]
     state_json_bytes = json.dumps(state_json).encode("utf-8")
-    _upload_bytes(state_json_bytes, STATE_FILENAME)
+    with metrics.stage("state_write", nbytes=len(state_json_bytes)):
+        archival_state.storage.put_bytes(state_json_bytes, STATE_FILENAME)
+
+    # The snapshot now covers the log, so it can be removed
+    for key in archival_state.log_keys:
+        archival_state.storage.delete(key)
+    archival_state.log_keys = []
+
+
+def _append_entry(archival_state, entry):
+    """Writes a single entry to the log, a cost independent of the number of entries."""
+    key = f"{STATE_LOG_PREFIX}{time.time_ns():020d}-{uuid.uuid4().hex}.json"
+    entry_bytes = json.dumps(entry.to_json()).encode("utf-8")
+    with metrics.stage("state_append", nbytes=len(entry_bytes)):
+        archival_state.storage.put_bytes(entry_bytes, key)
+    archival_state.log_keys.append(key)
+
+    # Compact once the log has grown, keeping loads to one snapshot plus a short tail
+    if len(archival_state.log_keys) >= STATE_COMPACT_EVERY:
+        _update_state(archival_state)
+
+
+def _sync_periodically(archival_state):
+    last_changed = time.time()
+    while True:
+        time.sleep(STATE_SYNC_SECONDS)
+        try:
+            if archival_state.shared.changed():
+                archival_state.sync()
+                last_changed = time.time()
+        except sqlite3.Error as e:
+            logger.warning(f"Unable to sync shared state: {e}")
+
+        if time.time() - last_changed >= STATE_REFRESH_SECONDS:
+            try:
+                with metrics.stage("state_refresh"):
+                    refresh_state(archival_state)
+                logger.debug("refreshed state from S3 after no changes to the shared store")
+            except Exception as e:
+                logger.warning(f"Unable to refresh state: {e}")
+            last_changed = time.time()
+
 
+# Populate state
+state = ArchivalState()
+if SHARED_STATE_DB:
+    state.shared = SharedEntryStore(SHARED_STATE_DB)
+    threading.Thread(target=_sync_periodically, args=(state,), name="state-sync", daemon=True).start()
 
-# Populate state from S3
-state = _get_state()
+# From the local snapshot if there is one so startup doesn't wait on S3, then refreshed
+#   from S3 in the background
+_local_snapshot = _read_local_snapshot()
+if _local_snapshot and state.shared and state.shared.seeded_etag() == _local_snapshot["etag"]:
+    # Another process has loaded the same state, and the generation leader keeps it up to date
+    state.sync()
+elif _local_snapshot:
+    # Also fills in a store left from an earlier run
+    state._replace(_state_from_read(_local_snapshot))
+if _local_snapshot:
+    threading.Thread(target=_refresh_in_background, args=(state, _local_snapshot), name="state-refresh", daemon=True).start()
+else:
+    # Nothing to check a store against
+    refresh_state(state)
@@ -0,0 +1,221 @@
+import os
+import shutil
+import logging
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from constants import FLASK_NAME
+
+logger = logging.getLogger(FLASK_NAME)
+
+S3_BUCKET_NAME = "archival-project"
+
+# S3-compatible endpoint to use instead of AWS, e.g. a local stand-in
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+
+# Local directory to use in place of the S3 bucket, e.g. for offline runs and benchmarks
+STORAGE_DIR = os.environ.get("STORAGE_DIR")
+
+# Streamed uploads are sent as parts of this many bytes, at least 5 MiB for S3, this many at a time
+STORAGE_PART_SIZE = int(os.environ.get("STORAGE_PART_SIZE", 5 * 1024 * 1024))
+STORAGE_UPLOAD_CONCURRENCY = int(os.environ.get("STORAGE_UPLOAD_CONCURRENCY", 4))
+
+# Attempts at each S3 request, including each part of an upload, before giving up
+STORAGE_MAX_ATTEMPTS = int(os.environ.get("STORAGE_MAX_ATTEMPTS", 5))
+
+
+def _split_parts(chunks, part_size):
+    """Regroups an iterable of byte chunks into parts of part_size bytes, the last possibly shorter."""
+    part = bytearray()
+    for chunk in chunks:
+        part += chunk
+        while len(part) >= part_size:
+            yield bytes(part[:part_size])
+            del part[:part_size]
+    if part:
+        yield bytes(part)
+
+
+class S3Storage:
+    """Stores objects in an S3 bucket, through one client whose connection pool is
+        shared by every request. Failed requests, including parts of uploads, are
+        retried by the client with backoff.
+    """
+
+    def __init__(self, bucket_name=S3_BUCKET_NAME, endpoint_url=S3_ENDPOINT_URL, part_size=STORAGE_PART_SIZE,
+                 concurrency=STORAGE_UPLOAD_CONCURRENCY, max_attempts=STORAGE_MAX_ATTEMPTS):
+        # Only require AWS credentials when actually using S3
+        from secrets import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
+        # Imported here as boto3 is slow to import, and only needed for S3
+        import boto3
+        from botocore.config import Config
+
+        self.bucket_name = bucket_name
+        self.part_size = part_size
+        self.concurrency = max(1, concurrency)
+        self.session = boto3.Session(aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+        config = Config(max_pool_connections=max(10, 2 * self.concurrency),
+                        retries={"max_attempts": max_attempts, "mode": "standard"})
+        self.client = self.session.client('s3', endpoint_url=endpoint_url, config=config)
+
+    def get_bytes(self, key):
+        return self.client.get_object(Bucket=self.bucket_name, Key=key)["Body"].read()
+
+    def get_bytes_if_exists(self, key):
+        """Returns the object's bytes, or None if there is no such key, e.g. as it has been deleted."""
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.get_object(Bucket=self.bucket_name, Key=key)["Body"].read()
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return None
+            raise
+
+    def get_bytes_if_changed(self, key, etag=None):
+        """Returns (bytes, etag), or (None, etag) if the object still has the given ETag."""
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=key, **({"IfNoneMatch": etag} if etag else {}))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+                return None, etag
+            raise
+        return response["Body"].read(), response["ETag"]
+
+    def put_bytes(self, b, key, **kwargs):
+        self.client.put_object(Bucket=self.bucket_name, Key=key, Body=b, **kwargs)
+
+    def upload_file(self, filename, key, **kwargs):
+        from boto3.s3.transfer import TransferConfig
+
+        config = TransferConfig(multipart_chunksize=self.part_size, max_concurrency=self.concurrency)
+        self.client.upload_file(filename, self.bucket_name, key, ExtraArgs=kwargs, Config=config)
+
+    def upload_stream(self, chunks, key, **kwargs):
+        """Uploads an iterable of byte chunks, such as an encoder's output, as a
+            multipart upload. Parts are sent concurrently as they fill, so no more than
+            concurrency parts are held in memory and the object is never on disk.
+        """
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=key, **kwargs)["UploadId"]
+        try:
+            parts = []
+            in_flight = set()
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for number, part in enumerate(_split_parts(chunks, self.part_size), start=1):
+                    # Wait for a part to finish before reading any more
+                    if len(in_flight) >= self.concurrency:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        parts.extend(future.result() for future in done)
+                    in_flight.add(executor.submit(self._upload_part, upload_id, key, number, part))
+                parts.extend(future.result() for future in in_flight)
+
+            if not parts:
+                # A multipart upload needs at least one part
+                self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+                self.put_bytes(b"", key, **kwargs)
+                return
+            parts.sort(key=lambda p: p["PartNumber"])
+            self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                                                  MultipartUpload={"Parts": parts})
+        except BaseException:
+            logger.warning(f"Aborting upload of {key}")
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+            raise
+
+    def _upload_part(self, upload_id, key, number, part):
+        response = self.client.upload_part(Bucket=self.bucket_name, Key=key, UploadId=upload_id, PartNumber=number, Body=part)
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def list_keys(self, prefix):
+        keys = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket_name, Prefix=prefix):
+            keys.extend(o["Key"] for o in page.get("Contents", []))
+        return sorted(keys)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket_name, Key=key)
+
+
+class LocalStorage:
+    """Stores objects as files in a local directory, standing in for S3.
+        Extra S3 arguments such as ACL are accepted and ignored.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get_bytes(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def get_bytes_if_exists(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get_bytes_if_changed(self, key, etag=None):
+        # Modification time and size stand in for an ETag
+        with open(self._path(key), 'rb') as f:
+            stat = os.fstat(f.fileno())
+            current_etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+            if current_etag == etag:
+                return None, etag
+            return f.read(), current_etag
+
+    def put_bytes(self, b, key, **kwargs):
+        # Write then rename so readers never see a partial object
+        os.makedirs(os.path.dirname(self._path(key)), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b)
+        os.replace(tmp_path, self._path(key))
+
+    def upload_file(self, filename, key, **kwargs):
+        os.makedirs(os.path.dirname(self._path(key)), exist_ok=True)
+        shutil.copyfile(filename, self._path(key))
+
+    def upload_stream(self, chunks, key, **kwargs):
+        # Written as it arrives, then renamed so readers never see a partial object
+        os.makedirs(os.path.dirname(self._path(key)), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def list_keys(self, prefix):
+        # Keys can contain "/", like S3, which map to subdirectories
+        keys = []
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith(".tmp-"):
+                    continue
+                key = os.path.relpath(os.path.join(root, filename), self.directory).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+def get_storage():
+    if STORAGE_DIR:
+        logger.info(f"using local storage in {STORAGE_DIR}")
+        return LocalStorage(STORAGE_DIR)
+    return S3Storage()
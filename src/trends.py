@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import FLASK_NAME
+from util import write_json_atomically
+
+
+logger = logging.getLogger(FLASK_NAME)
+
+# Comma separated names of the locations to generate compositions for each cycle
+TREND_LOCATIONS = [name.strip() for name in os.environ.get("TREND_LOCATIONS", "Boston").split(",") if name.strip()]
+
+# JSON file of fixture locations and trends to use instead of Twitter, for running offline
+TREND_FIXTURES = os.environ.get("TREND_FIXTURES")
+
+# Directory for the WOEID index and cached trend lists, empty to keep them in memory only
+TRENDS_CACHE_DIR = os.environ.get("TRENDS_CACHE_DIR", "trends_cache")
+
+# Seconds to reuse trend lists and the WOEID index for
+TRENDS_TTL_SECONDS = float(os.environ.get("TRENDS_TTL_SECONDS", 15 * 60))
+WOEID_INDEX_TTL_SECONDS = float(os.environ.get("WOEID_INDEX_TTL_SECONDS", 7 * 24 * 60 * 60))
+
+# Twitter allows 75 trend requests per 15 minutes with app auth
+TRENDS_RATE_LIMIT_CALLS = int(os.environ.get("TRENDS_RATE_LIMIT_CALLS", 75))
+TRENDS_RATE_LIMIT_PERIOD = float(os.environ.get("TRENDS_RATE_LIMIT_PERIOD", 15 * 60))
+
+WOEID_INDEX_FILENAME = "woeid_index.json"
+
+
+class RateLimiter(object):
+    """Spaces out calls so no more than calls are made in any period seconds."""
+    def __init__(self, calls, period):
+        self.calls = calls
+        self.period = period
+        self.history = collections.deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.history and now - self.history[0] >= self.period:
+                    self.history.popleft()
+                if len(self.history) < self.calls:
+                    self.history.append(now)
+                    return
+                wait = self.period - (now - self.history[0])
+            logger.debug(f"Trend requests rate limited, waiting {wait:.1f}s...")
+            time.sleep(wait)
+
+    def exhaust(self):
+        """Treats the window as used up, e.g. after the server says the limit was hit."""
+        with self.lock:
+            now = time.monotonic()
+            self.history.extend([now] * max(0, self.calls - len(self.history)))
+
+
+def _is_rate_limited(e):
+    # HTTP 429, or Twitter's "Rate limit exceeded" error code
+    response = getattr(e, "response", None)
+    return getattr(response, "status_code", None) == 429 or getattr(e, "api_code", None) == 88
+
+
+class TwitterTrendProvider(object):
+    """Fetches locations and trends from the Twitter API."""
+
+    def _api(self):
+        # Imported here as importing twitter authenticates with the API
+        from twitter import twitter
+        return twitter
+
+    def available_locations(self):
+        """Returns a list of {"name", "woeid"} for locations with trends."""
+        return [{"name": location["name"], "woeid": location["woeid"]} for location in self._api().trends_available()]
+
+    def trends(self, woeid):
+        """Returns the list of trends for a location."""
+        trends_response = self._api().trends_place(woeid, exclude="hashtags")
+        if len(trends_response) != 1:
+            logger.warning(f"Twitter trends response length was {len(trends_response)}, not 1.")
+            return None
+        return trends_response[0]["trends"]
+
+
+class FixtureTrendProvider(object):
+    """Serves locations and trends from a JSON file of the form
+        {"locations": [{"name", "woeid"}, ...], "trends": {"<woeid>": [trend, ...]}}
+    """
+    def __init__(self, filename):
+        with open(filename, "r") as f:
+            fixtures = json.load(f)
+        self.locations = fixtures.get("locations", [])
+        self.trends_by_woeid = fixtures.get("trends", {})
+
+    def available_locations(self):
+        return list(self.locations)
+
+    def trends(self, woeid):
+        trends = self.trends_by_woeid.get(str(woeid))
+        return [dict(trend) for trend in trends] if trends is not None else None
+
+
+class TrendService(object):
+    """Looks up trends by location name through a provider, keeping a persistent
+        index of location names to WOEIDs and a TTL cache of trend lists, and
+        keeping provider requests under its rate limit.
+    Args:
+        provider: A TwitterTrendProvider or FixtureTrendProvider.
+        cache_dir (str): Directory to persist the index and trend lists in, or None.
+        ttl (float): Seconds to reuse trend lists for.
+        index_ttl (float): Seconds to reuse the WOEID index for.
+        rate_limiter (RateLimiter): Limiter for provider requests.
+    """
+    def __init__(self, provider, cache_dir=None, ttl=TRENDS_TTL_SECONDS, index_ttl=WOEID_INDEX_TTL_SECONDS,
+                 rate_limiter=None):
+        self.provider = provider
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.index_ttl = index_ttl
+        self.rate_limiter = rate_limiter if rate_limiter else RateLimiter(TRENDS_RATE_LIMIT_CALLS, TRENDS_RATE_LIMIT_PERIOD)
+        self.index = None
+        self.index_fetched_at = 0.0
+        self.cached_trends = {}
+        self.lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _read_json(self, filename):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, filename), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_json(self, filename, value):
+        if not self.cache_dir:
+            return
+        try:
+            write_json_atomically(os.path.join(self.cache_dir, filename), value)
+        except (OSError, TypeError) as e:
+            logger.debug(f"Unable to write {filename}: {e}")
+
+    def _call(self, fn, *args):
+        self.rate_limiter.acquire()
+        try:
+            return fn(*args)
+        except Exception as e:
+            if _is_rate_limited(e):
+                # Hold off on further requests until the window has passed
+                self.rate_limiter.exhaust()
+            raise
+
+    def _woeid_index(self, refresh=False):
+        with self.lock:
+            if self.index is None:
+                stored = self._read_json(WOEID_INDEX_FILENAME)
+                if stored:
+                    self.index, self.index_fetched_at = stored["index"], stored["fetchedAt"]
+
+            if refresh or self.index is None or time.time() - self.index_fetched_at >= self.index_ttl:
+                logger.debug("Fetching available trend locations...")
+                locations = self._call(self.provider.available_locations)
+                index = {}
+                for location in locations:
+                    index.setdefault(location["name"].lower(), []).append(location["woeid"])
+                self.index, self.index_fetched_at = index, time.time()
+                self._write_json(WOEID_INDEX_FILENAME, {"index": self.index, "fetchedAt": self.index_fetched_at})
+            return self.index
+
+    def get_woeid(self, location_name):
+        """Returns the WOEID of a case-insensitive location name, or None if it isn't a unique trend location."""
+        woeids = self._woeid_index().get(location_name.lower(), [])
+        if len(woeids) != 1:
+            logger.warning(f"Found {len(woeids)} locations that matched the location named \"{location_name}\".")
+            return None
+        return woeids[0]
+
+    def _trends_filename(self, woeid):
+        return f"trends-{woeid}.json"
+
+    def _get_cached_trends(self, woeid):
+        cached = self.cached_trends.get(woeid) or self._read_json(self._trends_filename(woeid))
+        if cached and time.time() - cached["fetchedAt"] < self.ttl:
+            self.cached_trends[woeid] = cached
+            return [dict(trend) for trend in cached["trends"]]
+        return None
+
+    def get_trends(self, location_name):
+        """Returns a list of trends for a location name, or None if unavailable."""
+        woeid = self.get_woeid(location_name)
+        if woeid is None:
+            return None
+
+        trends = self._get_cached_trends(woeid)
+        if trends is not None:
+            return trends
+
+        trends = self._call(self.provider.trends, woeid)
+        if trends is None:
+            return None
+        cached = {"trends": trends, "fetchedAt": time.time()}
+        self.cached_trends[woeid] = cached
+        self._write_json(self._trends_filename(woeid), cached)
+        return [dict(trend) for trend in trends]
+
+    def get_trends_for_locations(self, location_names, concurrency=4):
+        """Returns a dict of trend lists, or None where unavailable, keyed by location name.
+            Resolves every name with at most one location request, then fetches trend
+            lists that aren't cached concurrently, within the rate limit.
+        """
+        self._woeid_index()
+
+        def get_trends_or_none(location_name):
+            try:
+                return self.get_trends(location_name)
+            except Exception as e:
+                logger.warning(f"Unable to get trends for \"{location_name}\": {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(location_names)))) as executor:
+            return dict(zip(location_names, executor.map(get_trends_or_none, location_names)))
+
+
+_trend_service = None
+
+
+def get_trend_service():
+    """Returns the shared TrendService, using fixtures instead of Twitter if TREND_FIXTURES is set."""
+    global _trend_service
+    if _trend_service is None:
+        if TREND_FIXTURES:
+            # Fixtures are cheap to read, and shouldn't mix with cached Twitter data
+            _trend_service = TrendService(FixtureTrendProvider(TREND_FIXTURES))
+        else:
+            _trend_service = TrendService(TwitterTrendProvider(), cache_dir=TRENDS_CACHE_DIR or None)
+    return _trend_service
@@ -1,5 +1,10 @@
+import os
+import json
 import bisect
+import shutil
+import tempfile
 import gevent
+from concurrent.futures import FIRST_COMPLETED, wait
 
 
 def quantize_without_going_over(value, quant, with_index=False):
@@ -20,3 +25,94 @@ def quantize_without_going_over(value, quant, with_index=False):
         return ind, quant[ind]
     else:
         return quant[ind]
+
+
+def _path_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(root, filename))
+    return size
+
+
+def evict_least_recently_used(directory, max_bytes):
+    """Removes the least recently modified entries of a directory until it fits in a size budget.
+        Entries starting with "." are ignored.
+    Args:
+        directory (str): Directory whose files or subdirectories are evictable entries.
+        max_bytes (int): Size budget for the directory in bytes.
+    Returns:
+        int: Number of entries removed.
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(directory):
+        if name.startswith("."):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            size = _path_size(path)
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError:
+            continue
+        total += size
+
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def mark_recently_used(path):
+    """Updates a file or directory's modification time, so evict_least_recently_used keeps it longest."""
+    os.utime(path)
+
+
+def write_json_atomically(path, value):
+    """Writes JSON to a temporary file beside path, then moves it into place, so
+        readers never see a partial file. The temporary file starts with "." so
+        evict_least_recently_used ignores it, and is removed if writing fails.
+    Raises:
+        OSError: If the file can't be written.
+        TypeError: If the value can't be serialized.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def wait_for_next(pending, ordered=False):
+    """Waits for futures to finish, returning those done.
+    Args:
+        pending (dict): Futures, as keys in the order they were submitted.
+        ordered (bool): Wait for just the oldest, rather than whichever finish first.
+    Returns:
+        iterable[Future]: The finished futures.
+    """
+    if ordered:
+        # Dicts keep insertion order, so the first pending future is the oldest
+        done = [next(iter(pending))]
+        wait(done)
+        return done
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    return done
@@ -1,11 +1,52 @@
+import os
+import ctypes
 import collections
+import multiprocessing
 import contextlib
 import wave
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import webrtcvad
+import _webrtcvad
 
 
-vad = webrtcvad.Vad(3)
+VAD_MODE = 3
+
+# Sample rates webrtcvad can analyze
+SUPPORTED_SAMPLE_RATES = [8000, 16000, 32000, 48000]
+
+# Rate to decimate 48kHz audio to for detection only
+VAD_SAMPLE_RATE = int(os.environ.get("VAD_SAMPLE_RATE", 48000))
+
+# RMS energy (in 16-bit sample units) below which frames are treated as unvoiced
+#   without running the detector, 0 to disable
+VAD_ENERGY_THRESHOLD = float(os.environ.get("VAD_ENERGY_THRESHOLD", 0))
+
+# Number of frames to decimate or measure energy for at once
+FEED_BLOCK_FRAMES = 1000
+
+# webrtcvad analyzes frequencies up to this, at any sample rate
+DETECTOR_BAND_HZ = 4000
+
+# Sources longer than this many seconds run VAD over chunks in parallel, 0 to disable
+VAD_PARALLEL_MIN_SECONDS = float(os.environ.get("VAD_PARALLEL_MIN_SECONDS", 3600))
+VAD_CHUNK_SECONDS = float(os.environ.get("VAD_CHUNK_SECONDS", 300))
+VAD_CHUNK_OVERLAP_SECONDS = float(os.environ.get("VAD_CHUNK_OVERLAP_SECONDS", 1))
+VAD_WORKERS = int(os.environ.get("VAD_WORKERS", os.cpu_count() or 1))
+
+# Samples in the 30ms frames webrtcvad's model analyzes, at 8kHz whatever the input rate
+NARROWBAND_FRAME_SAMPLES = 240
+
+vad = webrtcvad.Vad(VAD_MODE)
+
+# webrtcvad's own resampling, called directly to run it apart from the detector's model
+try:
+    _webrtcvad_lib = ctypes.CDLL(_webrtcvad.__file__)
+    _webrtcvad_lib.WebRtcSpl_Resample48khzTo8khz
+    _webrtcvad_lib.WebRtcVad_Downsampling
+except (OSError, AttributeError):
+    _webrtcvad_lib = None
 
 """
 NOTE: CRIBBED FROM https://github.com/wiseman/py-webrtcvad/blob/master/example.py
@@ -47,7 +88,7 @@ def frame_generator(frame_duration_ms, audio, sample_rate):
 
 
 def vad_collector(sample_rate, frame_duration_ms,
-                  padding_duration_ms, frames):
+                  padding_duration_ms, frames, detector=None):
     """
     RYAN EDIT: instead yields (start, end) timestamps for voiced frames
     """
@@ -68,68 +109,408 @@ def vad_collector(sample_rate, frame_duration_ms,
     frame_duration_ms - The frame duration in milliseconds.
     padding_duration_ms - The amount to pad the window, in milliseconds.
     frames - a source of audio frames (sequence or generator).
+    detector - the webrtcvad.Vad to use, defaults to the shared module one.
     Returns: A generator that yields PCM audio data.
     """
+    detector = detector if detector else vad
     num_padding_frames = int(padding_duration_ms / frame_duration_ms)
-    # We use a deque for our sliding window/ring buffer.
-    ring_buffer = collections.deque(maxlen=num_padding_frames)
-    # We have two states: TRIGGERED and NOTTRIGGERED. We start in the
-    # NOTTRIGGERED state.
-    triggered = False
-
-    voiced_frames = []
+    collector = SectionCollector(num_padding_frames)
     for frame in frames:
-        is_speech = vad.is_speech(frame.bytes, sample_rate)
+        is_speech = detector.is_speech(frame.bytes, sample_rate)
+        collector.push(frame.timestamp, frame.duration, is_speech)
+    return collector.finish()
+
+
+class SectionCollector(object):
+    """The padded, sliding window state machine from vad_collector, keeping
+        running counts of voiced frames so each frame costs O(1).
+    Collects [start, end] timestamps of voiced sections.
+    """
+    def __init__(self, num_padding_frames):
+        self.maxlen = num_padding_frames
+        # We use a deque for our sliding window/ring buffer of (timestamp, is_speech).
+        self.ring_buffer = collections.deque(maxlen=num_padding_frames)
+        self.num_voiced = 0
+        # We have two states: TRIGGERED and NOTTRIGGERED. We start in the
+        # NOTTRIGGERED state.
+        self.triggered = False
+        self.sections = []
+        self.end = None
+
+    def _clear(self):
+        self.ring_buffer.clear()
+        self.num_voiced = 0
 
-        if not triggered:
-            ring_buffer.append((frame, is_speech))
-            num_voiced = len([f for f, speech in ring_buffer if speech])
+    def push(self, timestamp, duration, is_speech):
+        # Account for the frame about to fall out of the window
+        if len(self.ring_buffer) == self.maxlen and self.ring_buffer[0][1]:
+            self.num_voiced -= 1
+        self.ring_buffer.append((timestamp, is_speech))
+        if is_speech:
+            self.num_voiced += 1
+        self.end = timestamp + duration
+
+        if not self.triggered:
             # If we're NOTTRIGGERED and more than 90% of the frames in
             # the ring buffer are voiced frames, then enter the
-            # TRIGGERED state.
-            if num_voiced > 0.9 * ring_buffer.maxlen:
-                triggered = True
-                # sys.stdout.write('+(%s)' % (ring_buffer[0][0].timestamp,))
-                # We want to yield all the audio we see from now until
-                # we are NOTTRIGGERED, but we have to start with the
-                # audio that's already in the ring buffer.
-                # for f, s in ring_buffer:
-                #     voiced_frames.append(f)
-                voiced_frames.append([ring_buffer[0][0].timestamp, None])
-                ring_buffer.clear()
+            # TRIGGERED state, starting with the audio that's already
+            # in the ring buffer.
+            if self.num_voiced > 0.9 * self.maxlen:
+                self.triggered = True
+                self.sections.append([self.ring_buffer[0][0], None])
+                self._clear()
         else:
-            # We're in the TRIGGERED state, so collect the audio data
-            # and add it to the ring buffer.
-            # voiced_frames.append(frame)
-            ring_buffer.append((frame, is_speech))
-            num_unvoiced = len([f for f, speech in ring_buffer if not speech])
             # If more than 90% of the frames in the ring buffer are
-            # unvoiced, then enter NOTTRIGGERED and yield whatever
-            # audio we've collected.
-            if num_unvoiced > 0.9 * ring_buffer.maxlen:
-                # sys.stdout.write('-(%s)' % (frame.timestamp + frame.duration))
-                voiced_frames[len(voiced_frames)-1][1] = frame.timestamp + frame.duration
-                triggered = False
-                # yield b''.join([f.bytes for f in voiced_frames])
-                ring_buffer.clear()
-                # voiced_frames = []
-    if triggered:
-        # sys.stdout.write('-(%s)' % (frame.timestamp + frame.duration))
-        voiced_frames[len(voiced_frames)-1][1] = frame.timestamp + frame.duration
-    # sys.stdout.write('\n')
-    # If we have any leftover voiced audio when we run out of input,
-    # yield it.
-    if voiced_frames:
-        # yield b''.join([f.bytes for f in voiced_frames])
-        pass
-    return voiced_frames
+            # unvoiced, then enter NOTTRIGGERED and end the section.
+            num_unvoiced = len(self.ring_buffer) - self.num_voiced
+            if num_unvoiced > 0.9 * self.maxlen:
+                self.sections[-1][1] = self.end
+                self.triggered = False
+                self._clear()
+
+    def finish(self):
+        # End any section still open when we run out of input
+        if self.triggered:
+            self.sections[-1][1] = self.end
+        return self.sections
+
 
 """
 NOTE: MY SHAMBLY IMPLEMENTATION
 """
 
-def extract_voiced_sections(pcm_data):
-    sample_rate = 48000
-    frames = frame_generator(30, pcm_data, sample_rate)
-    frames = list(frames)
-    return vad_collector(sample_rate, 30, 300, frames)
\ No newline at end of file
+def lowpass_taps(sample_rate, analysis_rate):
+    """Returns Hamming-windowed sinc low-pass taps for decimating to the analysis rate.
+        webrtcvad only looks below DETECTOR_BAND_HZ, so the filter passes that band
+        and stops what would alias into it, allowing a wide transition and few taps.
+    Args:
+        sample_rate (int): Rate of the audio filtered.
+        analysis_rate (int): Rate it is decimated to.
+    Returns:
+        numpy.ndarray: An odd number of float32 taps with unity gain at DC.
+    """
+    nyquist = analysis_rate / 2
+    pass_hz = min(DETECTOR_BAND_HZ, 0.85 * nyquist)
+    stop_hz = max(analysis_rate - DETECTOR_BAND_HZ, 2 * nyquist - pass_hz)
+
+    # A Hamming window's transition band is about 3.3 / num_taps cycles per sample wide
+    num_taps = int(np.ceil(3.3 * sample_rate / (stop_hz - pass_hz))) | 1
+    cutoff = (pass_hz + stop_hz) / 2 / sample_rate
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    taps = np.sinc(2 * cutoff * n) * np.hamming(num_taps)
+    return (taps / taps.sum()).astype(np.float32)
+
+
+class StreamingVAD(object):
+    """Finds voiced sections in PCM audio fed in chunks of any size, framing
+        views of each chunk rather than copying the audio into Frames.
+    Produces the same sections as vad_collector over frame_generator.
+    Optionally runs detection on audio decimated to a lower analysis rate, and
+        skips the detector for frames quieter than an RMS energy threshold. Both
+        change the sections detected, see benchmarks/vad.py: the detector
+        decides differently on band-limited audio, however well it is filtered.
+        Decimated audio is low-passed first by a windowed-sinc FIR filter, which
+        delays it by at most about 1.5ms. Section timestamps are in
+        seconds, so they apply to the full rate audio either way.
+    """
+    def __init__(self, sample_rate=48000, frame_duration_ms=30, padding_duration_ms=300, detector=None,
+                 analysis_rate=None, energy_threshold=0, collector=None):
+        analysis_rate = analysis_rate if analysis_rate else sample_rate
+        if analysis_rate not in SUPPORTED_SAMPLE_RATES or sample_rate % analysis_rate != 0:
+            raise ValueError(f"unable to analyze {sample_rate}Hz audio at {analysis_rate}Hz")
+        self.sample_rate = analysis_rate
+        self.decimation = sample_rate // analysis_rate
+        self.energy_threshold = energy_threshold
+        self.detector = detector if detector else webrtcvad.Vad(VAD_MODE)
+        self.frame_bytes = int(analysis_rate * (frame_duration_ms / 1000.0) * 2)
+        self.duration = (float(self.frame_bytes) / analysis_rate) / 2.0
+        self.timestamp = 0.0
+        self.collector = collector if collector else SectionCollector(int(padding_duration_ms / frame_duration_ms))
+        # Bytes carried over from the previous chunk, at most one frame
+        self.pending = b""
+        # Full rate bytes carried over from the previous chunk, less than one decimation step
+        self.decimation_pending = b""
+        if self.decimation > 1:
+            self.taps = lowpass_taps(sample_rate, analysis_rate)
+            # Full rate samples the filter still needs from previous chunks
+            self.filter_history = np.zeros(len(self.taps) - 1, dtype=np.float32)
+
+    @property
+    def sections(self):
+        return self.collector.sections
+
+    def _decimate(self, pcm):
+        # Low-pass filter so nothing above the analysis rate's Nyquist frequency aliases,
+        #   then keep the last sample of each decimation step
+        if self.decimation_pending:
+            pcm = memoryview(self.decimation_pending + pcm.tobytes())
+        step = 2 * self.decimation
+        usable = len(pcm) - (len(pcm) % step)
+        samples = np.frombuffer(pcm, dtype=np.int16, count=usable // 2)
+        self.decimation_pending = pcm[usable:].tobytes()
+
+        padded = np.concatenate([self.filter_history, samples.astype(np.float32)])
+        self.filter_history = padded[len(padded) - len(self.filter_history):]
+
+        # Filter only the samples kept, each from a window of the samples ending at it
+        windows = np.lib.stride_tricks.sliding_window_view(padded, len(self.taps))[self.decimation - 1::self.decimation]
+        filtered = windows @ self.taps[::-1]
+        np.clip(np.rint(filtered), -32768, 32767, out=filtered)
+        return memoryview(filtered.astype(np.int16)).cast("B")
+
+    def _process_frames(self, pcm, offset, count):
+        n = self.frame_bytes
+        if self.energy_threshold:
+            frames = np.frombuffer(pcm, dtype=np.int16, count=count * n // 2, offset=offset).reshape(count, n // 2)
+            loud = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=1)) >= self.energy_threshold
+        for i in range(count):
+            if self.energy_threshold and not loud[i]:
+                is_speech = False
+            else:
+                is_speech = self.detector.is_speech(pcm[offset + i * n:offset + (i + 1) * n], self.sample_rate)
+            self.collector.push(self.timestamp, self.duration, is_speech)
+            self.timestamp += self.duration
+
+    def feed(self, pcm):
+        """Processes a chunk of 16-bit mono PCM.
+        Like frame_generator, a frame is only processed once audio beyond it has
+            arrived, so a final frame ending exactly at the end is dropped.
+        """
+        pcm = memoryview(pcm).cast("B")
+
+        # Work through large buffers in views of about FEED_BLOCK_FRAMES frames,
+        #   bounding the memory used for decimation and energy
+        block_bytes = FEED_BLOCK_FRAMES * self.frame_bytes * self.decimation
+        if len(pcm) > block_bytes and (self.decimation > 1 or self.energy_threshold):
+            for offset in range(0, len(pcm), block_bytes):
+                self.feed(pcm[offset:offset + block_bytes])
+            return
+
+        if self.decimation > 1:
+            pcm = self._decimate(pcm)
+        n = self.frame_bytes
+        offset = 0
+
+        if self.pending:
+            # Complete the frame carried over from the previous chunk
+            offset = min(n - len(self.pending), len(pcm))
+            self.pending += pcm[:offset].tobytes()
+            if len(self.pending) < n or offset >= len(pcm):
+                return
+            self._process_frames(memoryview(self.pending), 0, 1)
+            self.pending = b""
+
+        count = max(0, (len(pcm) - offset - 1) // n)
+        self._process_frames(pcm, offset, count)
+        offset += count * n
+        self.pending = pcm[offset:].tobytes()
+
+    def flush(self):
+        # Process a complete frame held back waiting for more audio
+        if len(self.pending) == self.frame_bytes:
+            self._process_frames(memoryview(self.pending), 0, 1)
+            self.pending = b""
+
+    def finish(self):
+        return self.collector.finish()
+
+
+class FlagCollector(object):
+    """Collects the per-frame speech decisions instead of sections."""
+    def __init__(self):
+        self.flags = bytearray()
+
+    def push(self, timestamp, duration, is_speech):
+        self.flags.append(1 if is_speech else 0)
+
+    def finish(self):
+        return self.flags
+
+
+def speech_flags(pcm_data, analysis_rate=VAD_SAMPLE_RATE, energy_threshold=VAD_ENERGY_THRESHOLD):
+    """Returns the detector's decision for every frame of a sequential pass, one byte each."""
+    vad_stream = StreamingVAD(48000, 30, 300, analysis_rate=analysis_rate, energy_threshold=energy_threshold,
+                              collector=FlagCollector())
+    vad_stream.feed(pcm_data)
+    return bytes(vad_stream.finish())
+
+
+class NarrowbandFrontEnd(object):
+    """Stands in for the detector, converting each frame to the 8kHz audio
+        webrtcvad's model analyzes exactly as webrtcvad would, and keeping it for a
+        detector to decide on later at 8kHz. Returns True for every frame, so the
+        collected flags mark the frames passed to it.
+    Its filter states only depend on the last few frames, unlike the model's
+        adaptive state, so chunks of a recording can be converted in parallel.
+    """
+    def __init__(self):
+        # WebRtcSpl_State48khzTo8khz, and the 32kHz and 16kHz downsampling states, zeroed as by WebRtcVad_Init
+        self.resample_state = (ctypes.c_int32 * 40)()
+        self.downsampling_state = (ctypes.c_int32 * 4)()
+        self.resample_memory = (ctypes.c_int32 * (480 + 256))()
+        self.frames = bytearray()
+
+    def state(self):
+        return bytes(self.resample_state) + bytes(self.downsampling_state)
+
+    def set_state(self, state):
+        ctypes.memmove(self.resample_state, state, ctypes.sizeof(self.resample_state))
+        ctypes.memmove(self.downsampling_state, state[ctypes.sizeof(self.resample_state):], ctypes.sizeof(self.downsampling_state))
+
+    def is_speech(self, frame, sample_rate):
+        narrowband = (ctypes.c_int16 * NARROWBAND_FRAME_SAMPLES)()
+        if sample_rate == 48000:
+            # As WebRtcVad_CalcVad48khz, which resamples the frame's first 10ms for each of its three
+            samples = (ctypes.c_int16 * 480).from_buffer_copy(frame[:960])
+            ctypes.memset(self.resample_memory, 0, ctypes.sizeof(self.resample_memory))
+            for i in range(3):
+                _webrtcvad_lib.WebRtcSpl_Resample48khzTo8khz(samples, ctypes.byref(narrowband, i * 160), self.resample_state,
+                                                             self.resample_memory)
+            self.frames += narrowband
+            return True
+
+        samples = (ctypes.c_int16 * (len(frame) // 2)).from_buffer_copy(frame)
+        if sample_rate == 32000:
+            wideband = (ctypes.c_int16 * (2 * NARROWBAND_FRAME_SAMPLES))()
+            _webrtcvad_lib.WebRtcVad_Downsampling(samples, wideband, ctypes.byref(self.downsampling_state, 8), len(samples))
+            _webrtcvad_lib.WebRtcVad_Downsampling(wideband, narrowband, self.downsampling_state, len(wideband))
+        elif sample_rate == 16000:
+            _webrtcvad_lib.WebRtcVad_Downsampling(samples, narrowband, self.downsampling_state, len(samples))
+        else:
+            narrowband = samples
+        self.frames += narrowband
+        return True
+
+
+def _chunk_narrowband(pcm_data, warmup_frames, analysis_rate, energy_threshold, state=None):
+    """Converts the frames of a chunk for the detector after warming up the
+        decimation filter and front end over warmup_frames of preceding audio,
+        or starting the front end from a state.
+    Returns:
+        tuple: (flags marking the frames to run the detector on, their 8kHz audio,
+            front end state at the start of the chunk, front end state at its end).
+    """
+    front_end = NarrowbandFrontEnd()
+    vad_stream = StreamingVAD(48000, 30, 300, detector=front_end, analysis_rate=analysis_rate,
+                              energy_threshold=energy_threshold, collector=FlagCollector())
+    pcm_data = memoryview(pcm_data).cast("B")
+    warmup_bytes = warmup_frames * vad_stream.frame_bytes * vad_stream.decimation
+    if warmup_bytes:
+        vad_stream.feed(pcm_data[:warmup_bytes])
+        vad_stream.flush()
+    if state:
+        front_end.set_state(state)
+    start_state = front_end.state()
+    del front_end.frames[:]
+
+    vad_stream.feed(pcm_data[warmup_bytes:])
+    vad_stream.flush()
+    return bytes(vad_stream.finish()[warmup_frames:]), bytes(front_end.frames), start_state, front_end.state()
+
+
+def parallel_speech_flags(pcm_data, analysis_rate=VAD_SAMPLE_RATE, energy_threshold=VAD_ENERGY_THRESHOLD,
+                          chunk_seconds=VAD_CHUNK_SECONDS, overlap_seconds=VAD_CHUNK_OVERLAP_SECONDS,
+                          workers=VAD_WORKERS):
+    """Gives the detector's decision for every frame, one byte each, yielding them
+        a chunk at a time, the same as a sequential pass.
+    The detector's model adapts over the whole recording, so it runs here in
+        order. Only converting chunks to its 8kHz input, which is most of the work,
+        runs in a process pool, each chunk starting overlap_seconds early to warm up
+        the filters. Where a chunk's front end state doesn't match the previous
+        chunk's at the boundary, it is converted again here from that state.
+    """
+    pcm_data = memoryview(pcm_data).cast("B")
+    vad_stream = StreamingVAD(48000, 30, 300, analysis_rate=analysis_rate, energy_threshold=energy_threshold)
+    detector = webrtcvad.Vad(VAD_MODE)
+    narrowband_frame_bytes = 2 * NARROWBAND_FRAME_SAMPLES
+
+    # Chunk on frame boundaries of the full rate audio
+    frame_bytes = vad_stream.frame_bytes * vad_stream.decimation
+    num_frames = max(0, (len(pcm_data) // vad_stream.decimation // 2 * 2 - 1) // vad_stream.frame_bytes)
+    chunk_frames = max(1, int(chunk_seconds / vad_stream.duration))
+    # At least a frame, longer than the decimation filter, which must see the same audio as in a sequential pass
+    overlap_frames = max(1, int(overlap_seconds / vad_stream.duration))
+
+    def chunk(first_frame):
+        warmup_frames = min(first_frame, overlap_frames)
+        start = (first_frame - warmup_frames) * frame_bytes
+        end = min(first_frame + chunk_frames, num_frames) * frame_bytes
+        return pcm_data[start:end].tobytes(), warmup_frames, analysis_rate, energy_threshold
+
+    workers = workers if workers else os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Only copy a bounded number of chunks out to the workers at once
+        first_frames = iter(range(0, num_frames, chunk_frames))
+        futures = collections.deque()
+        state = None
+        while True:
+            for first_frame in first_frames:
+                futures.append((first_frame, executor.submit(_chunk_narrowband, *chunk(first_frame))))
+                if len(futures) >= 2 * workers:
+                    break
+            if not futures:
+                break
+
+            first_frame, future = futures.popleft()
+            flags, narrowband, start_state, end_state = future.result()
+            if state is not None and start_state != state:
+                flags, narrowband, _, end_state = _chunk_narrowband(*chunk(first_frame), state=state)
+            state = end_state
+
+            decisions = bytearray(len(flags))
+            offset = 0
+            for i, passed in enumerate(flags):
+                if passed:
+                    decisions[i] = detector.is_speech(narrowband[offset:offset + narrowband_frame_bytes], 8000)
+                    offset += narrowband_frame_bytes
+            yield bytes(decisions)
+
+
+def extract_voiced_sections_parallel(pcm_data, analysis_rate=VAD_SAMPLE_RATE, energy_threshold=VAD_ENERGY_THRESHOLD,
+                                     chunk_seconds=VAD_CHUNK_SECONDS, overlap_seconds=VAD_CHUNK_OVERLAP_SECONDS,
+                                     workers=VAD_WORKERS):
+    """Stitches the frame decisions of parallel_speech_flags through one
+        SectionCollector in order, giving the same sections as extract_voiced_sections.
+    """
+    vad_stream = StreamingVAD(48000, 30, 300, analysis_rate=analysis_rate, energy_threshold=energy_threshold)
+    for flags in parallel_speech_flags(pcm_data, analysis_rate, energy_threshold, chunk_seconds, overlap_seconds, workers):
+        # Time frames as a sequential pass would
+        for is_speech in flags:
+            vad_stream.collector.push(vad_stream.timestamp, vad_stream.duration, bool(is_speech))
+            vad_stream.timestamp += vad_stream.duration
+    return vad_stream.finish()
+
+
+def extract_voiced_sections(pcm_data, analysis_rate=VAD_SAMPLE_RATE, energy_threshold=VAD_ENERGY_THRESHOLD,
+                            parallel_min_seconds=VAD_PARALLEL_MIN_SECONDS):
+    # Split long sources across processes, unless already in a worker process
+    seconds = len(memoryview(pcm_data).cast("B")) / (48000 * 2)
+    if (parallel_min_seconds and seconds > parallel_min_seconds and VAD_WORKERS > 1 and _webrtcvad_lib
+            and multiprocessing.parent_process() is None):
+        return extract_voiced_sections_parallel(pcm_data, analysis_rate, energy_threshold)
+
+    # Use a fresh detector so results don't depend on previously processed sources
+    vad_stream = StreamingVAD(48000, 30, 300, analysis_rate=analysis_rate, energy_threshold=energy_threshold)
+    vad_stream.feed(pcm_data)
+    return vad_stream.finish()
+
+
+def extract_voiced_sections_from_stream(pcm_chunks, analysis_rate=VAD_SAMPLE_RATE, energy_threshold=VAD_ENERGY_THRESHOLD,
+                                       until=None):
+    """Runs VAD on PCM as it is produced, e.g. by a streaming decoder.
+    Args:
+        pcm_chunks (generator): Yields bytes-like chunks of 16-bit mono 48kHz PCM.
+        until (function): Given the completed sections so far, returns True to stop
+            reading chunks early.
+    Returns:
+        list[list[float]]: Voiced [start, end] sections in seconds.
+    """
+    vad_stream = StreamingVAD(48000, 30, 300, analysis_rate=analysis_rate, energy_threshold=energy_threshold)
+    for chunk in pcm_chunks:
+        vad_stream.feed(chunk)
+        if until:
+            completed = vad_stream.sections[:-1] if vad_stream.collector.triggered else vad_stream.sections
+            if until(completed):
+                # Leave out a section still open, as it would be cut short
+                return completed
+    return vad_stream.finish()